@@ -0,0 +1,99 @@
+import numpy as np
+
+
+# 轨迹对齐的 DTW 核心，代价矩阵 dist 由 geo.square_distance_matrix 得到（short × long 的距离平方）
+# utils.find_best_subsequence（连续窗口）和 test_TERI.find_best_subsequence（保序子序列）都使用这里的实现
+
+
+# 代价矩阵上的精确 DTW 距离，dist 为 (..., n, m)，前面的维度整体计算
+# 沿反对角线 i + j = d 递推，同一条反对角线上的格子互不依赖，一次向量化计算，循环次数为 n + m - 1
+def dtw_distance(dist):
+    dist = np.asarray(dist, dtype=np.float64)
+    n, m = dist.shape[-2:]
+    D = np.full(dist.shape[:-2] + (n + 1, m + 1), np.inf)
+    D[..., 0, 0] = 0
+    for d in range(2, n + m + 1):
+        i = np.arange(max(1, d - m), min(n, d - 1) + 1)
+        j = d - i
+        D[..., i, j] = dist[..., i - 1, j - 1] + np.minimum(np.minimum(D[..., i - 1, j], D[..., i, j - 1]),
+                                                            D[..., i - 1, j - 1])
+    return D[..., n, m]
+
+
+# long 中所有长度为 n 的连续窗口与 short 的 DTW 距离的最小值，没有窗口时为 inf
+def best_window(dist):
+    n, m = dist.shape
+    if m < n:
+        return float('inf')
+    # (窗口数, n, n)
+    windows = np.lib.stride_tricks.sliding_window_view(dist, n, axis=1).transpose(1, 0, 2)
+    return float(dtw_distance(windows).min())
+
+
+# 在 long 中选出长度为 n = len(short) 的保序子序列，使其与 short 的 DTW 距离最小，返回最小距离和子序列在 long 中的下标
+# 与枚举所有组合再逐个做 DTW 的结果相同，用动态规划精确求解：
+#   D[i, k, j] 为 short[:i+1] 与子序列前 k+1 个点（第 k+1 个点取 long[j]）对齐的最小距离
+#   D[i, k, j] = dist[i, j] + min(D[i-1, k, j],              short 前进一步，子序列不动
+#                                 min_{j'<j} D[i, k-1, j'],  子序列前进一步（选下一个点），short 不动
+#                                 min_{j'<j} D[i-1, k-1, j'])  两者都前进
+# 每个 (i, k) 对 j 整体向量化计算，复杂度 O(n^2 * m)
+def best_subsequence(dist):
+    n, m = dist.shape
+    if n == 0:
+        return 0, []
+
+    D = np.full((n, n, m), np.inf)
+    prev_kind = np.zeros((n, n, m), dtype=np.int8)  # 0 起点，1 short 前进，2 子序列前进，3 两者都前进
+    prev_j = np.zeros((n, n, m), dtype=np.int64)
+    index = np.arange(m)
+
+    def prefix_min(values):
+        # 每个 j 之前（不含 j）的最小值及其位置
+        running_min = np.minimum.accumulate(values)
+        running_arg = np.maximum.accumulate(np.where(values == running_min, index, 0))
+        shifted_min = np.concatenate([[np.inf], running_min[:-1]])
+        shifted_arg = np.concatenate([[0], running_arg[:-1]])
+        return shifted_min, shifted_arg
+
+    for i in range(n):
+        for k in range(n):
+            if i == 0 and k == 0:
+                D[0, 0] = dist[0]
+                continue
+
+            candidates = [np.full(m, np.inf)] * 3
+            args = [index] * 3
+            if i > 0:
+                candidates[0] = D[i - 1, k]
+            if k > 0:
+                candidates[1], args[1] = prefix_min(D[i, k - 1])
+            if i > 0 and k > 0:
+                candidates[2], args[2] = prefix_min(D[i - 1, k - 1])
+
+            candidates = np.stack(candidates)
+            best = np.argmin(candidates, axis=0)
+            D[i, k] = dist[i] + candidates[best, index]
+            prev_kind[i, k] = best + 1
+            prev_j[i, k] = np.stack(args)[best, index]
+
+    j = int(np.argmin(D[n - 1, n - 1]))
+    min_distance = D[n - 1, n - 1, j]
+
+    # 回溯得到子序列中每个点在 long 中的下标
+    selected = [0] * n
+    i, k = n - 1, n - 1
+    while True:
+        selected[k] = j
+        kind = prev_kind[i, k, j]
+        if kind == 0:
+            break
+        j = int(prev_j[i, k, j])
+        if kind == 1:
+            i -= 1
+        elif kind == 2:
+            k -= 1
+        else:
+            i -= 1
+            k -= 1
+
+    return min_distance, selected
@@ -0,0 +1,137 @@
+import os
+import numpy as np
+import pandas as pd
+from gather import read_partitions
+
+# polars 为可选依赖，没有安装时只能使用 pandas
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+
+# 预处理的执行后端
+#   'pandas'  参考实现
+#   'polars'  惰性、多线程执行，读取时只读需要的列（投影下推），排序和时间转换在 Arrow 内存上完成，
+#             最后一次性转为 pandas 交给后续步骤
+# 各阶段中按分组计算的部分（meshing 的读取，trip_count 按轨迹点数过滤，trip2trips 把轨迹点拼成字符串）
+# 按 backend 选择实现，结果相同；其余部分是对整列数组的 NumPy 计算，与后端无关
+BACKENDS = ('pandas', 'polars')
+
+GATHERED_COLUMNS = ['MMSI', 'BaseDateTime', 'LAT', 'LON', 'COG', 'SOG']
+# 分块读取 csv 时每块的行数
+CSV_CHUNKSIZE = 1000000
+
+
+def check_backend(backend):
+    if backend not in BACKENDS:
+        raise ValueError(f'ERROR: {backend} is unknown.')
+    if backend == 'polars' and pl is None:
+        raise ImportError('polars is required for the polars backend')
+
+
+def gathered_paths(data_path, data_name):
+    return os.path.join(data_path, 'cleaned_' + data_name), os.path.join(data_path, 'cleaned_' + data_name + '.csv')
+
+
+# 读取 gather 的输出（分区 Parquet 数据集 cleaned_<data_name>/ 或 cleaned_<data_name>.csv），
+# 按 MMSI 和时间升幂排序（稳定排序），时间转换为 Unix 时间戳（秒）
+# mmsi_range = (lo, hi) 时只读取 lo <= MMSI <= hi 的轨迹点：Parquet 按条件下推读取，csv 分块读取后过滤
+def read_gathered(data_path, data_name, backend='pandas', mmsi_range=None):
+    check_backend(backend)
+    gathered_dir, gathered_csv = gathered_paths(data_path, data_name)
+
+    if backend == 'polars':
+        if os.path.isdir(gathered_dir):
+            lazy = pl.scan_parquet(os.path.join(gathered_dir, '**', '*.parquet'), hive_partitioning=False)
+        else:
+            lazy = pl.scan_csv(gathered_csv)
+        if mmsi_range is not None:
+            lazy = lazy.filter(pl.col('MMSI').is_between(mmsi_range[0], mmsi_range[1]))
+        df = (lazy.select(GATHERED_COLUMNS)
+              .sort(['MMSI', 'BaseDateTime'], maintain_order=True)
+              .with_columns(pl.col('BaseDateTime').str.strptime(pl.Datetime('us'), '%Y-%m-%dT%H:%M:%S')
+                            .dt.epoch('s').cast(pl.Float64))
+              .collect())
+        return df.to_pandas()
+
+    # csv 按 round_trip 解析浮点数（与 polars 相同，得到最接近的 double），两个后端读到的经纬度完全相同
+    if mmsi_range is None:
+        if os.path.isdir(gathered_dir):
+            df = read_partitions(gathered_dir, columns=GATHERED_COLUMNS)
+        else:
+            df = pd.read_csv(gathered_csv, float_precision='round_trip')
+    elif os.path.isdir(gathered_dir):
+        df = read_partitions(gathered_dir, columns=GATHERED_COLUMNS,
+                             filters=[('MMSI', '>=', mmsi_range[0]), ('MMSI', '<=', mmsi_range[1])])
+    else:
+        df = pd.concat([chunk[chunk['MMSI'].between(mmsi_range[0], mmsi_range[1])]
+                        for chunk in pd.read_csv(gathered_csv, usecols=GATHERED_COLUMNS, chunksize=CSV_CHUNKSIZE,
+                                                float_precision='round_trip')])
+
+    # 只保留部分
+    df = df[GATHERED_COLUMNS]
+
+    # 将 AIS 数据按 MMSI 和时间升幂排序
+    df.sort_values(by=['MMSI', 'BaseDateTime'], kind='stable', inplace=True)
+    df.reset_index(drop=True, inplace=True)
+
+    # 将时间字符串转换为 Unix 时间戳（秒），整列一次计算
+    # 与 1970-01-01 的时间差除以 1 秒，不依赖 datetime 列的时间单位（pandas 3 解析得到的不一定是 ns）
+    df['BaseDateTime'] = (pd.to_datetime(df['BaseDateTime'], format='%Y-%m-%dT%H:%M:%S') - pd.Timestamp(0)) / pd.Timedelta(seconds=1)
+
+    return df
+
+
+# 每个 MMSI 的轨迹点数（按 MMSI 升序），只读取 MMSI 一列
+def gathered_mmsi_counts(data_path, data_name):
+    gathered_dir, gathered_csv = gathered_paths(data_path, data_name)
+    if os.path.isdir(gathered_dir):
+        return read_partitions(gathered_dir, columns=['MMSI'])['MMSI'].value_counts().sort_index()
+
+    counts = pd.Series(dtype=np.int64)
+    for chunk in pd.read_csv(gathered_csv, usecols=['MMSI'], chunksize=CSV_CHUNKSIZE):
+        counts = counts.add(chunk['MMSI'].value_counts(), fill_value=0)
+    return counts.astype(np.int64).sort_index()
+
+
+# 按 MMSI 顺序把轨迹点分成每组约 chunk_size 个点的连续 MMSI 区间（一个 MMSI 不拆开），返回 [(lo, hi), ...]
+def mmsi_ranges(counts, chunk_size):
+    mmsi = counts.index.values
+    starts = np.cumsum(counts.values) - counts.values
+    group = starts // chunk_size
+    first = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    last = np.r_[first[1:] - 1, len(mmsi) - 1]
+    return [(int(mmsi[i]), int(mmsi[j])) for i, j in zip(first, last)]
+
+
+# 按 MMSI 区间依次读取 gather 的输出，每次只有一组 MMSI 的轨迹点在内存中；
+# 各块首尾相接即为 read_gathered 的结果
+def read_gathered_chunks(data_path, data_name, chunk_size, backend='pandas'):
+    check_backend(backend)
+    for mmsi_range in mmsi_ranges(gathered_mmsi_counts(data_path, data_name), chunk_size):
+        yield read_gathered(data_path, data_name, backend, mmsi_range)
+
+
+# 所在分组的大小不小于 min_size 的行，keys 为分组键（一维数组），返回布尔数组
+def group_size_at_least(keys, min_size, backend='pandas'):
+    check_backend(backend)
+    if backend == 'polars':
+        return (pl.DataFrame({'key': keys}).select(pl.len().over('key') >= min_size)
+                .to_series().to_numpy())
+    keys = pd.Series(keys)
+    return (keys.groupby(keys).transform('size') >= min_size).values
+
+
+# polars 后端的 trip2trips（pandas 后端为 trip2trips.trip_to_trips）：
+# 按 key 分组（分组按 key 升序，组内保持原顺序），每组的 columns 按行用 ',' 连接、各行用 ';' 连接，
+# 返回 DataFrame(id, trips, trip_length)；数值转换为字符串的方式与 pandas 的 astype(str) 相同
+def join_groups(df, key, columns):
+    # 每列整列转换一次字符串，分组和拼接在 polars 中完成
+    strings = pl.DataFrame({column: df[column].astype(str).to_numpy(dtype=object) for column in columns})
+    trips = (strings.with_columns(pl.Series('id', df[key].values))
+             .group_by('id', maintain_order=False)
+             .agg(pl.concat_str(columns, separator=',').str.join(';').alias('trips'),
+                  pl.len().cast(pl.Int64).alias('trip_length'))
+             .sort('id'))
+    return trips.to_pandas()
@@ -2,6 +2,9 @@
 grid_side = 10
 # 网格访问次数
 grid_weight_min = 52
+# 自适应四叉树网格：每个网格的目标最大点数，以及网格最大边长
+grid_point_max = 2000
+grid_side_max = 640
 # 轨迹点最小限制数量
 trip_count_min = 20
 # 轨迹点最大限制数量
@@ -14,6 +17,8 @@ time_max = 160
 distance_min = 5
 # 测试数据集中删除最小种类的数量
 test_delte = 10
+# 投影坐标系
+epsg = '4575'
 
 
 # 一条轨迹在同一个网格中最大出现比例
@@ -1,13 +1,17 @@
 import os
+import json
+import time
+import shutil
 import pandas as pd
 
 import numpy as np
-from collections import Counter
-import math
 import pickle
 
 from datetime import datetime
 from geopy.distance import geodesic
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import profiling
+from trips_store import file_hash
 
 # 相似判定中的分组mmsi数量
 mmsi_count_has_sim = 0
@@ -18,8 +22,10 @@ mmsi_count = 0
 # 𝐷𝑖𝑠 = 𝑅 × 2000 × arcsin√𝐷，其中D的公式为
 # 𝐷 = {sin[0.5 × (𝑥2 − 𝑥1)]}^2 + cos𝑥1 × cos𝑥2 × {sin[0.5 × (𝑦2 − 𝑦1)]}^2
 # 单位：米
+# data 按 MMSI 和时间排序，整表一次 shift 计算，每个 MMSI 的第一个点（前一个点属于其他船）距离记为 0
 def calculate_distance(data):
     # print(data)
+    same_mmsi = data['MMSI'].eq(data['MMSI'].shift(1))
     x1 = np.radians(data['LAT'].shift(1))
     y1 = np.radians(data['LON'].shift(1))
     x2 = np.radians(data['LAT'])
@@ -32,152 +38,149 @@ def calculate_distance(data):
     time = pd.to_datetime(data['BaseDateTime'], format='%Y-%m-%dT%H:%M:%S').diff().dt.total_seconds()
     max_distance = time * 51.2 * 1852 / 3600
 
-    data['Distance'] = distance.fillna(0)
-    data['MaxDistance'] = max_distance.fillna(0)
+    data['Distance'] = distance.where(same_mmsi, 0).fillna(0)
+    data['MaxDistance'] = max_distance.where(same_mmsi, 0).fillna(0)
 
     return data
 
 
-# 数值型数据的相似判断
-def similar_number(num1, num2):
-    if pd.isna(num1) and pd.isna(num2):
-        return 1
-    if pd.isna(num1) or pd.isna(num2):
-        return 0
-    if max(num1, num2) == 0:
-        if num1 == num2:
-            return 1
+# 相似判定使用的列及其类型，顺序与权重一致
+# 数值型：1 - |(x1 - x2) / max(x1, x2)|，max 为 0 时相等为 1 否则为 0
+# 字符型：字符计数向量的余弦相似度
+# 布尔型：如船舶的 AIS 设备种类表示为 A 类和 B 类，相等为 1 否则为 0
+# 两个值都缺失时相似度为 1，只有一个缺失时为 0
+SIMILAR_COLUMNS = [('BaseDateTime', 'string'), ('LAT', 'number'), ('LON', 'number'), ('SOG', 'number'),
+                   ('COG', 'number'), ('Heading', 'number'), ('VesselName', 'string'), ('IMO', 'string'),
+                   ('CallSign', 'string'), ('VesselType', 'number'), ('Status', 'number'), ('Length', 'number'),
+                   ('Width', 'number'), ('Draft', 'number'), ('Cargo', 'number'), ('TransceiverClass', 'bool')]
+
+
+# 字符串的字符计数矩阵，每个不同的字符串一行
+def char_counts(values):
+    codes = np.array(values, dtype=str)
+    codes = codes.view(np.uint32).reshape(len(values), -1)
+    # 定长字符串末尾用 0 填充，不计入
+    chars, inverse = np.unique(codes, return_inverse=True)
+    inverse = inverse.reshape(codes.shape)
+    rows = np.broadcast_to(np.arange(len(values))[:, None], codes.shape)
+    valid = codes != 0
+    counts = np.bincount(rows[valid] * len(chars) + inverse[valid], minlength=len(values) * len(chars))
+    return counts.reshape(len(values), len(chars))
+
+
+# 每个 MMSI 分组只计算一次：数值列转为数组，字符列转为不同取值的编号及其字符计数矩阵
+def similar_features(data):
+    features = []
+    for column, kind in SIMILAR_COLUMNS:
+        if kind == 'number':
+            features.append((kind, data[column].to_numpy(dtype=np.float64, na_value=np.nan)))
+            continue
+        codes, uniques = pd.factorize(data[column].astype(object))
+        if kind == 'string':
+            # 末尾多一个空字符串，全部缺失时也能取到一行
+            counts = char_counts([str(value) for value in uniques] + [''])
+            features.append((kind, (codes, counts, (counts * counts).sum(axis=1))))
         else:
-            return 0
-    sim = 1 - abs((num1 - num2) / max(num1, num2))
-    return sim
-
-
-# 字符型数据的相似判断
-# 余弦相似度算法
-def similar_string(str1, str2):
-    if pd.isna(str1) and pd.isna(str2):
-        return 1
-    if pd.isna(str1) or pd.isna(str2):
-        return 0
-    vector1 = Counter(list(str1))
-    vector2 = Counter(list(str2))
-
-    shared = set(vector1.keys()) & set(vector2.keys())
-    numerator = sum([vector1[x] * vector2[x] for x in shared])
-
-    sum1 = sum([vector1[x] ** 2 for x in vector1.keys()])
-    sum2 = sum([vector2[x] ** 2 for x in vector2.keys()])
-    denominator = math.sqrt(sum1 * sum2)
-
-    if not denominator:
-        return 0.0
-    else:
-        return float(numerator) / denominator
-
-
-# 布尔型数据的相似判断
-# 如船舶的 AIS 设备种类表示为 A 类和 B 类，为了方便计算，将 A 类记为 0，B 类记为 1
-def similar_bool(bool1, bool2):
-    if pd.isna(bool1) and pd.isna(bool2):
-        return 1
-    if pd.isna(bool1) or pd.isna(bool2):
-        return 0
-    return bool1 == bool2
-
-
-# 数据的相似判断
-def similar(wei, row1, row2):
-    # sim_mmsi = similar_number(row1['MMSI'], row2['MMSI'])
-    sim_time = similar_string(row1['BaseDateTime'], row2['BaseDateTime'])
-    sim_lat = similar_number(row1['LAT'], row2['LAT'])
-    sim_lon = similar_number(row1['LON'], row2['LON'])
-    sim_sog = similar_number(row1['SOG'], row2['SOG'])
-    sim_cog = similar_number(row1['COG'], row2['COG'])
-    sim_heading = similar_number(row1['Heading'], row2['Heading'])
-    sim_vessel_name = similar_string(row1['VesselName'], row2['VesselName'])
-    sim_imo = similar_string(row1['IMO'], row2['IMO'])
-    sim_call_sign = similar_string(row1['CallSign'], row2['CallSign'])
-    sim_vessel_type = similar_number(row1['VesselType'], row2['VesselType'])
-    sim_status = similar_number(row1['Status'], row2['Status'])
-    sim_length = similar_number(row1['Length'], row2['Length'])
-    sim_width = similar_number(row1['Width'], row2['Width'])
-    sim_draft = similar_number(row1['Draft'], row2['Draft'])
-    sim_cargo = similar_number(row1['Cargo'], row2['Cargo'])
-    sim_transceiver_class = similar_bool(row1['TransceiverClass'], row2['TransceiverClass'])
-    sim = np.array(
-        [
-            sim_time,
-            sim_lat, sim_lon, sim_sog, sim_cog, sim_heading, sim_vessel_name, sim_imo, sim_call_sign,
-         sim_vessel_type, sim_status, sim_length, sim_width, sim_draft, sim_cargo, sim_transceiver_class])
+            features.append((kind, codes))
+    return features
+
+
+# 分组内 rows 与 cols（广播）两两之间的加权相似度是否超过 0.95
+def similar_pairs(features, wei, rows, cols):
+    sims = []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for kind, feature in features:
+            if kind == 'number':
+                a, b = feature[rows], feature[cols]
+                a_na, b_na = np.isnan(a), np.isnan(b)
+                largest = np.maximum(a, b)
+                sim = np.where(largest == 0, (a == b).astype(np.float64), 1 - np.abs((a - b) / largest))
+            elif kind == 'string':
+                codes, counts, norms = feature
+                a, b = codes[rows], codes[cols]
+                a_na, b_na = a < 0, b < 0
+                a, b = np.maximum(a, 0), np.maximum(b, 0)
+                numerator = (counts[a] * counts[b]).sum(axis=-1)
+                denominator = np.sqrt((norms[a] * norms[b]).astype(np.float64))
+                sim = np.where(denominator == 0, 0.0, numerator / denominator)
+            else:
+                a, b = feature[rows], feature[cols]
+                a_na, b_na = a < 0, b < 0
+                sim = (a == b).astype(np.float64)
+            sim = np.where(a_na | b_na, (a_na & b_na).astype(np.float64), sim)
+            sims.append(sim)
+
     # 带权重的相似度
-    wei_sim = np.sum(sim * wei)
-    is_sim = wei_sim > 0.95
-    # print(wei_sim)
-    # print(is_sim)
-    return is_sim
-    # print(
-    #     f"sim_MMSI\n{sim_mmsi}\n"
-    #     f"sim_time\n{sim_time}\n"
-    #     f"sim_lat\n{sim_lat}\n"
-    #     f"sim_lon\n{sim_lon}\n"
-    #     f"sim_sog\n{sim_sog}\n"
-    #     f"sim_cog\n{sim_cog}\n"
-    #     f"sim_heading\n{sim_heading}\n"
-    #     f"sim_vessel_name\n{sim_vessel_name}\n"
-    #     f"sim_imo\n{sim_imo}\n"
-    #     f"sim_call_sign\n{sim_call_sign}\n"
-    #     f"sim_vessel_type\n{sim_vessel_type}\n"
-    #     f"sim_status\n{sim_status}\n"
-    #     f"sim_length\n{sim_length}\n"
-    #     f"sim_width\n{sim_width}\n"
-    #     f"sim_draft\n{sim_draft}\n"
-    #     f"sim_cargo\n{sim_cargo}\n"
-    #     f"sim_transceiver_class\n{sim_transceiver_class}\n"
-    # )
-
-
-# 改进的动态滑动窗口策略
+    wei_sim = np.sum(np.stack(sims, axis=-1) * wei, axis=-1)
+    return wei_sim > 0.95
+
+
+# 改进的动态滑动窗口策略，返回分组内每条数据是否与之前的数据相似重复
+# 窗口尺寸扩大：将窗口内数据分别与窗口第一个数据进行相似度计算，
+#   当检测到数据𝑊(𝑘)与数据𝑊(𝑖)相似时，其中𝑖 < 𝑘 ≤ 𝑗，对窗口进行扩大
+# 窗口尺寸缩小：当检测到一个不重复数据，则𝑐𝑜𝑢𝑛𝑡𝑒𝑟的值加一，当𝑐𝑜𝑢𝑛𝑡𝑒𝑟超过阈值，提前结束窗口，并缩小窗口
+# 每条数据与其后 band 个数据的相似度先用广播一次算出，窗口超出 band 时再单独计算；
+# 窗口内连续的不相似数据一次跳过，只在相似的位置和窗口结束时更新窗口状态
 def dynamic_window(data, wei, initial_window_size, threshold):
     global mmsi_count_has_sim, mmsi_count
     mmsi_count_has_sim += 1
     print(f"{mmsi_count_has_sim}/{mmsi_count}")
+
+    n = len(data)
+    is_similar = np.zeros(n, dtype=bool)
+    if n < 2:
+        return is_similar
+
+    features = similar_features(data)
+    band = min(2 * (initial_window_size + threshold), n - 1)
+    rows = np.arange(n)[:, None]
+    cols = np.minimum(rows + np.arange(1, band + 1), n - 1)
+    band_sim = similar_pairs(features, wei, rows, cols)
+
+    def similar_range(begin, start, stop):
+        if stop - begin - 1 <= band:
+            return band_sim[begin, start - begin - 1: stop - begin - 1]
+        return similar_pairs(features, wei, np.full(stop - start, begin), np.arange(start, stop))
+
     window_size = initial_window_size
     counter = 0
-    repetition_number = []
-    for begin in range(0, len(data)):
-        # print(f"repetition\n{repetition_number}\n")
-        # print(f"begin\n{begin}\n")
-        if begin in repetition_number:
+    for begin in range(n):
+        # 窗口尺寸只在比较时改变，缩小到 0 以下后不会再有比较
+        if window_size <= 0:
+            break
+        if is_similar[begin]:
             continue
         compared = 0
-        window_begin = begin
-        now = window_begin + 1
-        while compared < window_size:
-            if now >= len(data):
+        now = begin + 1
+        while True:
+            limit = min(window_size - compared, n - now)
+            if limit <= 0:
                 break
-            # 窗口尺寸扩大
-            # 将窗口内数据分别与窗口第一个数据进行相似度计算，
-            # 当检测到数据𝑊(𝑘)与数据𝑊(𝑖)相似时，其中𝑖 < 𝑘 ≤ 𝑗，对窗口进行扩大
-            if similar(wei, data.iloc[window_begin], data.iloc[now]):
-                window_change = window_size - 1
-                window_size = now - window_begin + 1 + window_change
-                repetition_number.append(now)
-                data.loc[data.index[now], 'ISSIMILAR'] = 1
-                # print(data)
-
-                # 窗口尺寸缩小
-                # 当检测到一个不重复数据，则𝑐𝑜𝑢𝑛𝑡𝑒𝑟的值加一，当𝑐𝑜𝑢𝑛𝑡𝑒𝑟超过阈值，提前结束窗口，并缩小窗口
-            else:
-                counter += 1
-                if counter > threshold:
-                    window_change = window_size - counter - 1
-                    window_size = now - window_begin + 1 - window_change
-                    counter = 0
-                    break
+            found = np.flatnonzero(similar_range(begin, now, now + limit))
+            not_similar = found[0] if len(found) > 0 else limit
+
+            # 在遇到下一个相似数据之前 counter 超过阈值
+            if threshold - counter + 1 <= not_similar:
+                now += threshold - counter
+                counter = threshold + 1
+                window_change = window_size - counter - 1
+                window_size = now - begin + 1 - window_change
+                counter = 0
+                break
+
+            counter += not_similar
+            compared += not_similar
+            now += not_similar
+            if len(found) == 0:
+                break
+
+            window_change = window_size - 1
+            window_size = now - begin + 1 + window_change
+            is_similar[now] = True
             compared += 1
             now += 1
-    return data
+
+    return is_similar
 
 def save_file(df, output_path, new_filename):
     # 保存处理后的数据集
@@ -188,11 +191,13 @@ def save_file(df, output_path, new_filename):
 # for filename in os.listdir(input_folder):
 #     if filename.endswith('.csv'):
 
-def data_clean(df):
+def data_clean(df, dedup=True):
 
     global mmsi_count_has_sim, mmsi_count
     # 相似判定中的分组mmsi数量
     mmsi_count_has_sim = 0
+    # 每一步的耗时、内存峰值和行数
+    mark = profiling.step_marker('data_clean', len(df))
 
     # Load the dataset
 
@@ -203,36 +208,48 @@ def data_clean(df):
     df.reset_index(drop=True, inplace=True)
     print("1 将 AIS 数据按 MMSI 和时间升幂排序 end")
     print("len(df):{}\n".format(len(df)))
+    mark('1 排序', len(df))
     # print(df)
 
     # 2. 删除 MMSI 不为 9 位的数据
-    df = df[df['MMSI'].apply(lambda x: len(str(x)) == 9)]
+    df = df[(df['MMSI'] >= 100000000) & (df['MMSI'] <= 999999999)]
     print("2 删除 MMSI 不为 9 位的数据 end")
     print("len(df):{}\n".format(len(df)))
+    mark('2 MMSI 位数', len(df))
+
+    # 3、4 都是整船删除，IMO 种类数和轨迹点数在同一次分组中算出
+    groups = df.groupby('MMSI')
+    imo_count = groups['IMO'].transform('nunique')
+    group_size = groups['MMSI'].transform('size')
 
     # 3. 删除MMSI相同、IMO不同的情况，一般为套牌船
     # print(df)
-    df = df.groupby('MMSI').filter(lambda x: x['IMO'].nunique() <= 1)
+    keep = imo_count <= 1
+    df = df[keep]
     # print(df)
     print("3 删除MMSI相同、IMO不同的情况，一般为套牌船 end")
     print("len(df):{}\n".format(len(df)))
+    mark('3 套牌船', len(df))
 
     # 4. 删除一天内的AIS数据不足50条的轨迹
     # print(df)
-    df = df.groupby('MMSI').filter(lambda x: x['MMSI'].count() > 50)
+    df = df[group_size[keep] > 50]
     # print(df)
     print("4 删除一天内的AIS数据不足1050条的轨迹 end")
     print("len(df):{}\n".format(len(df)))
+    mark('4 轨迹点数', len(df))
 
     # 5. 删除状态为1的轨迹点
     df = df[df['Status'] != 1]
     print("5 删除状态为1的轨迹点 end")
     print("len(df):{}\n".format(len(df)))
+    mark('5 状态', len(df))
 
     # 6. 删除船长小于 3 和船宽小于 2 的船舶数据
     df = df[(df['Length'] >= 3) & (df['Width'] >= 2)]
     print("6 删除船长小于 3 和船宽小于 2 的船舶数据 end")
     print("len(df):{}\n".format(len(df)))
+    mark('6 船舶尺寸', len(df))
 
     # 7. 删除超出有效范围的经度、维度、对地航速、对地航向数据
     df = df[(df['LON'] >= -180.0) & (df['LON'] <= 180.0)]
@@ -241,9 +258,10 @@ def data_clean(df):
     df = df[(df['COG'] >= 0) & (df['COG'] <= 409.6)]
     print("7 删除超出有效范围的经度、维度、对地航速、对地航向数据 end")
     print("len(df):{}\n".format(len(df)))
+    mark('7 有效范围', len(df))
 
     # 8. 删除经纬度明显漂移的数据
-    df = df.groupby('MMSI').apply(calculate_distance, include_groups=False).reset_index(level=0)
+    df = calculate_distance(df.copy())
     # print(df)
 
     # 排除与前后两个点之间实际距离均大于理论距离的点
@@ -255,85 +273,227 @@ def data_clean(df):
     # print(df)
     print("8 删除经纬度明显漂移的数据 end")
     print("before df len:{}\n".format(len(df)))
-
-    # # 9. 删除相似重复的数据
-    # # 求去掉mmsi的各列权重
-    # # df_without_mmsi = df.drop(columns=['MMSI', 'BaseDateTime', 'Distance', 'MaxDistance'], axis=1)
-    # df_without_mmsi = df.drop(columns=['MMSI', 'Distance', 'MaxDistance'], axis=1)
-    #
-    # # print(df_without_mmsi)
-    # num_unique = df_without_mmsi.nunique()
-    # total_unique = num_unique.sum()
-    # weight = num_unique / total_unique
-    # print(f"种类数量:\n {num_unique}\n种类总数:\n{total_unique}\n权重:\n{weight}")
-    # mmsi_count = df['MMSI'].nunique()
-    # print('mmsi_count: {}'.format(df['MMSI'].nunique()))
-    # # print(df)
-    # # 删除相似数据
-    # df['ISSIMILAR'] = 0
-    # df = df.groupby('MMSI').apply(dynamic_window, wei=weight, initial_window_size=5, threshold=5,
-    #                               include_groups=False).reset_index(level=0)
-    # # print(df.head())
-    #
-    # df = df[df['ISSIMILAR'] == 0]
-    # df = df.drop('ISSIMILAR', axis=1)
-    # # print(df)
-    # print("9 删除重复的数据 end")
-    # print("after df len:{}\n".format(len(df)))
+    mark('8 漂移', len(df))
+
+    # 9. 删除相似重复的数据
+    if dedup:
+        # 求去掉mmsi的各列权重
+        columns = [column for column, _ in SIMILAR_COLUMNS]
+        num_unique = df[columns].nunique()
+        total_unique = num_unique.sum()
+        weight = (num_unique / total_unique).values
+        print(f"种类数量:\n {num_unique}\n种类总数:\n{total_unique}\n权重:\n{weight}")
+        mmsi_count = df['MMSI'].nunique()
+        print('mmsi_count: {}'.format(df['MMSI'].nunique()))
+        # 删除相似数据，按 MMSI 分组（组内按时间排序）
+        is_similar = np.zeros(len(df), dtype=bool)
+        for index in df.groupby('MMSI', sort=False).indices.values():
+            is_similar[index] = dynamic_window(df.iloc[index], weight, initial_window_size=5, threshold=5)
+
+        df = df[~is_similar]
+        print("9 删除重复的数据 end")
+        print("after df len:{}\n".format(len(df)))
 
     df.drop(columns=['Distance', 'MaxDistance'], inplace=True)
     df.reset_index(drop=True, inplace=True)
+    mark('9 相似重复', len(df), last=True)
     # print(df)
 
     return df
 
 
+# 流式读取时只读取清洗用到的列，并指定类型，避免类型推断和无用列占用内存
+# 相似重复判定用到 SIMILAR_COLUMNS 中的所有列
+CLEAN_COLUMNS = ['MMSI'] + [column for column, _ in SIMILAR_COLUMNS]
+CLEAN_DTYPES = {'MMSI': np.int64, 'BaseDateTime': str, 'LAT': np.float64, 'LON': np.float64,
+                'SOG': np.float64, 'COG': np.float64, 'Heading': np.float64, 'VesselName': str,
+                'IMO': str, 'CallSign': str, 'VesselType': np.float64, 'Status': np.float64,
+                'Length': np.float64, 'Width': np.float64, 'Draft': np.float64, 'Cargo': np.float64,
+                'TransceiverClass': str}
+# 输出保留的列
+OUTPUT_COLUMNS = ['MMSI', 'BaseDateTime', 'LAT', 'LON', 'COG', 'SOG']
+
+
+# 分块读取一个每日文件，每块读入后立即按经纬度范围过滤，内存只与范围内的数据量有关
+def read_bbox(file_path, lon_min, lon_max, lat_min, lat_max, chunksize=1000000):
+    chunks = []
+    for chunk in pd.read_csv(file_path, usecols=CLEAN_COLUMNS, dtype=CLEAN_DTYPES, chunksize=chunksize):
+        chunk = chunk[((chunk['LON'] >= lon_min) & (chunk['LON'] < lon_max) &
+                       (chunk['LAT'] >= lat_min) & (chunk['LAT'] < lat_max))]
+        chunks.append(chunk)
+
+    return pd.concat(chunks, ignore_index=True)
+
+
+# 文件名 AIS_2023_12_30.csv 对应的日期 2023-12-30，其他文件名直接使用去掉扩展名的文件名
+def file_day(filename):
+    parts = os.path.splitext(filename)[0].split('_')
+    if len(parts) >= 3 and all(part.isdigit() for part in parts[-3:]):
+        return '-'.join(parts[-3:])
+    return os.path.splitext(filename)[0]
+
+
+# 按 MMSI 分桶
+def mmsi_bucket(mmsi, n_buckets):
+    return np.asarray(mmsi, dtype=np.int64) % n_buckets
+
+
+# 分区 Parquet 数据集：output_dir/day=<日期>/bucket=<MMSI 桶>/part-0.parquet
+# 重复写入同一天时先删除该天原有的分区
+def write_partition(df, output_dir, day, n_buckets):
+    day_dir = os.path.join(output_dir, 'day=' + day)
+    shutil.rmtree(day_dir, ignore_errors=True)
+    os.makedirs(day_dir)
+
+    buckets = mmsi_bucket(df['MMSI'].values, n_buckets)
+    for bucket in np.unique(buckets):
+        partition_dir = os.path.join(day_dir, 'bucket=' + str(bucket))
+        os.makedirs(partition_dir, exist_ok=True)
+        df[buckets == bucket].to_parquet(os.path.join(partition_dir, 'part-0.parquet'), index=False)
+
+
+# 每天的分区写完后最后写入 _SUCCESS，记录
+#   source  源文件的大小和修改时间
+#   params  清洗参数：经纬度范围、分桶数、分块大小、是否删除相似重复
+#   code    清洗代码（本文件）的 sha1
+# 三者都与本次运行相同时才跳过该天；中途失败的天没有该文件，以 _ 开头的文件读取数据集时会被忽略
+def source_stamp(file_path):
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def clean_params(lon_min, lon_max, lat_min, lat_max, n_buckets, chunksize, dedup):
+    return {'bbox': [lon_min, lon_max, lat_min, lat_max], 'n_buckets': n_buckets, 'chunksize': chunksize, 'dedup': dedup}
+
+
+def clean_stamp(file_path, params):
+    return {'source': source_stamp(file_path), 'params': params, 'code': file_hash(os.path.abspath(__file__))}
+
+
+def day_up_to_date(file_path, output_dir, day, params):
+    marker = os.path.join(output_dir, 'day=' + day, '_SUCCESS')
+    if not os.path.exists(marker):
+        return False
+    with open(marker) as f:
+        # 经过 JSON 比较，与写入时的形式一致
+        return json.load(f).get('stamp') == json.loads(json.dumps(clean_stamp(file_path, params)))
+
+
+def mark_day(file_path, output_dir, day, params, stats):
+    with open(os.path.join(output_dir, 'day=' + day, '_SUCCESS'), 'w') as f:
+        json.dump({'stamp': clean_stamp(file_path, params), 'stats': stats}, f)
+
+
+# 读取分区 Parquet 数据集，可以只读部分列；filters 为 pyarrow 的过滤条件，下推到读取时执行
+def read_partitions(output_dir, columns=None, filters=None):
+    df = pd.read_parquet(output_dir, columns=columns, filters=filters)
+    # 分区列由目录名得到，不属于原始数据
+    return df.drop(columns=[column for column in ['day', 'bucket'] if column in df.columns])
+
+
+def daily_files(input_folder):
+    return sorted(filename for filename in os.listdir(input_folder) if filename.endswith('.csv'))
+
+
+# 流式处理一个每日文件：分块读取、过滤、清洗后直接写入该天的分区，返回行数和耗时
+def process_day(file_path, output_dir, lon_min, lon_max, lat_min, lat_max, n_buckets=16, chunksize=1000000, dedup=True):
+    begin = time.time()
+    day = file_day(os.path.basename(file_path))
+
+    with profiling.profile('process_day ' + day):
+        temp_df = read_bbox(file_path, lon_min, lon_max, lat_min, lat_max, chunksize)
+        rows_in = len(temp_df)
+        profiling.rows(rows_in=rows_in)
+
+        temp_df = data_clean(temp_df, dedup)
+
+        # 只保留部分
+        temp_df = temp_df[OUTPUT_COLUMNS]
+
+        write_partition(temp_df, output_dir, day, n_buckets)
+        profiling.rows(rows_out=len(temp_df))
+    stats = {'file': os.path.basename(file_path), 'day': day, 'rows_in': rows_in, 'rows_out': len(temp_df),
+             'seconds': time.time() - begin}
+    mark_day(file_path, output_dir, day, clean_params(lon_min, lon_max, lat_min, lat_max, n_buckets, chunksize, dedup), stats)
+    # 性能记录随结果返回（子进程中的记录不会出现在主进程），不写入 _SUCCESS
+    stats['profile'] = profiling.collect()
+
+    return stats
+
+
+# 每个每日文件单独处理，不在内存中累积，内存峰值只取决于单个文件在范围内的数据量，与处理的月份数无关
+# n_workers > 1 时用进程池并行清洗，同时提交的任务不超过 max_in_flight 个；
+# 已经处理过、源文件和清洗参数、清洗代码都未改变的天直接跳过，中断后重新运行会从未完成的天继续
+def process_files_stream(file_paths, output_dir, lon_min, lon_max, lat_min, lat_max, n_buckets=16, chunksize=1000000,
+                         n_workers=1, max_in_flight=None, dedup=True):
+    params = clean_params(lon_min, lon_max, lat_min, lat_max, n_buckets, chunksize, dedup)
+    pending = [file_path for file_path in file_paths
+               if not day_up_to_date(file_path, output_dir, file_day(os.path.basename(file_path)), params)]
+    print("files:{} skipped:{}".format(len(file_paths), len(file_paths) - len(pending)))
+
+    all_stats = []
+
+    def report(stats):
+        all_stats.append(stats)
+        print("{}/{} {}: rows {} -> {}, {:.1f}s".format(len(all_stats), len(pending), stats['file'],
+                                                        stats['rows_in'], stats['rows_out'], stats['seconds']))
+
+    if n_workers <= 1:
+        for file_path in pending:
+            report(process_day(file_path, output_dir, lon_min, lon_max, lat_min, lat_max, n_buckets, chunksize, dedup))
+        return all_stats
+
+    if max_in_flight is None:
+        max_in_flight = 2 * n_workers
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        in_flight = set()
+        for file_path in pending:
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    report(future.result())
+            in_flight.add(executor.submit(process_day, file_path, output_dir, lon_min, lon_max, lat_min, lat_max,
+                                          n_buckets, chunksize, dedup))
+        for future in wait(in_flight).done:
+            report(future.result())
+
+    return all_stats
+
+
 def process_file(input_folder, lon_min, lon_max, lat_min, lat_max):
-    df = pd.DataFrame()
+    dfs = []
     file_count = 0
 
-    for filename in os.listdir(input_folder):
+    for filename in daily_files(input_folder):
         # if filename != "AIS_2023_12_30.csv":
         #     continue
-        if filename.endswith('.csv'):
-            file_path = os.path.join(input_folder, filename)
+        file_path = os.path.join(input_folder, filename)
 
-            print("{}: {} begin".format(file_count, filename))
+        print("{}: {} begin".format(file_count, filename))
+        with profiling.profile('process_file ' + filename):
             # 读取csv文件的内容
             temp_df = pd.read_csv(file_path)
 
             temp_df = temp_df[((temp_df['LON'] >= lon_min) & (temp_df['LON'] < lon_max) &
                             (temp_df['LAT'] >= lat_min) & (temp_df['LAT'] < lat_max))]
+            profiling.rows(rows_in=len(temp_df))
 
             temp_df = data_clean(temp_df)
 
             # 只保留部分
-            temp_df = temp_df[['MMSI', 'BaseDateTime', 'LAT', 'LON', 'COG', 'SOG']]
+            temp_df = temp_df[OUTPUT_COLUMNS]
+            profiling.rows(rows_out=len(temp_df))
 
-            # save_file(temp_df, '../data/AIS/AIS_2023_101112', filename)
+        # save_file(temp_df, '../data/AIS/AIS_2023_101112', filename)
 
-            df = pd.concat([df, temp_df])
-            # print("df len:{}\n".format(len(df)))
+        # 先收集，最后只拼接一次
+        dfs.append(temp_df)
 
-            print(f"{filename} end")
+        print("{}: {} end".format(file_count, filename))
 
+        file_count = file_count + 1
 
-            # for lon_min, lon_max, lat_min, lat_max in zip(LON_min, LON_max, LAT_min, LAT_max):
-            #
-            #     temp_df1 = temp_df[((temp_df['LON'] >= lon_min) & (temp_df['LON'] < lon_max) &
-            #                        (temp_df['LAT'] >= lat_min) & (temp_df['LAT'] < lat_max))]
-            #     df = pd.concat([df, temp_df1])
-            #     print("len(temp_df1):{} len(df):{}".format(len(temp_df1), len(df)))
-
-
-            # 将读取的内容添加到df中
-            # df = pd.concat([df, temp_df])
-
-            print("{}: {} end".format(file_count, filename))
-
-            file_count = file_count + 1
-
-    return df
+    return pd.concat(dfs) if dfs else pd.DataFrame()
 
 
 def save_file(df, output_path, new_filename):
@@ -342,11 +502,13 @@ def save_file(df, output_path, new_filename):
     df.to_csv(output_path, index=False)
 
 
-def gather():
+# output_format 为 'parquet' 时流式写入分区 Parquet 数据集 cleaned_AIS_2023_4month/（n_workers 个进程并行），
+# 为 'csv' 时与原来一样在内存中合并后写出 AIS_2023_4month.csv
+def gather(output_format, n_workers=1):
 
     input_folders = ['../data/AIS_2023_09', '../data/AIS_2023_10', '../data/AIS_2023_11', '../data/AIS_2023_12']
+    output_path = '../data/AIS/AIS_2023_4month'
 
-    df = pd.DataFrame()
     # LON_min = [-95.5, -94.8,  -91.18, -88.7, -85.6, -83.5, -82.6, -81.4]
     # LON_max = [-83.5, -91.18, -89.5,  -85.6, -83.5, -82.6, -81.4, -79.0]
     # LAT_min = [ 23.5,  28.8,   28.8,   28.8,  28.8,  23.3,  23.3,  23.3]
@@ -362,19 +524,25 @@ def gather():
     lat_min = 28.5
     lat_max = 30.5
 
-    file_count = 0
-
-    for folder in input_folders:
-        temp_df = process_file(folder, lon_min, lon_max, lat_min, lat_max)
-        df = pd.concat([df, temp_df])
-        file_count += 1
-
+    if output_format == 'parquet':
+        output_dir = os.path.join(output_path, 'cleaned_AIS_2023_4month')
+        file_paths = [os.path.join(folder, filename) for folder in input_folders for filename in daily_files(folder)]
+        stats = process_files_stream(file_paths, output_dir, lon_min, lon_max, lat_min, lat_max, n_workers=n_workers)
+        print("rows:{}".format(sum(stat['rows_out'] for stat in stats)))
+        records = [record for stat in stats for record in stat['profile']]
+    elif output_format == 'csv':
+        df = pd.concat([process_file(folder, lon_min, lon_max, lat_min, lat_max) for folder in input_folders])
+        save_file(df, output_path, 'AIS_2023_4month.csv')
+        records = profiling.collect()
+    else:
+        raise ValueError(f'ERROR: {output_format} is unknown.')
 
+    # 每个文件及 data_clean 每一步的耗时、CPU 时间、内存峰值和行数
+    profiling.write_run(os.path.join(output_path, 'profile'), 'gather_' + output_format, records,
+                        {'n_workers': n_workers})
 
-    save_file(df, '../data/AIS/AIS_2023_4month', 'AIS_2023_4month.csv')
     print("finish")
 
 
-gather()
-
-
+if __name__ == '__main__':
+    gather('parquet', n_workers=os.cpu_count())
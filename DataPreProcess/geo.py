@@ -0,0 +1,130 @@
+import os
+import pickle
+import hashlib
+from functools import lru_cache
+import numpy as np
+from pyproj import Transformer
+
+
+# 坐标转换与球面距离，所有坐标转换都经过这里
+# Transformer 按 CRS 对缓存，整个数组一次 pyproj 调用完成转换；距离用 NumPy 对 (N, 2) 数组整体计算，
+# 与 geopy.distance.great_circle 的公式和地球半径一致
+# 网格中心表按数据集缓存；在较小的范围内也可以用拟合的仿射变换近似投影，并给出误差上界
+
+# geopy 使用的地球平均半径（千米）
+EARTH_RADIUS = 6371.009
+
+
+# 所有转换都使用 always_xy，输入输出均为 (x, y) / (lon, lat) 顺序
+@lru_cache(maxsize=None)
+def get_transformer(src, dst):
+    return Transformer.from_crs(f"epsg:{src}", f"epsg:{dst}", always_xy=True)
+
+
+# 投影坐标 (N, 2) 的 (x, y) 转为 (N, 2) 的 (lon, lat)，给出 affine 时使用仿射近似
+def to_wgs84(points, epsg, affine=None):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if affine is not None:
+        return affine_transform(affine['inverse'], points)
+    lon, lat = get_transformer(epsg, '4326').transform(points[:, 0], points[:, 1])
+    return np.stack([np.asarray(lon), np.asarray(lat)], axis=1)
+
+
+# (N, 2) 的 (lon, lat) 转为投影坐标 (x, y)，给出 affine 时使用仿射近似
+def from_wgs84(lonlat, epsg, affine=None):
+    lonlat = np.asarray(lonlat, dtype=np.float64).reshape(-1, 2)
+    if affine is not None:
+        return affine_transform(affine['forward'], lonlat)
+    x, y = get_transformer('4326', epsg).transform(lonlat[:, 0], lonlat[:, 1])
+    return np.stack([np.asarray(x), np.asarray(y)], axis=1)
+
+
+# 纬度、经度两列一次转换，返回 (北向, 东向) 坐标，即预处理中 LAT、LON 列转换后的含义
+def project_columns(lat, lon, epsg):
+    x, y = get_transformer('4326', epsg).transform(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+    return np.asarray(y), np.asarray(x)
+
+
+# 仿射变换：points (N, 2) 乘以 3×2 矩阵（最后一行为平移）
+def affine_transform(matrix, points):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    return points @ matrix[:2] + matrix[2]
+
+
+def fit_affine(source, target):
+    design = np.hstack([source, np.ones((len(source), 1))])
+    return np.linalg.lstsq(design, target, rcond=None)[0]
+
+
+# 在经纬度范围 bbox = (lon_min, lon_max, lat_min, lat_max) 内用 samples×samples 个点拟合正反两个仿射变换，
+# 在 check×check 个点上与精确投影比较，给出最大误差：max_error（米）、inverse_max_error（度）
+def fit_local_affine(epsg, bbox, samples=16, check=64):
+    lon_min, lon_max, lat_min, lat_max = bbox
+
+    def lattice(count):
+        lon, lat = np.meshgrid(np.linspace(lon_min, lon_max, count), np.linspace(lat_min, lat_max, count))
+        return np.stack([lon.ravel(), lat.ravel()], axis=1)
+
+    lonlat = lattice(samples)
+    xy = from_wgs84(lonlat, epsg)
+    affine = {'forward': fit_affine(lonlat, xy), 'inverse': fit_affine(xy, lonlat)}
+
+    lonlat = lattice(check)
+    xy = from_wgs84(lonlat, epsg)
+    affine['max_error'] = float(np.max(np.linalg.norm(affine_transform(affine['forward'], lonlat) - xy, axis=1)))
+    affine['inverse_max_error'] = float(np.max(np.abs(affine_transform(affine['inverse'], xy) - lonlat)))
+    return affine
+
+
+# 网格中心表：grid2center_<data_name>.pickle（网格编号 0..N-1 -> 投影坐标 (x, y)）转为数组，
+#   'xy'      N×2 投影坐标
+#   'lonlat'  N×2 经纬度
+# 以 pickle 文件的 sha1 为键缓存到 <pickle>.centers.npz，同一进程内按文件修改时间缓存在内存中
+def grid_center_table(grid2center_path, epsg):
+    stat = os.stat(grid2center_path)
+    return load_grid_center_table(grid2center_path, epsg, stat.st_mtime, stat.st_size)
+
+
+@lru_cache(maxsize=None)
+def load_grid_center_table(grid2center_path, epsg, mtime, size):
+    with open(grid2center_path, 'rb') as f:
+        content = f.read()
+    key = hashlib.sha1(content + str(epsg).encode()).hexdigest()
+
+    cache_path = grid2center_path + '.centers.npz'
+    if os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        if str(cached['key']) == key:
+            return {'xy': cached['xy'], 'lonlat': cached['lonlat']}
+
+    grid2center = pickle.loads(content)
+    xy = np.array([grid2center[grid] for grid in range(len(grid2center))], dtype=np.float64).reshape(-1, 2)
+    lonlat = to_wgs84(xy, epsg)
+    np.savez(cache_path, key=key, xy=xy, lonlat=lonlat)
+    return {'xy': xy, 'lonlat': lonlat}
+
+
+# 两组 (lon, lat) 逐点的大圆距离（米），支持广播
+def great_circle_distance(lonlat1, lonlat2):
+    lonlat1 = np.radians(np.asarray(lonlat1, dtype=np.float64))
+    lonlat2 = np.radians(np.asarray(lonlat2, dtype=np.float64))
+    lng1, lat1 = lonlat1[..., 0], lonlat1[..., 1]
+    lng2, lat2 = lonlat2[..., 0], lonlat2[..., 1]
+
+    sin_lat1, cos_lat1 = np.sin(lat1), np.cos(lat1)
+    sin_lat2, cos_lat2 = np.sin(lat2), np.cos(lat2)
+    delta_lng = lng2 - lng1
+    cos_delta_lng, sin_delta_lng = np.cos(delta_lng), np.sin(delta_lng)
+
+    d = np.arctan2(np.sqrt((cos_lat2 * sin_delta_lng) ** 2 +
+                           (cos_lat1 * sin_lat2 - sin_lat1 * cos_lat2 * cos_delta_lng) ** 2),
+                   sin_lat1 * sin_lat2 + cos_lat1 * cos_lat2 * cos_delta_lng)
+
+    return EARTH_RADIUS * d * 1000
+
+
+# 两组投影坐标之间两两的大圆距离平方（米²），返回 len(points_a) × len(points_b) 的矩阵
+def square_distance_matrix(points_a, points_b, epsg):
+    lonlat_a = to_wgs84(points_a, epsg)
+    lonlat_b = to_wgs84(points_b, epsg)
+    return great_circle_distance(lonlat_a[:, None, :], lonlat_b[None, :, :]) ** 2
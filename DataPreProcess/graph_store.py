@@ -0,0 +1,103 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.sparse.linalg import eigsh
+
+
+# 稀疏邻接矩阵与拉普拉斯矩阵
+# 邻接矩阵由 graph_A.csv 的边表直接构建为 scipy.sparse 矩阵，节点为所有网格加上 TOTAL_SPE_TOKEN 个特殊标记，
+# 不再经过 networkx 生成 N×N 的稠密矩阵
+
+
+# 边表转为 n_vertex × n_vertex 的 csr 矩阵，网格编号加上 spe_token 偏移
+def edges_to_matrix(src, dst, weights, n_vertex, spe_token=0):
+    return sp.csr_matrix((np.asarray(weights, dtype=np.float64), (np.asarray(src) + spe_token, np.asarray(dst) + spe_token)),
+                         shape=(n_vertex, n_vertex))
+
+
+# graph_A.csv 旁边同名的稀疏矩阵文件（trips_graph 同时写出），不比 csv 旧时直接读取
+def adjacency_matrix_path(adj_path):
+    return os.path.splitext(adj_path)[0] + '.npz'
+
+
+# 读取 graph_A.csv，网格编号加上 spe_token 偏移，返回 n_vertex × n_vertex 的 csr 矩阵
+def read_adjacency(adj_path, n_vertex, spe_token):
+    matrix_path = adjacency_matrix_path(adj_path)
+    if os.path.exists(matrix_path) and os.path.getmtime(matrix_path) >= os.path.getmtime(adj_path):
+        matrix = sp.load_npz(matrix_path).tocoo()
+        return edges_to_matrix(matrix.row, matrix.col, matrix.data, n_vertex, spe_token)
+
+    adj_pd = pd.read_csv(adj_path)
+    # 与 networkx 加边的行为一致，重复的边保留最后一次的权重
+    adj_pd = adj_pd.drop_duplicates(subset=['src', 'dst'], keep='last')
+
+    return edges_to_matrix(adj_pd['src'].values, adj_pd['dst'].values, adj_pd['weight'].values, n_vertex, spe_token)
+
+
+# 度为 0 的节点取 0，与稠密求逆时的奇异情况区分开
+def inverse_degree(deg):
+    inv = np.zeros_like(deg)
+    np.divide(1.0, deg, out=inv, where=deg != 0)
+    return inv
+
+
+def calculate_laplacian_matrix_sparse(adj_mat, mat_type):
+    n_vertex = adj_mat.shape[0]
+    adj_mat = sp.csr_matrix(adj_mat, dtype=np.float64)
+
+    # row sum
+    deg = np.asarray(adj_mat.sum(axis=1)).ravel()
+    id_mat = sp.identity(n_vertex, dtype=np.float64, format='csr')
+
+    if mat_type == 'com_lap_mat':
+        # Combinatorial
+        com_lap_mat = sp.diags(deg) - adj_mat
+        return com_lap_mat.tocsr()
+    elif mat_type == 'wid_rw_normd_lap_mat':
+        # For ChebConv
+        rw_lap_mat = sp.diags(inverse_degree(deg)) @ adj_mat
+        rw_normd_lap_mat = id_mat - rw_lap_mat
+        lambda_max_rw = eigsh(rw_lap_mat, k=1, which='LM', return_eigenvectors=False)[0]
+        wid_rw_normd_lap_mat = 2 * rw_normd_lap_mat / lambda_max_rw - id_mat
+        return wid_rw_normd_lap_mat.tocsr()
+    elif mat_type == 'hat_rw_normd_lap_mat':
+        # For GCNConv
+        wid_adj_mat = adj_mat + id_mat
+        hat_rw_normd_lap_mat = sp.diags(1.0 / (deg + 1)) @ wid_adj_mat
+        return hat_rw_normd_lap_mat.tocsr()
+    else:
+        raise ValueError(f'ERROR: {mat_type} is unknown.')
+
+
+def adjacency_hash(adj_mat, mat_type):
+    adj_mat = sp.csr_matrix(adj_mat)
+    sha = hashlib.sha1()
+    sha.update(mat_type.encode())
+    sha.update(np.asarray(adj_mat.shape, dtype=np.int64).tobytes())
+    for array in (adj_mat.indptr, adj_mat.indices, adj_mat.data):
+        sha.update(np.ascontiguousarray(array).tobytes())
+    return sha.hexdigest()
+
+
+# 带缓存的拉普拉斯矩阵，缓存保存在 cache_path 目录下的 <mat_type>.npz，邻接矩阵变化时重新计算
+def calculate_laplacian_matrix(adj_mat, mat_type, cache_path=None):
+    if cache_path is None:
+        return calculate_laplacian_matrix_sparse(adj_mat, mat_type)
+
+    mat_path = os.path.join(cache_path, mat_type + '.npz')
+    hash_path = os.path.join(cache_path, mat_type + '.sha1')
+    adj_hash = adjacency_hash(adj_mat, mat_type)
+
+    if os.path.exists(hash_path) and open(hash_path).read() == adj_hash:
+        return sp.load_npz(mat_path).tocsr()
+
+    lap_mat = calculate_laplacian_matrix_sparse(adj_mat, mat_type)
+    os.makedirs(cache_path, exist_ok=True)
+    if os.path.exists(hash_path):
+        os.remove(hash_path)
+    sp.save_npz(mat_path, lap_mat)
+    open(hash_path, 'w').write(adj_hash)
+
+    return lap_mat
@@ -1,45 +1,31 @@
 import numpy as np
 import pandas as pd
 import os
-from pyproj import Transformer
 import pickle
 from constants import *
-from joblib import Parallel, delayed
+from trips_store import save_points
+import profiling
+from backend import read_gathered, read_gathered_chunks
+from geo import project_columns
 import math
 
 
-def compute_distances(group, group_name):
-    last_point = None
-    delete_index = []
+# 每个点与同一 MMSI 中前一个点的距离是否不超过 distance_min（坐标为米）
+def close_to_previous(mmsi, lat, lon):
+    close = np.zeros(len(mmsi), dtype=bool)
+    dis = np.sqrt((lat[1:] - lat[:-1]) ** 2 + (lon[1:] - lon[:-1]) ** 2)
+    close[1:] = (mmsi[1:] == mmsi[:-1]) & (dis <= distance_min)
+    return close
 
-    for idx, row in group.iterrows():
-        if last_point is None:
-            last_point = (row['LAT'], row['LON'])
-            continue
-
-        point = (row['LAT'], row['LON'])
-        dis = math.sqrt((point[0] - last_point[0]) ** 2 + (point[1] - last_point[1]) ** 2)
-
-        if dis <= distance_min:
-            delete_index.append(idx - 1)
-
-        last_point = point
-
-    # print(f"Processed group: {group_name}")
-    return delete_index
 
+# df 按 MMSI 和时间排序，某个点与前一个点距离过近时删除前一个点
 def trips_diff(df):
     print(f"trip length: {len(df)}")
 
-    grouped = df.groupby('MMSI')
+    close = close_to_previous(df['MMSI'].values, df['LAT'].values, df['LON'].values)
 
-    # 并行计算各组的删除索引
-    delete_indices = Parallel(n_jobs=-1)(
-        delayed(compute_distances)(group, mmsi) for mmsi, group in grouped
-    )
-
-    # 将所有删除索引合并为一个列表
-    delete_indices = [idx for sublist in delete_indices for idx in sublist]
+    # 删除的是前一个点的索引
+    delete_indices = np.unique(df.index.values[close] - 1)
 
     # 删除指定索引的行
     df.drop(index=delete_indices, inplace=True)
@@ -47,10 +33,37 @@ def trips_diff(df):
     return df
 
 
+# 与 wgs84_to_utm + trips_diff 相同，但数据按块读入（read_gathered_chunks 的输出，按 MMSI 和时间排序、首尾相接）
+# 每块投影后与上一块的最后一个点拼在一起计算，最后一个点是否删除要看下一块的第一个点，所以留到下一块再决定
+# 内存中同时只有一块原始数据和已经删除过近点的结果；返回删除后的 df 和读入的总点数
+def trips_diff_chunks(chunks):
+    kept = []
+    carry = None
+    rows_in = 0
+    for chunk in chunks:
+        # 索引接着上一块编号，与整表读取时相同
+        chunk.index += rows_in
+        rows_in += len(chunk)
+        chunk['LAT'], chunk['LON'] = wgs84_to_utm(chunk['LAT'], chunk['LON'])
+        if carry is not None:
+            chunk = pd.concat([carry, chunk])
+
+        close = close_to_previous(chunk['MMSI'].values, chunk['LAT'].values, chunk['LON'].values)
+        # 下一个点与当前点过近时删除当前点
+        keep = ~np.r_[close[1:], False]
+        kept.append(chunk.iloc[:-1][keep[:-1]])
+        carry = chunk.iloc[-1:]
+        print(f"chunk length: {len(chunk)}")
+
+    if carry is not None:
+        kept.append(carry)
+    print(f"trip length: {rows_in}")
+    return pd.concat(kept), rows_in
+
+
 def wgs84_to_utm(northing, easting):
-    transformer = Transformer.from_crs("epsg:4326", "epsg:4575")
-    # transformer = Transformer.from_crs("epsg:4326", "epsg:3086")
-    lat, lon = transformer.transform(northing, easting)
+    # 两列一次转换，结果与 Transformer.from_crs("epsg:4326", "epsg:4575").transform(lat, lon) 相同
+    lat, lon = project_columns(northing, easting, epsg)
     return lat, lon
 
 
@@ -102,6 +115,135 @@ def trip_grids(df):
     return df, grids_dict
 
 
+# 自适应四叉树网格：根网格为覆盖所有点的边长 grid_side * 2^depth 的正方形，
+# 点数超过 grid_point_max 或边长超过 grid_side_max 的网格继续四等分，直到边长为 grid_side；
+# 船舶密集的区域网格小，稀疏的区域网格大，网格数（词表大小）由 grid_point_max 控制
+# 划分后自底向上合并（merge_quadtree_leaves），再去掉点数少于 grid_weight_min 的网格
+# 返回值与 trip_grids 相同：GRID 列为网格编号，字典中为点数不少于 grid_weight_min 的网格中心
+def trip_grids_quadtree(df):
+
+    print("df length:{}".format(len(df)))
+
+    lat_min = df['LAT'].min()
+    lon_min = df['LON'].min()
+    lat_max = df['LAT'].max()
+    lon_max = df['LON'].max()
+
+    # 最细一层与固定网格相同
+    lat_indices = np.floor_divide((df['LAT'] - lat_min).values, grid_side).astype(np.int64)
+    lon_indices = np.floor_divide((df['LON'] - lon_min).values, grid_side).astype(np.int64)
+    side_count = max(math.ceil((lat_max - lat_min) / grid_side), math.ceil((lon_max - lon_min) / grid_side), 1)
+    depth = math.ceil(math.log2(side_count + 1))
+
+    # 叶子网格（按编号）的层、该层的网格索引和点数
+    leaves = {'level': [], 'lat': [], 'lon': [], 'count': []}
+    grid_ids = np.full(len(df), -1, dtype=np.int64)
+    next_id = 0
+    active = np.arange(len(df))
+    for level in range(depth + 1):
+        shift = depth - level
+        side = grid_side * 2 ** shift
+        lat_cells = lat_indices[active] >> shift
+        lon_cells = lon_indices[active] >> shift
+        keys = lat_cells * (2 ** level) + lon_cells
+        unique, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+
+        # 最后一层的网格不再划分
+        leaf = np.ones(len(unique), dtype=bool) if shift == 0 else (counts <= grid_point_max) & (side <= grid_side_max)
+        leaf_ids = np.full(len(unique), -1, dtype=np.int64)
+        leaf_ids[leaf] = np.arange(next_id, next_id + leaf.sum())
+        next_id += leaf.sum()
+
+        leaves['level'].append(np.full(leaf.sum(), level))
+        leaves['lat'].append(unique[leaf] // (2 ** level))
+        leaves['lon'].append(unique[leaf] % (2 ** level))
+        leaves['count'].append(counts[leaf])
+
+        is_leaf = leaf[inverse]
+        grid_ids[active[is_leaf]] = leaf_ids[inverse[is_leaf]]
+        active = active[~is_leaf]
+
+    leaves = {key: np.concatenate(value).astype(np.int64) for key, value in leaves.items()}
+    # 叶子网格的中心
+    leaf_side = grid_side * 2.0 ** (depth - leaves['level'])
+    leaves['center_lat'] = lat_min + (leaves['lat'] + 0.5) * leaf_side
+    leaves['center_lon'] = lon_min + (leaves['lon'] + 0.5) * leaf_side
+
+    cell, count, center_lat, center_lon = merge_quadtree_leaves(leaves, depth)
+    grid_ids = cell[grid_ids]
+
+    # 创建满足条件的网格字典
+    grids_dict = {}
+    for grid_id in np.unique(cell):
+        if count[grid_id] < grid_weight_min:
+            continue
+        grids_dict[grid_id] = (center_lon[grid_id], center_lat[grid_id])
+
+    print("depth:{}, leaf grids:{}, merged grids:{}".format(depth, next_id, len(np.unique(cell))))
+
+    df['GRID'] = grid_ids
+
+    return df, grids_dict
+
+
+# 自底向上合并四叉树的叶子网格：从最细一层开始，同一父网格下的叶子网格（包括下一层合并得到的网格）
+# 点数之和不超过 grid_point_max 且父网格边长不超过 grid_side_max 时合并为父网格层的一个网格，继续参与上一层的合并；
+# 合并后的编号为其中最小的叶子编号，中心为各网格中心按点数的加权平均（只有一个网格时不变）
+# 这样被划分开的父网格中，稀疏的兄弟网格不会因为各自少于 grid_weight_min 个点而全部删除
+# leaves 为按叶子编号的 level、lat、lon（该层的网格索引）、count、center_lat、center_lon，
+# 返回每个叶子所在网格的编号，以及按编号的点数和中心（只有网格编号处有效）
+def merge_quadtree_leaves(leaves, depth):
+    cell = np.arange(len(leaves['count']))
+    count = leaves['count'].copy()
+    center_lat = leaves['center_lat'].copy()
+    center_lon = leaves['center_lon'].copy()
+    lat = leaves['lat'].copy()
+    lon = leaves['lon'].copy()
+
+    items = np.zeros(0, dtype=np.int64)
+    for level in range(depth, 0, -1):
+        # 父网格边长超过 grid_side_max 时不再合并，上一层的父网格更大
+        if grid_side * 2 ** (depth - level + 1) > grid_side_max:
+            break
+        items = np.concatenate([items, np.flatnonzero(leaves['level'] == level)])
+        if len(items) == 0:
+            continue
+        parents, inverse = np.unique((lat[items] >> 1) * (2 ** (level - 1)) + (lon[items] >> 1), return_inverse=True)
+        totals = np.bincount(inverse, weights=count[items]).astype(np.int64)
+        sizes = np.bincount(inverse)
+
+        merge = totals[inverse] <= grid_point_max
+        items, inverse = items[merge], inverse[merge]
+        rep = np.full(len(parents), len(cell), dtype=np.int64)
+        np.minimum.at(rep, inverse, items)
+        groups = np.unique(inverse)
+        rep = rep[groups]
+
+        # 多个网格合并时的中心
+        weighted_lat = np.bincount(inverse, weights=count[items] * center_lat[items], minlength=len(parents))
+        weighted_lon = np.bincount(inverse, weights=count[items] * center_lon[items], minlength=len(parents))
+        several = sizes[groups] > 1
+        center_lat[rep[several]] = weighted_lat[groups[several]] / totals[groups[several]]
+        center_lon[rep[several]] = weighted_lon[groups[several]] / totals[groups[several]]
+        count[rep] = totals[groups]
+        # rep 是组内的网格，其父网格即组的父网格
+        lat[rep] = lat[rep] >> 1
+        lon[rep] = lon[rep] >> 1
+
+        group_rep = np.full(len(parents), -1, dtype=np.int64)
+        group_rep[groups] = rep
+        cell[items] = group_rep[inverse]
+        items = rep
+
+    # 合并链：叶子 -> 下一层合并的网格 -> 上一层合并的网格
+    while True:
+        resolved = cell[cell]
+        if np.array_equal(resolved, cell):
+            break
+        cell = resolved
+    return cell, count, center_lat, center_lon
+
+
 # 创建字典
 def create_dict(grids):
     grids_dict = {}
@@ -133,65 +275,69 @@ def create_dict(grids):
 def save_file(df, output_path, new_filename):
     # 保存处理后的数据集
     output_path = os.path.join(output_path, new_filename)
-    df.to_csv(output_path, index=True)
+    if new_filename.endswith('.npz'):
+        save_points(output_path, df)
+    else:
+        df.to_csv(output_path, index=True)
 
 
-def meshing(data_format, data_name):
+# backend 为 'pandas' 或 'polars'，只影响读取、排序和时间转换，结果相同
+# mesh 为 'fixed'（边长 grid_side 的固定网格）或 'quadtree'（自适应四叉树网格）
+# chunk_size 不为空时按 MMSI 区间分块读取（每块约 chunk_size 个点，一个 MMSI 不拆开）并删除过近的点，
+# 读取阶段的内存只与块大小有关；划分网格需要删除后的全部点，结果与不分块时相同
+def meshing(data_format, data_name, backend='pandas', mesh='fixed', chunk_size=None):
     data_path = os.path.join('../data', 'AIS', data_name)
-    if data_format == 'csv':
-        df = pd.read_csv(os.path.join(data_path, 'cleaned_'+ data_name +'.csv'))
+    if data_format not in ('csv', 'npz'):
+        raise ValueError(f'ERROR: {data_format} is unknown.')
+    # gather 的输出为 csv 或分区 Parquet 数据集 cleaned_<data_name>/，data_format 决定本阶段输出的格式
+    # 读取后按 MMSI 和时间升幂排序，时间转换为 Unix 时间戳（秒）
+    if chunk_size is None:
+        df = read_gathered(data_path, data_name, backend)
         print('meshing read finish')
-
-        # print("len(df:{})".format(len(df)))
-        # df = df[df['Status'] != 1]
-        # print("删除状态为1的轨迹点 end\n")
-        # print("len(df:{})".format(len(df)))
-
-        # 只保留部分
-        df = df[['MMSI', 'BaseDateTime', 'LAT', 'LON', 'COG', 'SOG']]
-
-        # 将 AIS 数据按 MMSI 和时间升幂排序
-        df.sort_values(by=['MMSI', 'BaseDateTime'], inplace=True)
-        df.reset_index(drop=True, inplace=True)
+        profiling.rows(rows_in=len(df))
         print("将 AIS 数据按 MMSI 和时间升幂排序 end\n")
 
-        # 将时间字符串转换为 datetime 对象
-        # 将 datetime 对象转换为 Unix 时间戳（秒）
-        df['BaseDateTime'] = pd.to_datetime(df['BaseDateTime'])
-        df['BaseDateTime'] = df['BaseDateTime'].apply(lambda x: x.timestamp())
-
         # 将 经纬度 对象转换 （米）
         df['LAT'], df['LON'] = wgs84_to_utm(df['LAT'], df['LON'])
         print('data trans finish')
 
         trips_diff(df)
-        save_file(df, data_path, 'diff_dis_' + data_name + '.csv')
-        print('delete distance finish')
-        print("len(df):{}".format(len(df)))
-
-        # 给轨迹点加上网格号 同时创建字典
+    else:
+        df, rows_in = trips_diff_chunks(read_gathered_chunks(data_path, data_name, chunk_size, backend))
+        profiling.rows(rows_in=rows_in)
+    save_file(df, data_path, 'diff_dis_' + data_name + '.' + data_format)
+    print('delete distance finish')
+    print("len(df):{}".format(len(df)))
+
+    # 给轨迹点加上网格号 同时创建字典
+    if mesh == 'fixed':
         df, grids_dict = trip_grids(df)
+    elif mesh == 'quadtree':
+        df, grids_dict = trip_grids_quadtree(df)
+    else:
+        raise ValueError(f'ERROR: {mesh} is unknown.')
 
-        # 保存到pickle文件
-        pickle.dump(grids_dict, open(os.path.join(data_path, 'grids_'+ data_name +'.pickle'), 'wb'))
-        # 读取
-        grids_AIS_EAST = pickle.load(open(os.path.join(data_path, 'grids_'+ data_name +'.pickle'), 'rb'))
-        open(os.path.join(data_path, 'grids_'+ data_name +'.txt'), 'w').write(f"{grids_AIS_EAST}\n")
-        print('create dict finish')
+    # 保存到pickle文件
+    pickle.dump(grids_dict, open(os.path.join(data_path, 'grids_'+ data_name +'.pickle'), 'wb'))
+    # 读取
+    grids_AIS_EAST = pickle.load(open(os.path.join(data_path, 'grids_'+ data_name +'.pickle'), 'rb'))
+    open(os.path.join(data_path, 'grids_'+ data_name +'.txt'), 'w').write(f"{grids_AIS_EAST}\n")
+    print('create dict finish')
 
-        print("len(grids_dict:{})".format(len(grids_dict)))
-        print("len(df):{}".format(len(df)))
+    print("len(grids_dict:{})".format(len(grids_dict)))
+    print("len(df):{}".format(len(df)))
 
-        df = df[df['GRID'].isin(grids_dict)]
+    df = df[df['GRID'].isin(grids_dict)]
 
-        print("len(df:{})".format(len(df)))
-        print('delete not in gird finish')
-        save_file(df, data_path, 'grid_delete_cleaned_' + data_name + '.csv')
+    print("len(df:{})".format(len(df)))
+    print('delete not in gird finish')
+    save_file(df, data_path, 'grid_delete_cleaned_' + data_name + '.' + data_format)
+    profiling.rows(rows_out=len(df))
 
-        print('finish')
+    print('finish')
 
-        # 显示 DataFrame 的前几行以确认数据是否正确加载
-        # print(df.head())
+    # 显示 DataFrame 的前几行以确认数据是否正确加载
+    # print(df.head())
 
 
 # meshing('csv', 'AIS_z')
@@ -0,0 +1,263 @@
+import os
+import ast
+import json
+import string
+import hashlib
+import inspect
+import constants
+import trips_store
+import profiling
+from trips_store import file_hash
+from meshing import meshing
+from trip_count import trip_count
+from trip2trips import trip2trips
+from trips2new import trips2new
+from trips_drop import trips_drop
+from trips_split import trips_split
+from trips_graph import trips_graph
+from test_delete_graph import test_delete_graph
+
+
+# 增量运行的预处理流水线
+# 每个阶段声明输入、输出文件（相对 ../data/AIS/<data_name>/，{name}、{fmt} 为数据集名和中间结果格式，
+# {<选项>} 为阶段选项的值，选项没有设置或为 None 时没有该文件；元组表示取第一个存在的文件）、
+# 用到的 constants.py 中的参数以及阶段函数的选项
+# 阶段的键为 阶段代码（阶段模块及其导入的本目录模块）、参数、选项和所有输入文件内容的 sha1，
+# 记录在 .pipeline/<阶段>.<格式>.json 中；键与上次运行相同且输出文件内容没有变化时跳过该阶段。
+# 例如只修改 trip_count_max 时 meshing 跳过，trip_count 重新运行，之后的阶段只有在输入内容确实变化时才重新运行
+# 每个阶段都依赖上一个阶段的输出，按顺序在同一个进程中运行，
+# npz 格式的中间结果同时留在内存中，下一个阶段不再从磁盘读取
+STAGES = [
+    {'name': 'meshing', 'func': meshing,
+     'inputs': [('cleaned_{name}', 'cleaned_{name}.csv')],
+     'outputs': ['diff_dis_{name}.{fmt}', 'grids_{name}.pickle', 'grids_{name}.txt', 'grid_delete_cleaned_{name}.{fmt}'],
+     'params': ['grid_side', 'grid_weight_min', 'grid_point_max', 'grid_side_max', 'distance_min', 'epsg'],
+     'options': ['backend', 'mesh', 'chunk_size']},
+    {'name': 'trip_count', 'func': trip_count,
+     'inputs': ['grid_delete_cleaned_{name}.{fmt}'],
+     'outputs': ['count_{name}.{fmt}', 'delete_count_{name}.{fmt}'],
+     'params': ['time_min', 'time_max', 'trip_count_min', 'trip_count_max'],
+     'options': ['backend']},
+    {'name': 'trip2trips', 'func': trip2trips,
+     'inputs': ['delete_count_{name}.{fmt}'],
+     'outputs': ['trips_cleaned_{name}.{fmt}'],
+     'params': [],
+     'options': ['backend']},
+    {'name': 'trips2new', 'func': trips2new,
+     'inputs': ['trips_cleaned_{name}.{fmt}', 'grids_{name}.pickle'],
+     'outputs': ['trips_new_cleaned_{name}.{fmt}', 'grid2center_{name}.pickle', 'grid2center_{name}.txt'],
+     'params': [],
+     'options': []},
+    {'name': 'trips_drop', 'func': trips_drop,
+     'inputs': ['trips_new_cleaned_{name}.{fmt}'],
+     'outputs': ['trips_drop_cleaned_{name}.{fmt}'],
+     'params': [],
+     'options': ['seed']},
+    {'name': 'trips_split', 'func': trips_split,
+     'inputs': ['trips_drop_cleaned_{name}.{fmt}'],
+     'outputs': ['traj_train.{fmt}', 'traj_val.{fmt}', 'traj_test111.{fmt}'],
+     'params': [],
+     'options': []},
+    {'name': 'trips_graph', 'func': trips_graph,
+     'inputs': ['traj_train.{fmt}'],
+     'outputs': ['graph_A.csv', 'graph_A.npz', 'graph_A_window{time_window}.npz'],
+     'params': [],
+     'options': ['time_window']},
+    {'name': 'test_delete_graph', 'func': test_delete_graph,
+     'inputs': ['traj_test111.{fmt}', 'graph_A.csv'],
+     'outputs': ['traj_test.{fmt}'],
+     'params': ['test_delte'],
+     'options': []},
+]
+STAGE_BY_NAME = {stage['name']: stage for stage in STAGES}
+
+# 不影响结果的选项，不计入阶段的键
+RESULT_FREE_OPTIONS = ['backend', 'chunk_size']
+
+# 阶段代码所在的目录；constants 的值已按 params 计入键，profiling 只做测量，两者都不计入阶段代码
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+NON_CODE_MODULES = ['constants', 'profiling']
+
+
+def data_dir(data_name):
+    return os.path.join('../data', 'AIS', data_name)
+
+
+def record_path(data_path, name, data_format):
+    return os.path.join(data_path, '.pipeline', '{}.{}.json'.format(name, data_format))
+
+
+def resolve(pattern, data_path, data_name, data_format, options):
+    if isinstance(pattern, tuple):
+        paths = [resolve(alternative, data_path, data_name, data_format, options) for alternative in pattern]
+        return next((path for path in paths if os.path.exists(path)), paths[0])
+    return os.path.join(data_path, pattern.format(name=data_name, fmt=data_format, **options))
+
+
+# 文件名中用到的选项都已设置（不为 None）
+def pattern_enabled(pattern, options):
+    patterns = pattern if isinstance(pattern, tuple) else (pattern,)
+    fields = {field for pattern in patterns for _, field, _, _ in string.Formatter().parse(pattern) if field}
+    return all(options.get(field) is not None for field in fields - {'name', 'fmt'})
+
+
+def stage_files(stage, key, data_path, data_name, data_format, options):
+    options = stage_options(stage, options)
+    return [resolve(pattern, data_path, data_name, data_format, options) for pattern in stage[key]
+            if pattern_enabled(pattern, options)]
+
+
+# 文件的大小和修改时间，目录为其中所有文件的大小和修改时间；不变时沿用记录中的内容 sha1
+def stat_signature(path):
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+    sha = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(path)):
+        for name in sorted(files):
+            stat = os.stat(os.path.join(root, name))
+            sha.update('{}:{}:{};'.format(os.path.relpath(os.path.join(root, name), path), stat.st_size,
+                                          stat.st_mtime_ns).encode())
+    return sha.hexdigest()
+
+
+def content_hash(path):
+    if os.path.isfile(path):
+        return file_hash(path)
+    sha = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(path)):
+        for name in sorted(files):
+            sha.update(os.path.relpath(os.path.join(root, name), path).encode())
+            sha.update(file_hash(os.path.join(root, name)).encode())
+    return sha.hexdigest()
+
+
+# 文件指纹 {signature, sha1}，known 为之前记录过的指纹
+def fingerprint(path, known):
+    signature = stat_signature(path)
+    if path in known and known[path]['signature'] == signature:
+        return known[path]
+    return {'signature': signature, 'sha1': content_hash(path)}
+
+
+def load_records(data_path, data_format):
+    records = {}
+    for stage in STAGES:
+        path = record_path(data_path, stage['name'], data_format)
+        if os.path.exists(path):
+            with open(path) as f:
+                records[stage['name']] = json.load(f)
+    return records
+
+
+def known_fingerprints(records):
+    known = {}
+    for record in records.values():
+        known.update(record['inputs'])
+        known.update(record['outputs'])
+    return known
+
+
+def stage_options(stage, options):
+    return {option: options[option] for option in stage['options'] if option in options}
+
+
+# 模块中 import 的本目录模块的文件
+def repo_imports(path):
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    names = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names.append(node.module)
+    paths = [os.path.join(CODE_DIR, name + '.py') for name in names if name not in NON_CODE_MODULES]
+    return [path for path in paths if os.path.isfile(path)]
+
+
+# 阶段代码：阶段函数所在模块及其递归导入的本目录模块，{文件名: sha1}
+# 例如修改 trips_store.py 或 geo.py 时，用到它们的阶段都重新运行
+def stage_code(stage):
+    pending = [os.path.abspath(inspect.getsourcefile(stage['func']))]
+    files = set()
+    while pending:
+        path = pending.pop()
+        if path not in files:
+            files.add(path)
+            pending += repo_imports(path)
+    return {os.path.basename(path): file_hash(path) for path in sorted(files)}
+
+
+def stage_key(stage, inputs, options):
+    content = {'stage': stage['name'],
+               'code': stage_code(stage),
+               'params': {param: getattr(constants, param) for param in stage['params']},
+               'options': {option: value for option, value in stage_options(stage, options).items()
+                           if option not in RESULT_FREE_OPTIONS},
+               'inputs': {os.path.basename(path): value['sha1'] for path, value in inputs.items()}}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def outputs_current(record, outputs, known):
+    for path in outputs:
+        if not os.path.exists(path) or path not in record['outputs']:
+            return False
+        if fingerprint(path, known)['sha1'] != record['outputs'][path]['sha1']:
+            return False
+    return True
+
+
+# 依次运行各阶段，返回实际运行的阶段名和这些阶段的性能记录
+def run_stages(names, data_format, data_name, options, force=False):
+    data_path = data_dir(data_name)
+    os.makedirs(os.path.join(data_path, '.pipeline'), exist_ok=True)
+    ran = []
+    previous_outputs = []
+    for name in names:
+        stage = STAGE_BY_NAME[name]
+        records = load_records(data_path, data_format)
+        known = known_fingerprints(records)
+
+        inputs = {path: fingerprint(path, known)
+                  for path in stage_files(stage, 'inputs', data_path, data_name, data_format, options)}
+        outputs = stage_files(stage, 'outputs', data_path, data_name, data_format, options)
+        key = stage_key(stage, inputs, options)
+        record = records.get(name)
+        if not force and record is not None and record['key'] == key and outputs_current(record, outputs, known):
+            print('pipeline: {} is up to date'.format(name))
+            previous_outputs = []
+            continue
+
+        # 只保留上一个阶段的输出在内存中
+        trips_store.keep_in_memory(data_format == 'npz', previous_outputs)
+        print('pipeline: run {}'.format(name))
+        with profiling.profile(name):
+            stage['func'](data_format, data_name, **stage_options(stage, options))
+        previous_outputs = outputs
+
+        record = {'key': key, 'inputs': inputs, 'outputs': {path: fingerprint(path, {}) for path in outputs}}
+        temp_path = record_path(data_path, name, data_format) + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(record, f)
+        os.replace(temp_path, record_path(data_path, name, data_format))
+        ran.append(name)
+
+    trips_store.keep_in_memory(False)
+    return ran, profiling.collect()
+
+
+# 实际运行的阶段的性能记录写入 .pipeline/profile/pipeline_<格式>_<时间>.json 和 .txt
+def write_profile(data_path, data_format, records, options):
+    if records:
+        profiling.write_run(os.path.join(data_path, '.pipeline', 'profile'), 'pipeline_' + data_format, records,
+                            {'options': options})
+
+
+# 运行流水线，options 为各阶段函数的选项（backend、mesh、chunk_size、seed、time_window）
+# force 为 True 时不跳过任何阶段
+def run_pipeline(data_format, data_name, force=False, **options):
+    ran, records = run_stages([stage['name'] for stage in STAGES], data_format, data_name, options, force)
+    print('pipeline: ran {}'.format(ran))
+    write_profile(data_dir(data_name), data_format, records, options)
+    return ran
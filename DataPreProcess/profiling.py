@@ -0,0 +1,152 @@
+import os
+import sys
+import json
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# resource 只在 Unix 上有，没有时（且没有 /proc）峰值记为 None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# 阶段和步骤的性能记录，每条记录包含
+#   name               阶段或步骤名
+#   wall_seconds       墙上时间
+#   cpu_seconds        本进程的 CPU 时间（用户态 + 内核态）
+#   peak_rss_mb        这一段运行期间的 RSS 峰值，无法读取时为 None
+#   rows_in, rows_out  输入、输出的行数（轨迹点数）
+#   rows_per_second    rows_in / wall_seconds
+# 记录按结束顺序保存在本进程中，collect 取出；write_run 把一次运行的记录写成 JSON 和汇总表
+# 默认得到的是进程启动以来的峰值；环境变量 PROFILING_RESET_PEAK=1 时，Linux 上每段开始时
+# 向 /proc/self/clear_refs 写入 5 重置 VmHWM，得到该段自己的峰值（会清除整个进程的页面访问标记，默认不做）
+RESET_PEAK = os.environ.get('PROFILING_RESET_PEAK') == '1'
+
+records = []
+# 正在运行的记录，外层在前
+running = []
+
+
+def read_peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # ru_maxrss 在 Linux 上为 KB，在 macOS 上为字节
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+# 把到目前为止的峰值计入所有正在运行的记录，RESET_PEAK 时再重置峰值
+def checkpoint_rss():
+    peak = read_peak_rss_mb()
+    if peak is not None:
+        for record in running:
+            record['peak_rss_mb'] = peak if record['peak_rss_mb'] is None else max(record['peak_rss_mb'], peak)
+    if not RESET_PEAK:
+        return
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def start(name, rows_in=None):
+    checkpoint_rss()
+    record = {'name': name, 'rows_in': None if rows_in is None else int(rows_in), 'rows_out': None, 'peak_rss_mb': None,
+              'started': datetime.now().isoformat(timespec='seconds'),
+              'wall_begin': time.perf_counter(), 'cpu_begin': time.process_time()}
+    running.append(record)
+    return record
+
+
+# 结束 record，同时丢弃在它之后开始、因异常没有结束的记录（如出错的 step_marker 步骤）
+def finish(record, rows_out=None):
+    try:
+        checkpoint_rss()
+    finally:
+        del running[running.index(record):]
+    if rows_out is not None:
+        record['rows_out'] = int(rows_out)
+    record['wall_seconds'] = time.perf_counter() - record.pop('wall_begin')
+    record['cpu_seconds'] = time.process_time() - record.pop('cpu_begin')
+    record['rows_per_second'] = record['rows_in'] / record['wall_seconds'] \
+        if record['rows_in'] is not None and record['wall_seconds'] > 0 else None
+    records.append(record)
+    return record
+
+
+@contextmanager
+def profile(name, rows_in=None):
+    record = start(name, rows_in)
+    try:
+        yield record
+    finally:
+        finish(record)
+
+
+# 阶段内报告行数，记入最内层正在运行的记录；没有在记录时不做任何事
+def rows(rows_in=None, rows_out=None):
+    if not running:
+        return
+    if rows_in is not None:
+        running[-1]['rows_in'] = int(rows_in)
+    if rows_out is not None:
+        running[-1]['rows_out'] = int(rows_out)
+
+
+# 顺序执行的多个步骤：mark(name, rows_out) 结束上一个 mark 之后开始的步骤，
+# 下一个步骤的输入行数为这一步的输出行数；最后一步 last=True，之后不再开始新的步骤
+def step_marker(prefix, rows_in):
+    state = {'record': start(prefix, rows_in)}
+
+    def mark(name, rows_out, last=False):
+        record = state['record']
+        record['name'] = '{} {}'.format(prefix, name)
+        finish(record, rows_out)
+        if not last:
+            state['record'] = start(prefix, rows_out)
+
+    return mark
+
+
+# 取出本进程已结束的记录（子进程中调用后随结果返回）
+def collect():
+    finished = list(records)
+    records.clear()
+    return finished
+
+
+def summary_table(run_records):
+    header = '{:<48} {:>10} {:>10} {:>10} {:>12} {:>12} {:>12}'.format(
+        'name', 'wall(s)', 'cpu(s)', 'peak(MB)', 'rows_in', 'rows_out', 'rows/s')
+    lines = [header, '-' * len(header)]
+    for record in run_records:
+        lines.append('{:<48} {:>10.2f} {:>10.2f} {:>10} {:>12} {:>12} {:>12}'.format(
+            record['name'][:48], record['wall_seconds'], record['cpu_seconds'],
+            '' if record['peak_rss_mb'] is None else '{:.1f}'.format(record['peak_rss_mb']),
+            '' if record['rows_in'] is None else record['rows_in'],
+            '' if record['rows_out'] is None else record['rows_out'],
+            '' if record['rows_per_second'] is None else '{:.0f}'.format(record['rows_per_second'])))
+    return '\n'.join(lines)
+
+
+# 一次运行写成 <output_dir>/<run_name>_<时间>.json 和同名 .txt 汇总表，返回 JSON 路径
+def write_run(output_dir, run_name, run_records, info=None):
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, '{}_{}'.format(run_name, datetime.now().strftime('%Y%m%d_%H%M%S')))
+    with open(path + '.json', 'w') as f:
+        json.dump({'run': run_name, 'info': info or {}, 'records': run_records}, f, ensure_ascii=False, indent=1)
+    table = summary_table(run_records)
+    with open(path + '.txt', 'w') as f:
+        f.write(table + '\n')
+    print(table)
+    return path + '.json'
@@ -0,0 +1,47 @@
+import os
+import sys
+import subprocess
+import numpy as np
+import pandas as pd
+
+
+# 测试用的小型合成数据集：n_vessels 条船沿同一条航线向东航行（每 30 秒一个点，纬度有很小的抖动），
+# 出发时间和航行点数不同，同一位置的网格被大多数船经过，能通过 grid_weight_min、trip_count_min 等过滤，
+# 流水线的每个阶段都有输出；列与 gather 的输出相同
+
+
+def synthetic_gathered(n_vessels=60, seed=0):
+    rng = np.random.default_rng(seed)
+    frames = []
+    for vessel in range(n_vessels):
+        n = int(rng.integers(40, 120))
+        start = pd.Timestamp('2023-10-01') + pd.Timedelta(seconds=int(rng.integers(0, 86400 - 120 * 30)))
+        frames.append(pd.DataFrame({
+            'MMSI': np.full(n, 366000000 + vessel, dtype=np.int64),
+            'BaseDateTime': (start + pd.to_timedelta(np.arange(n) * 30, unit='s')).strftime('%Y-%m-%dT%H:%M:%S'),
+            'LAT': 29.0 + rng.normal(0, 2e-6, n),
+            'LON': -94.0 + np.arange(n) * 0.00154 + rng.normal(0, 2e-6, n),
+            'COG': np.full(n, 90.0), 'SOG': np.full(n, 5.0)}))
+    return pd.concat(frames, ignore_index=True)
+
+
+# 在 root 下建立 data/AIS/<data_name>/cleaned_<data_name>.csv 和工作目录 work/，
+# 返回工作目录：各阶段按 '../data/AIS/<data_name>' 读写，在工作目录中运行
+def write_synthetic_dataset(root, data_name='X', n_vessels=60, seed=0):
+    data_path = os.path.join(str(root), 'data', 'AIS', data_name)
+    os.makedirs(data_path, exist_ok=True)
+    synthetic_gathered(n_vessels, seed).to_csv(os.path.join(data_path, 'cleaned_' + data_name + '.csv'), index=False)
+    work_dir = os.path.join(str(root), 'work')
+    os.makedirs(work_dir, exist_ok=True)
+    return work_dir
+
+
+# 建立合成数据集并在子进程中运行整个流水线（每种格式一次），返回数据目录 root/data/AIS/<data_name>
+# 供 recovery_stage、detection_stage 的测试使用：它们的 constants 与本目录的同名，不能在同一进程中导入各阶段
+def synthetic_pipeline_outputs(root, data_formats=('csv', 'npz'), data_name='X'):
+    work_dir = write_synthetic_dataset(root, data_name)
+    script = ('import sys\nsys.path.insert(0, {!r})\nfrom pipeline import run_pipeline\n'
+              'for data_format in {!r}:\n    run_pipeline(data_format, {!r})\n').format(
+        os.path.dirname(os.path.abspath(__file__)), list(data_formats), data_name)
+    subprocess.run([sys.executable, '-c', script], cwd=work_dir, check=True, stdout=subprocess.DEVNULL)
+    return os.path.join(str(root), 'data', 'AIS', data_name)
@@ -0,0 +1,101 @@
+import os
+import pickle
+import numpy as np
+import pandas as pd
+import pytest
+from backend import read_gathered
+from gather import write_partition
+from pipeline import run_pipeline
+from synthetic_ais import write_synthetic_dataset
+
+
+# pandas 与 polars 两个后端的一致性：读取 gather 的输出，以及在合成数据集上运行 meshing 到 trips_graph 的结果
+
+
+def gathered_frame(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    times = pd.Timestamp('2023-10-01') + pd.to_timedelta(rng.integers(0, 3 * 86400, n), unit='s')
+    return pd.DataFrame({'MMSI': rng.choice([366000001, 366000002, 538000003, 255000004], n).astype(np.int64),
+                         'BaseDateTime': times.strftime('%Y-%m-%dT%H:%M:%S'),
+                         'LAT': 28.5 + rng.random(n) * 2, 'LON': -95.6 + rng.random(n) * 15,
+                         'COG': rng.random(n) * 360, 'SOG': rng.random(n) * 20})
+
+
+def write_gathered(data_path, df, layout):
+    if layout == 'csv':
+        df.to_csv(data_path / 'cleaned_X.csv', index=False)
+        return
+    day = pd.to_datetime(df['BaseDateTime']).dt.strftime('%Y-%m-%d')
+    for value in day.unique():
+        write_partition(df[day == value], str(data_path / 'cleaned_X'), value, 4)
+
+
+def expected_frame(df):
+    expected = df.sort_values(['MMSI', 'BaseDateTime'], kind='stable').reset_index(drop=True)
+    expected['BaseDateTime'] = [pd.Timestamp(value).timestamp() for value in expected['BaseDateTime']]
+    return expected
+
+
+@pytest.mark.parametrize('layout', ['csv', 'parquet'])
+def test_pandas_backend(tmp_path, layout):
+    df = gathered_frame()
+    write_gathered(tmp_path, df, layout)
+    result = read_gathered(str(tmp_path), 'X', 'pandas')
+    expected = expected_frame(df)
+    # 时间相同的点在分区中的顺序可能不同，按全部列排序后比较
+    pd.testing.assert_frame_equal(result.sort_values(list(result.columns), ignore_index=True),
+                                  expected.sort_values(list(expected.columns), ignore_index=True))
+    # 按 MMSI 和时间排序
+    assert (result[['MMSI', 'BaseDateTime']].values == expected[['MMSI', 'BaseDateTime']].values).all()
+
+
+@pytest.mark.parametrize('layout', ['csv', 'parquet'])
+def test_polars_matches_pandas(tmp_path, layout):
+    write_gathered(tmp_path, gathered_frame(), layout)
+    expected = read_gathered(str(tmp_path), 'X', 'pandas')
+    result = read_gathered(str(tmp_path), 'X', 'polars')
+    pd.testing.assert_frame_equal(result.sort_values(list(result.columns), ignore_index=True),
+                                  expected.sort_values(list(expected.columns), ignore_index=True), check_exact=True)
+    # 排序键相同
+    assert (result[['MMSI', 'BaseDateTime']].values == expected[['MMSI', 'BaseDateTime']].values).all()
+
+
+def pipeline_outputs(root, data_format, backend, monkeypatch):
+    monkeypatch.chdir(write_synthetic_dataset(root))
+    run_pipeline(data_format, 'X', backend=backend)
+    return os.path.join(str(root), 'data', 'AIS', 'X')
+
+
+def load_file(path):
+    if path.endswith('.npz'):
+        with np.load(path) as f:
+            return {key: f[key] for key in f.files}
+    if path.endswith('.pickle'):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def assert_same(a, b):
+    if isinstance(a, dict) and all(isinstance(value, np.ndarray) for value in a.values()):
+        assert a.keys() == b.keys()
+        for key in a:
+            assert np.array_equal(a[key], b[key]), key
+    else:
+        assert a == b
+
+
+@pytest.mark.parametrize('data_format', ['csv', 'npz'])
+def test_pipeline_backends_match(tmp_path, monkeypatch, data_format):
+    pandas_path = pipeline_outputs(tmp_path / 'pandas', data_format, 'pandas', monkeypatch)
+    polars_path = pipeline_outputs(tmp_path / 'polars', data_format, 'polars', monkeypatch)
+
+    names = ['grid_delete_cleaned_X.', 'delete_count_X.', 'trips_cleaned_X.', 'trips_new_cleaned_X.', 'traj_train.',
+             'traj_test.']
+    names = [name + data_format for name in names] + ['grids_X.pickle', 'graph_A.csv', 'graph_A.npz']
+    for name in names:
+        assert_same(load_file(os.path.join(pandas_path, name)), load_file(os.path.join(polars_path, name)))
+    # 合成数据集每个阶段都有输出
+    assert len(load_file(os.path.join(pandas_path, 'grids_X.pickle'))) > 0
+    assert len(load_file(os.path.join(pandas_path, 'graph_A.csv')).splitlines()) > 1
@@ -0,0 +1,177 @@
+import math
+from collections import Counter
+import numpy as np
+import pandas as pd
+import gather
+from gather import SIMILAR_COLUMNS, dynamic_window
+
+
+# gather.dynamic_window（向量化的相似重复判定）与原来逐行比较的实现结果相同
+# 下面是原来的 similar_number / similar_string / similar_bool / similar / dynamic_window，作为参照
+
+
+def similar_number(num1, num2):
+    if pd.isna(num1) and pd.isna(num2):
+        return 1
+    if pd.isna(num1) or pd.isna(num2):
+        return 0
+    if max(num1, num2) == 0:
+        if num1 == num2:
+            return 1
+        else:
+            return 0
+    sim = 1 - abs((num1 - num2) / max(num1, num2))
+    return sim
+
+
+def similar_string(str1, str2):
+    if pd.isna(str1) and pd.isna(str2):
+        return 1
+    if pd.isna(str1) or pd.isna(str2):
+        return 0
+    vector1 = Counter(list(str1))
+    vector2 = Counter(list(str2))
+
+    shared = set(vector1.keys()) & set(vector2.keys())
+    numerator = sum([vector1[x] * vector2[x] for x in shared])
+
+    sum1 = sum([vector1[x] ** 2 for x in vector1.keys()])
+    sum2 = sum([vector2[x] ** 2 for x in vector2.keys()])
+    denominator = math.sqrt(sum1 * sum2)
+
+    if not denominator:
+        return 0.0
+    else:
+        return float(numerator) / denominator
+
+
+def similar_bool(bool1, bool2):
+    if pd.isna(bool1) and pd.isna(bool2):
+        return 1
+    if pd.isna(bool1) or pd.isna(bool2):
+        return 0
+    return bool1 == bool2
+
+
+def similar(wei, row1, row2):
+    sim_time = similar_string(row1['BaseDateTime'], row2['BaseDateTime'])
+    sim_lat = similar_number(row1['LAT'], row2['LAT'])
+    sim_lon = similar_number(row1['LON'], row2['LON'])
+    sim_sog = similar_number(row1['SOG'], row2['SOG'])
+    sim_cog = similar_number(row1['COG'], row2['COG'])
+    sim_heading = similar_number(row1['Heading'], row2['Heading'])
+    sim_vessel_name = similar_string(row1['VesselName'], row2['VesselName'])
+    sim_imo = similar_string(row1['IMO'], row2['IMO'])
+    sim_call_sign = similar_string(row1['CallSign'], row2['CallSign'])
+    sim_vessel_type = similar_number(row1['VesselType'], row2['VesselType'])
+    sim_status = similar_number(row1['Status'], row2['Status'])
+    sim_length = similar_number(row1['Length'], row2['Length'])
+    sim_width = similar_number(row1['Width'], row2['Width'])
+    sim_draft = similar_number(row1['Draft'], row2['Draft'])
+    sim_cargo = similar_number(row1['Cargo'], row2['Cargo'])
+    sim_transceiver_class = similar_bool(row1['TransceiverClass'], row2['TransceiverClass'])
+    sim = np.array(
+        [
+            sim_time,
+            sim_lat, sim_lon, sim_sog, sim_cog, sim_heading, sim_vessel_name, sim_imo, sim_call_sign,
+         sim_vessel_type, sim_status, sim_length, sim_width, sim_draft, sim_cargo, sim_transceiver_class])
+    # 带权重的相似度
+    wei_sim = np.sum(sim * wei)
+    is_sim = wei_sim > 0.95
+    return is_sim
+
+
+def reference_dynamic_window(data, wei, initial_window_size, threshold):
+    window_size = initial_window_size
+    counter = 0
+    repetition_number = []
+    for begin in range(0, len(data)):
+        if begin in repetition_number:
+            continue
+        compared = 0
+        window_begin = begin
+        now = window_begin + 1
+        while compared < window_size:
+            if now >= len(data):
+                break
+            if similar(wei, data.iloc[window_begin], data.iloc[now]):
+                window_change = window_size - 1
+                window_size = now - window_begin + 1 + window_change
+                repetition_number.append(now)
+                data.loc[data.index[now], 'ISSIMILAR'] = 1
+            else:
+                counter += 1
+                if counter > threshold:
+                    window_change = window_size - counter - 1
+                    window_size = now - window_begin + 1 - window_change
+                    counter = 0
+                    break
+            compared += 1
+            now += 1
+    return data
+
+
+# 一条船的数据：从几个基准点出发，多数行只有很小的扰动（相似重复），也有完全相同的连续行（窗口不断扩大），
+# 以及缺失值、空字符串和 0
+def random_group(rng, n):
+    base = pd.DataFrame({
+        'BaseDateTime': ['2023-10-01T{:02d}:{:02d}:{:02d}'.format(*rng.integers(0, [24, 60, 60])) for _ in range(3)],
+        'LAT': 28 + rng.random(3), 'LON': -95 + rng.random(3), 'SOG': rng.random(3) * 10, 'COG': rng.random(3) * 360,
+        'Heading': rng.integers(0, 360, 3).astype(np.float64), 'VesselName': ['ALPHA', 'BRAVO ONE', ''],
+        'IMO': ['IMO9000001', 'IMO9000002', ''], 'CallSign': ['WDA1234', 'WDB5678', 'WDC'],
+        'VesselType': [70.0, 0.0, 30.0], 'Status': [0.0, 5.0, 15.0], 'Length': [100.0, 0.0, 50.0],
+        'Width': [20.0, 0.0, 10.0], 'Draft': [5.0, 0.0, 2.0], 'Cargo': [70.0, 0.0, 0.0],
+        'TransceiverClass': ['A', 'B', 'A']})
+    data = base.iloc[rng.integers(0, 3, n)].reset_index(drop=True)
+    if rng.random() < 0.5:
+        # 连续的相同行
+        start = int(rng.integers(0, n))
+        data.iloc[start:] = data.iloc[start]
+
+    jitter = rng.random(n) < 0.6
+    for column in ['LAT', 'LON', 'SOG', 'COG']:
+        data.loc[jitter, column] *= 1 + rng.normal(0, 0.01, jitter.sum())
+    for column, kind in SIMILAR_COLUMNS:
+        missing = rng.random(n) < 0.08
+        if kind == 'number':
+            data.loc[missing, column] = np.nan
+            data.loc[rng.random(n) < 0.05, column] = 0.0
+        else:
+            data[column] = data[column].astype(object)
+            data.loc[missing, column] = np.nan
+            if kind == 'string':
+                data.loc[rng.random(n) < 0.05, column] = ''
+    data.index = rng.permutation(np.arange(1000, 1000 + n))
+    return data
+
+
+def column_weights(data):
+    num_unique = data[[column for column, _ in SIMILAR_COLUMNS]].nunique()
+    return (num_unique / num_unique.sum()).values
+
+
+def test_dynamic_window_matches_reference(monkeypatch):
+    # 记录窗口超出预先计算的 band 后单独计算的次数
+    beyond_band = []
+    similar_pairs = gather.similar_pairs
+
+    def counting_similar_pairs(features, wei, rows, cols):
+        if np.ndim(rows) == 1:
+            beyond_band.append(len(rows))
+        return similar_pairs(features, wei, rows, cols)
+
+    monkeypatch.setattr(gather, 'similar_pairs', counting_similar_pairs)
+
+    rng = np.random.default_rng(0)
+    flagged = 0
+    for _ in range(60):
+        data = random_group(rng, int(rng.integers(1, 80)))
+        wei = column_weights(data)
+        for window, threshold in [(5, 5), (2, 1), (3, 0)]:
+            reference = reference_dynamic_window(data.assign(ISSIMILAR=0), wei, window, threshold)
+            result = dynamic_window(data, wei, window, threshold)
+            assert np.array_equal(result, reference['ISSIMILAR'].values == 1)
+            flagged += result.sum()
+
+    assert flagged > 0
+    assert len(beyond_band) > 0
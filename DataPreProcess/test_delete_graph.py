@@ -1,45 +1,50 @@
+import numpy as np
 import pandas as pd
 import os
 from constants import *
-from scipy.optimize import bracket
+from trips_store import POINT_COLUMNS, offsets_to_rows, take_trips, save_trips, load_trips, parse_list_strings
+import profiling
 
 
-def delete_test_graph(test, graph):
-    # 获取 src 列的唯一值
-    # unique_src = set(graph['src'])
-    # print(unique_src)
-
-    # src_counts = graph['src'].value_counts()
+# 测试集删除规则，轨迹中任一轨迹点满足即删除该轨迹：
+#   no_out_edge     所在网格不是训练集转移图中任何边的起点
+#   low_out_weight  所在网格的出边权重之和不大于 test_delte
+# grid、offsets 为扁平的轨迹点网格号和偏移数组，返回每条轨迹是否删除以及每条规则删除的轨迹数
+# （一条轨迹可能同时满足两条规则）
+def graph_delete_rules(grid, offsets, graph):
     src_counts = graph.groupby('src')['weight'].sum()
+    rules = {'no_out_edge': ~np.isin(grid, src_counts.index.values),
+             'low_out_weight': np.isin(grid, src_counts.index[src_counts <= test_delte].values)}
 
-    trips_sparse = test['trips_sparse'].values.tolist()
-    num_labels = test['num_labels'].values.tolist()
-
-    index = 0
+    rows = offsets_to_rows(offsets)
+    delete = np.zeros(len(offsets) - 1, dtype=bool)
+    removed = {}
+    for rule, outside in rules.items():
+        hit = np.bincount(rows[outside], minlength=len(offsets) - 1) > 0
+        removed[rule] = int(hit.sum())
+        delete |= hit
+    print('delete test trips:{} {}'.format(np.count_nonzero(delete), removed))
 
-    for trip, num_label in zip(trips_sparse, num_labels):
-        first_column = [row[0] for row in trip]
+    return delete, removed
 
-        count = 0
 
-        for loc in first_column:
-            # print('loc:{}'.format(loc))
+# csv 的测试集，trips_sparse 为 "[[grid, lon, lat, cog, sog, time], ...]" 字符串，原地删除，一次完成
+def delete_test_graph(test, graph):
+    points, offsets = parse_list_strings(test['trips_sparse'].tolist(), len(POINT_COLUMNS))
+    grid = points[:, POINT_COLUMNS.index('grid')].astype(np.int64)
 
-            # if num_label[count] == 0 or (int(loc) in src_counts and src_counts[int(loc)] > test_delte):
-            if int(loc) in src_counts and src_counts[int(loc)] > test_delte:
-                count = count + 1
-            else:
-                test.drop(index, inplace=True)
-                print('index:{} loc:{} count:{} num_labels[count]:{}\n'.format(index, loc, count, num_label[count]))
-                break
+    delete, removed = graph_delete_rules(grid, offsets, graph)
+    test.drop(test.index[delete], inplace=True)
+    test.reset_index(drop=True, inplace=True)
 
-            # count += 1
+    return removed
 
-        index += 1
 
-    test.reset_index(drop=True, inplace=True)
-    # print(test)
+# 列式轨迹的测试集删除，返回保留下来的轨迹
+def delete_test_graph_columnar(test, graph):
+    delete, _ = graph_delete_rules(test['trips_sparse.grid'], test['trips_sparse.offsets'], graph)
 
+    return take_trips(test, np.flatnonzero(~delete))
 
 
 def save_file(df, output_path, new_filename):
@@ -52,12 +57,20 @@ def test_delete_graph(data_format, data_name):
     data_path = os.path.join('../data', 'AIS', data_name)
     if data_format == 'csv':
         df_graph = pd.read_csv(os.path.join(data_path, 'graph_A.csv'))
-        df_test = pd.read_csv(os.path.join(data_path, 'traj_test111.csv'), converters={'trips_sparse': eval, 'num_labels': eval})
+        df_test = pd.read_csv(os.path.join(data_path, 'traj_test111.csv'))
+        profiling.rows(rows_in=df_test['trip_length'].sum())
         delete_test_graph(df_test, df_graph)
+        profiling.rows(rows_out=df_test['trip_length'].sum())
 
         save_file(df_test, data_path, 'traj_test.csv')
         print('finish')
 
+    elif data_format == 'npz':
+        df_graph = pd.read_csv(os.path.join(data_path, 'graph_A.csv'))
+        test = load_trips(os.path.join(data_path, 'traj_test111.npz'))
+        profiling.rows(rows_in=test['trip_length'].sum())
+        test = delete_test_graph_columnar(test, df_graph)
+        profiling.rows(rows_out=test['trip_length'].sum())
 
-
-
+        save_trips(os.path.join(data_path, 'traj_test.npz'), test)
+        print('finish')
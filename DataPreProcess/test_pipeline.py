@@ -0,0 +1,53 @@
+import os
+import shutil
+import constants
+import pipeline
+import trip_count
+from pipeline import run_pipeline, STAGES
+from synthetic_ais import write_synthetic_dataset
+
+
+# 增量流水线的跳过逻辑（合成数据集，npz 格式）：再次运行时全部跳过，
+# 修改参数或代码时只重新运行受影响的阶段，以及输入内容确实变化的后续阶段
+
+ALL_STAGES = [stage['name'] for stage in STAGES]
+
+
+def test_second_run_skips_everything(tmp_path, monkeypatch):
+    monkeypatch.chdir(write_synthetic_dataset(tmp_path))
+    assert run_pipeline('npz', 'X') == ALL_STAGES
+    assert run_pipeline('npz', 'X') == []
+    # 结果无关的选项不影响阶段的键
+    assert run_pipeline('npz', 'X', backend='polars') == []
+    assert run_pipeline('npz', 'X', force=True) == ALL_STAGES
+
+
+def test_trip_count_max_reruns_downstream(tmp_path, monkeypatch):
+    monkeypatch.chdir(write_synthetic_dataset(tmp_path))
+    run_pipeline('npz', 'X')
+
+    monkeypatch.setattr(constants, 'trip_count_max', 30)
+    monkeypatch.setattr(trip_count, 'trip_count_max', 30)
+    # 轨迹分段变化，之后的阶段输入都变了
+    assert run_pipeline('npz', 'X') == ALL_STAGES[1:]
+    assert run_pipeline('npz', 'X') == []
+
+
+def test_imported_module_edit(tmp_path, monkeypatch):
+    # 本目录模块的副本，修改副本不影响测试进程中已导入的模块
+    code_dir = tmp_path / 'code'
+    shutil.copytree(pipeline.CODE_DIR, code_dir, ignore=shutil.ignore_patterns('__pycache__', '.pytest_cache'))
+    monkeypatch.setattr(pipeline, 'CODE_DIR', str(code_dir))
+    monkeypatch.chdir(write_synthetic_dataset(tmp_path / 'data'))
+    run_pipeline('npz', 'X')
+
+    # 只有 meshing 导入 geo.py，meshing 的输出内容不变，之后的阶段跳过
+    with open(os.path.join(code_dir, 'geo.py'), 'a') as f:
+        f.write('\n# edited\n')
+    assert run_pipeline('npz', 'X') == ['meshing']
+
+    # 所有阶段都导入 trips_store.py
+    with open(os.path.join(code_dir, 'trips_store.py'), 'a') as f:
+        f.write('\n# edited\n')
+    assert run_pipeline('npz', 'X') == ALL_STAGES
+    assert run_pipeline('npz', 'X') == []
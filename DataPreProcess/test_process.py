@@ -1,22 +1,20 @@
-from meshing import *
-from trip_count import *
-from trip2trips import *
-from trips2new import *
-from trips_drop import *
-from trips_split import *
-from trips_graph import *
-from test_delete_graph import *
+from pipeline import run_pipeline
 
 data_name = 'AIS_2023_4month'
+# 中间结果格式: 'csv' 或列式轨迹 'npz'
+data_format = 'npz'
+# 读取 gather 输出的后端: 'pandas' 或 'polars'（需要安装 polars）
+backend = 'pandas'
+# 网格划分: 'fixed' 或自适应四叉树 'quadtree'
+mesh = 'fixed'
+# meshing 分块读取的点数，None 时整表读取
+chunk_size = None
+# 为 True 时不跳过任何阶段
+force = False
 
 print(data_name)
 
 
-meshing('csv', data_name)
-trip_count('csv', data_name)
-trip2trips('csv', data_name)
-trips2new('csv', data_name)
-trips_drop('csv', data_name)
-trips_split('csv', data_name)
-trips_graph('csv', data_name)
-test_delete_graph('csv', data_name)
\ No newline at end of file
+# meshing → trip_count → trip2trips → trips2new → trips_drop → trips_split → trips_graph → test_delete_graph
+# 参数（constants.py）、代码和输入都没有变化的阶段跳过
+run_pipeline(data_format, data_name, force=force, backend=backend, mesh=mesh, chunk_size=chunk_size)
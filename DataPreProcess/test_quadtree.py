@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import meshing
+from meshing import trip_grids, trip_grids_quadtree
+
+
+# 四叉树网格：划分和合并后每个网格的点数不超过 grid_point_max（最细一层的网格除外）、范围不超过 grid_side_max，
+# 不限点数时与固定网格相同，同一父网格下稀疏的兄弟网格合并后保留
+
+
+# 几个密集的船舶聚集区和稀疏的背景点（坐标为米）
+def clustered_points(seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(0, 6000, (5, 2))
+    points = [center + rng.normal(0, rng.uniform(20, 200), (int(rng.integers(500, 3000)), 2)) for center in centers]
+    points.append(rng.uniform(0, 6000, (1500, 2)))
+    points = np.vstack(points)
+    return pd.DataFrame({'LAT': points[:, 0], 'LON': points[:, 1]})
+
+
+# 每个点在最细一层（边长 grid_side）的网格索引
+def finest_indices(df):
+    lat = np.floor_divide(df['LAT'].values - df['LAT'].min(), meshing.grid_side).astype(np.int64)
+    lon = np.floor_divide(df['LON'].values - df['LON'].min(), meshing.grid_side).astype(np.int64)
+    return lat, lon
+
+
+def test_point_budget(monkeypatch):
+    monkeypatch.setattr(meshing, 'grid_point_max', 200)
+    df, grids_dict = trip_grids_quadtree(clustered_points())
+    lat, lon = finest_indices(df)
+    # 网格不超过 grid_side_max 的父网格
+    shift = int(np.log2(meshing.grid_side_max // meshing.grid_side))
+
+    assert (df['GRID'] >= 0).all()
+    for grid_id, index in df.groupby('GRID').indices.items():
+        if len(index) > meshing.grid_point_max:
+            # 只有最细一层的网格可以超过点数上限
+            assert len(np.unique(lat[index])) == 1 and len(np.unique(lon[index])) == 1
+        assert len(np.unique(lat[index] >> shift)) == 1 and len(np.unique(lon[index] >> shift)) == 1
+    # 网格的点数接近上限，网格数远少于固定网格
+    assert df['GRID'].value_counts().max() > meshing.grid_point_max // 2
+    assert 0 < len(grids_dict) < len(np.unique(lat * (lon.max() + 1) + lon))
+
+
+def test_unbounded_budget_is_fixed_partition(monkeypatch):
+    # 所有网格都划分到最细一层，也没有可以合并的网格
+    monkeypatch.setattr(meshing, 'grid_point_max', 0)
+    quadtree, quadtree_dict = trip_grids_quadtree(clustered_points())
+    fixed, fixed_dict = trip_grids(clustered_points())
+
+    # 划分相同（编号不同）
+    pairs = pd.DataFrame({'quadtree': quadtree['GRID'].values, 'fixed': fixed['GRID'].values}).drop_duplicates()
+    assert pairs['quadtree'].is_unique and pairs['fixed'].is_unique
+    assert np.array_equal(quadtree['GRID'].isin(quadtree_dict).values, fixed['GRID'].isin(fixed_dict).values)
+    assert sorted(quadtree_dict.values()) == sorted(fixed_dict.values())
+
+
+def test_sparse_siblings_merge(monkeypatch):
+    monkeypatch.setattr(meshing, 'grid_point_max', 200)
+    rng = np.random.default_rng(0)
+    # 边长 40 的父网格：左下 20x20 的子网格有 4 x 250 个点，继续划分到最细一层；
+    # 其余三个子网格各 20 个点（少于 grid_weight_min），合并为一个 60 个点的网格
+    dense = [rng.uniform(1, 9, (250, 2)) + [lat, lon] for lat in (0, 10) for lon in (0, 10)]
+    sparse = [rng.uniform(21, 39, (20, 2)) - [lat, lon] for lat, lon in ((0, 20), (20, 0), (0, 0))]
+    points = np.vstack([[[0.0, 0.0]]] + dense + sparse)
+    df, grids_dict = trip_grids_quadtree(pd.DataFrame({'LAT': points[:, 0], 'LON': points[:, 1]}))
+
+    dense_grids = df['GRID'].values[1:1001]
+    sparse_grids = df['GRID'].values[1001:]
+    assert len(np.unique(dense_grids)) == 4 and np.isin(dense_grids, list(grids_dict)).all()
+    assert len(np.unique(sparse_grids)) == 1 and sparse_grids[0] not in dense_grids
+    assert 60 >= meshing.grid_weight_min and sparse_grids[0] in grids_dict
+    # 中心为三个子网格中心（(30, 10)、(10, 30)、(30, 30)，按 (LAT, LON)）按点数的加权平均
+    center_lon, center_lat = grids_dict[sparse_grids[0]]
+    assert np.isclose(center_lat, 70 / 3) and np.isclose(center_lon, 70 / 3)
@@ -0,0 +1,57 @@
+import numpy as np
+from trips_drop import drop_ratio_01, tagging_num, tagging_labels, dataset_sparse_index
+from trips_store import lengths_to_offsets
+
+
+# trips_drop 的标签生成：固定种子的结果不变（测试集依赖它），以及每条轨迹的删除点数、最后一个点不删除
+
+
+# 与 trips_drop 相同的随机数顺序：先抽 tagging_num，再生成标签
+def drop_labels(trip_lengths, seed):
+    rng = np.random.default_rng(seed)
+    return tagging_labels(trip_lengths, drop_ratio_01(trip_lengths), tagging_num(trip_lengths, rng), rng)
+
+
+def check_labels(trip_lengths, tagging_nums, delete_nums, offsets, num_labels):
+    assert np.array_equal(np.diff(offsets), trip_lengths - delete_nums)
+    for i in range(len(trip_lengths)):
+        labels = num_labels[offsets[i]:offsets[i + 1]]
+        assert labels.sum() == delete_nums[i]
+        assert np.count_nonzero(labels) == tagging_nums[i]
+        # 最后一个保留点之后没有删除的点
+        assert labels[-1] == 0
+
+
+def test_seed_42_labels():
+    # trip_count 之后的轨迹不少于 trip_count_min = 20 个点
+    trip_lengths = np.array([20, 25, 33, 41, 30, 58])
+    tagging_nums, delete_nums, offsets, num_labels = drop_labels(trip_lengths, 42)
+
+    assert tagging_nums.tolist() == [2, 2, 3, 3, 1, 4]
+    assert delete_nums.tolist() == [2, 2, 3, 4, 3, 5]
+    check_labels(trip_lengths, tagging_nums, delete_nums, offsets, num_labels)
+
+    # 每条轨迹中非零标签的位置和删除点数
+    tagged = [{int(j): int(num_labels[offsets[i] + j]) for j in np.flatnonzero(num_labels[offsets[i]:offsets[i + 1]])}
+              for i in range(len(trip_lengths))]
+    assert tagged == [{11: 1, 14: 1},
+                      {9: 1, 15: 1},
+                      {14: 1, 19: 1, 26: 1},
+                      {12: 1, 26: 1, 28: 2},
+                      {13: 3},
+                      {6: 1, 9: 1, 20: 1, 32: 2}]
+
+
+def test_random_labels():
+    rng = np.random.default_rng(0)
+    for seed in range(20):
+        trip_lengths = rng.integers(20, 200, 50)
+        tagging_nums, delete_nums, offsets, num_labels = drop_labels(trip_lengths, seed)
+        check_labels(trip_lengths, tagging_nums, delete_nums, offsets, num_labels)
+
+        # 保留的点递增，每条轨迹的第一个和最后一个点都保留
+        trip_offsets = lengths_to_offsets(trip_lengths)
+        keep = dataset_sparse_index(trip_offsets, num_labels, offsets)
+        assert np.all(np.diff(keep) > 0)
+        assert np.array_equal(keep[offsets[:-1]], trip_offsets[:-1])
+        assert np.array_equal(keep[offsets[1:] - 1], trip_offsets[1:] - 1)
@@ -0,0 +1,68 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from trips_graph import create_graph_columnar, time_windows
+from trips_store import lengths_to_offsets
+from graph_store import read_adjacency, adjacency_matrix_path, edges_to_matrix
+from pipeline import run_pipeline
+from synthetic_ais import write_synthetic_dataset
+
+
+# 转移图：各时间窗口的边权之和等于总图 graph_A，graph_A.npz 与 graph_A.csv 读出的邻接矩阵相同
+
+
+# 逐条轨迹统计相邻两点的边，作为参照
+def reference_graph(grid, offsets):
+    weights = {}
+    for i in range(len(offsets) - 1):
+        trip = grid[offsets[i]:offsets[i + 1]]
+        for src, dst in zip(trip[:-1], trip[1:]):
+            weights[(src, dst)] = weights.get((src, dst), 0) + 1
+    return weights
+
+
+def window_sums(window_graph):
+    return window_graph.groupby(['src', 'dst'])['weight'].sum()
+
+
+def test_window_counts_sum_to_graph():
+    rng = np.random.default_rng(0)
+    offsets = lengths_to_offsets(rng.integers(1, 40, 200))
+    grid = rng.integers(0, 30, offsets[-1])
+    time = 1696118400 + np.cumsum(rng.integers(10, 160, offsets[-1]))
+
+    trips_graph, window_graph = create_graph_columnar(grid, offsets, time_windows(time, 3600))
+
+    weights = reference_graph(grid, offsets)
+    assert dict(zip(zip(trips_graph['src'], trips_graph['dst']), trips_graph['weight'])) == weights
+    assert window_graph['group'].nunique() > 1
+    assert window_sums(window_graph).to_dict() == weights
+
+
+@pytest.mark.parametrize('data_format', ['csv', 'npz'])
+def test_pipeline_window_graph_and_adjacency(tmp_path, monkeypatch, data_format):
+    monkeypatch.chdir(write_synthetic_dataset(tmp_path))
+    run_pipeline(data_format, 'X', time_window=3600)
+    data_path = os.path.join(str(tmp_path), 'data', 'AIS', 'X')
+    adj_path = os.path.join(data_path, 'graph_A.csv')
+
+    graph = pd.read_csv(adj_path)
+    with np.load(os.path.join(data_path, 'graph_A_window3600.npz')) as f:
+        window_graph = pd.DataFrame({column: f[column] for column in f.files})
+    assert len(graph) > 0 and window_graph['group'].nunique() > 1
+    assert window_sums(window_graph).to_dict() == graph.set_index(['src', 'dst'])['weight'].to_dict()
+    # 窗口起点间隔 time_window
+    assert (window_graph['start'] - window_graph['group'] * 3600).nunique() == 1
+
+    n_vertex = int(max(graph['src'].max(), graph['dst'].max())) + 1 + 4
+    from_npz = read_adjacency(adj_path, n_vertex, 4)
+    # npz 比 csv 旧时读取 csv
+    matrix_path = adjacency_matrix_path(adj_path)
+    os.utime(matrix_path, ns=(os.stat(adj_path).st_mtime_ns - 10 ** 9,) * 2)
+    assert os.path.getmtime(matrix_path) < os.path.getmtime(adj_path)
+    from_csv = read_adjacency(adj_path, n_vertex, 4)
+
+    expected = edges_to_matrix(graph['src'].values, graph['dst'].values, graph['weight'].values, n_vertex, 4)
+    assert from_npz.shape == from_csv.shape == (n_vertex, n_vertex)
+    assert (from_npz != from_csv).nnz == 0 and (from_csv != expected).nnz == 0
@@ -1,6 +1,9 @@
 import numpy as np
 import pandas as pd
 import os
+from trips_store import trips_from_points, table_length, save_trips, load_points
+import profiling
+from backend import check_backend, join_groups
 
 
 def trip_to_trips(df):
@@ -48,19 +51,43 @@ def save_file(df, output_path, new_filename):
     output_path = os.path.join(output_path, new_filename)
     df.to_csv(output_path, index=False)
 
-def trip2trips(data_format, data_name):
+# backend 为 'pandas' 或 'polars'，只影响 csv 格式中把轨迹点拼成字符串的分组计算，结果相同
+def trip2trips(data_format, data_name, backend='pandas'):
+    check_backend(backend)
     data_path = os.path.join('../data', 'AIS', data_name)
     if data_format == 'csv':
         df = pd.read_csv(os.path.join(data_path, 'delete_count_'+ data_name +'.csv'))
         print('trip2trips read finish')
+        profiling.rows(rows_in=len(df))
 
         # 只保留部分
         df = df[['MMSI', 'BaseDateTime', 'LAT', 'LON', 'COG', 'SOG', 'COUNT', 'GRID']]
 
-        trips_df = trip_to_trips(df)
+        if backend == 'polars':
+            df = df.astype({'GRID': np.int64, 'BaseDateTime': np.int64})
+            trips_df = join_groups(df, 'COUNT', ['GRID', 'LON', 'LAT', 'COG', 'SOG', 'BaseDateTime'])
+        else:
+            trips_df = trip_to_trips(df)
         # print(trips_df.head())
 
         save_file(trips_df, data_path, 'trips_cleaned_'+ data_name +'.csv')
+        profiling.rows(rows_out=trips_df['trip_length'].sum())
+
+        print('trips finish')
+
+        print('finish')
+
+    elif data_format == 'npz':
+        df = load_points(os.path.join(data_path, 'delete_count_'+ data_name +'.npz'))
+        print('trip2trips read finish')
+        profiling.rows(rows_in=len(df))
+
+        # 每个 COUNT 一条轨迹，轨迹点按列保存
+        trips = trips_from_points(df, key='COUNT', group='trips')
+        print("len(trips):{}".format(table_length(trips)))
+
+        save_trips(os.path.join(data_path, 'trips_cleaned_'+ data_name +'.npz'), trips)
+        profiling.rows(rows_out=trips['trips.offsets'][-1])
 
         print('trips finish')
 
@@ -1,92 +1,89 @@
+import numpy as np
 import pandas as pd
 import os
-from pyproj import Transformer
 from constants import *
+from trips_store import save_points, load_points
+import profiling
+from backend import group_size_at_least
 from geopy.distance import geodesic, distance
 import math
 
 
+# 按 MMSI 分组（分组按 MMSI 排序，组内保持原顺序）给每个轨迹点编号 COUNT，编号相同的点为一条轨迹
+# 组内除第一个点外，与上一个点的时间间隔 >= time_max 或 <= time_min，或当前轨迹已有 trip_count_max 个点时开始新的轨迹；
+# 每个 MMSI 结束后编号加一。点数计数只在开始新轨迹时清零，每个 MMSI 的第一个点不计入
+# 用数组一次计算：
+#   间隔断点由组内时间差得到
+#   点数断点：在所有非首点组成的序列中，从上一个间隔断点（或序列开头）起每 trip_count_max 个点断开一次
+#   COUNT = 到当前点为止的断点数 + 之前的 MMSI 数
 def trip(df):
-    # 初始化一个变量用于存储递增的 count
-    point_count = 0
-    count = 0
-
     print("len(df):{}".format(len(df)))
-    progress= 0
-
-    # 用于存储所有的 count 结果
-    count_results = []
-
-    # 对每个 mmsi 分组
-    for mmsi, group in df.groupby('MMSI'):
-        # 初始化一个变量用于存储上一个 BaseDateTime
-        last_base_date_time = None
-        # print(df.head())
-
-        for index, point in group.iterrows():
-            # 获取当前组的第一个 BaseDateTime
-            base_date_time = point['BaseDateTime']
-
-            if progress % 50000 == 0:
-                print("{} / {}".format(progress, len(df)))
-            progress = progress + 1
-
-            # 如果这是第一次遇到这个 mmsi，或者 BaseDateTime 大于 200，重置 incremental_count
-            if last_base_date_time is None :
-                last_base_date_time = base_date_time
-                # df.at[index, 'COUNT'] = count
-                count_results.append((index, count))
-                continue
 
-            if (base_date_time - last_base_date_time) >= time_max or (base_date_time - last_base_date_time) <= time_min or point_count >= trip_count_max :
-                count += 1
-                point_count = 0
+    mmsi = df['MMSI'].values
+    order = np.argsort(mmsi, kind='stable')
+    mmsi = mmsi[order]
+    times = df['BaseDateTime'].values[order]
 
-            # 更新 'COUNT' 列
-            # df.at[index, 'COUNT'] = count
+    first = np.ones(len(df), dtype=bool)
+    first[1:] = mmsi[1:] != mmsi[:-1]
+    gaps = np.zeros(len(df))
+    gaps[1:] = times[1:] - times[:-1]
+    gap_break = ~first & ((gaps >= time_max) | (gaps <= time_min))
 
-            # 存储 'COUNT' 值
-            count_results.append((index, count))
+    inner = np.flatnonzero(~first)
+    position = np.arange(len(inner))
+    segment_start = np.maximum.accumulate(np.where(gap_break[inner], position, 0)) if len(inner) > 0 else position
+    offset = position - segment_start
+    count_break = (offset > 0) & (offset % trip_count_max == 0)
 
-            point_count += 1
+    breaks = np.zeros(len(df), dtype=np.int64)
+    breaks[inner] = gap_break[inner] | count_break
 
-            last_base_date_time = base_date_time
+    count = np.empty(len(df), dtype=np.int64)
+    count[order] = np.cumsum(breaks) + np.cumsum(first) - 1
 
-        count += 1
-
-    # 将结果一次性写入 DataFrame
-    df.loc[[idx for idx, _ in count_results], 'COUNT'] = [cnt for _, cnt in count_results]
+    df['COUNT'] = count
     return df
 
 
 def save_file(df, output_path, new_filename):
     # 保存处理后的数据集
     output_path = os.path.join(output_path, new_filename)
-    df.to_csv(output_path, index=True)
+    if new_filename.endswith('.npz'):
+        save_points(output_path, df)
+    else:
+        df.to_csv(output_path, index=True)
 
 
-def trip_count(data_format, data_name):
+# backend 为 'pandas' 或 'polars'，只影响按轨迹点数过滤的分组计算，结果相同
+def trip_count(data_format, data_name, backend='pandas'):
     data_path = os.path.join('../data', 'AIS', data_name)
     if data_format == 'csv':
         df = pd.read_csv(os.path.join(data_path, 'grid_delete_cleaned_'+ data_name +'.csv'))
-        print('trip_count read finish')
-
-        # 只保留部分
-        df = df[['MMSI', 'BaseDateTime', 'LAT', 'LON', 'COG', 'SOG', 'GRID']]
-
-        df['COUNT'] = -1
-        # trip(df)
-        df = trip(df)
-        save_file(df, data_path, 'count_'+ data_name +'.csv')
-        print('trip count finish')
-
-        df = df.groupby('COUNT').filter(lambda x: x['COUNT'].count() >= trip_count_min)
-        save_file(df, data_path, 'delete_count_'+ data_name +'.csv')
-        print('delete trip count min finish')
-
-        print('finish')
-
-        # 显示 DataFrame 的前几行以确认数据是否正确加载
-        # print(df.head())
+    elif data_format == 'npz':
+        df = load_points(os.path.join(data_path, 'grid_delete_cleaned_'+ data_name +'.npz'))
+    else:
+        raise ValueError(f'ERROR: {data_format} is unknown.')
+    print('trip_count read finish')
+    profiling.rows(rows_in=len(df))
+
+    # 只保留部分
+    df = df[['MMSI', 'BaseDateTime', 'LAT', 'LON', 'COG', 'SOG', 'GRID']]
+
+    df['COUNT'] = -1
+    # trip(df)
+    df = trip(df)
+    save_file(df, data_path, 'count_'+ data_name +'.' + data_format)
+    print('trip count finish')
+
+    df = df[group_size_at_least(df['COUNT'].values, trip_count_min, backend)]
+    save_file(df, data_path, 'delete_count_'+ data_name +'.' + data_format)
+    profiling.rows(rows_out=len(df))
+    print('delete trip count min finish')
+
+    print('finish')
+
+    # 显示 DataFrame 的前几行以确认数据是否正确加载
+    # print(df.head())
 
 # trip_count('csv', 'AIS_z')
@@ -1,91 +1,68 @@
-from collections import Counter
 import numpy as np
 import pandas as pd
 import os
 import pickle
 from constants import *
+from trips_store import POINT_COLUMNS, strings_to_trips, table_length, save_trips, load_trips
+import profiling
 
 
+# 字符串形式的轨迹："grid,lon,lat,cog,sog,time;..."
+# 整列解析为列式轨迹，与 npz 格式相同地重新编号网格号，再一次格式化为
+# "new_grid,lon,lat, cog, sog, time"，浮点数按最短的往返表示输出，与原字符串相同
 def trips_to_new(trips, grids_AIS_EAST):
-    # 将每个部分转换为列表
-    trips_new_list = []
-
-    # trips_new = pd.DataFrame(columns=['trips_new'])
-
-    # 创建一个空字典用于存储数据和对应的自然数
-    center = {}
-    # 创建一个空字典用于存储新pickle
-    grids2center = {}
-    # 创建一个计数器，用于生成连续的自然数
-    counter = 0
-
     print(f"trip length{len(trips)}")
-    i = 0
-
-    for trip in trips:
-        if i % 10000 == 0:
-            print("{}/{}".format(i, len(trips)))
-        i += 1
-
-        trip_new = []
-        # 按照逗号分割每一部分，并转换为相应的数据类型
-        trip_point = trip.split(';')
-
-        # 提取第一列
-        first_column = [part.split(',')[0] for part in trip_point]
-
-
-        # if len(set(first_column)) < trip_grid_set_min * len(first_column):
-        #     trips_new_list.append('0')
-        #     continue
 
+    trips_new, grids2center = table_to_new(strings_to_trips(trips.tolist(), 'trips'), grids_AIS_EAST)
 
-        # if Counter(first_column).most_common(1)[0][1] >= trip_grid_max * len(first_column):
-        #     trips_new_list.append('0')
-        #     continue
+    return pd.Series(format_trips_new(trips_new), name='trips_new'), grids2center
 
 
-        # 是否跳过字典转换
-        # skip = 0
-        # skip = any(int(number) not in grids_AIS_EAST for number in first_column)
+# 'trips' 组的网格号重新编号后作为 'trips_new' 组，其余列不变
+def table_to_new(trips, grids_AIS_EAST):
+    trips_new = {key.replace('trips.', 'trips_new.', 1): value for key, value in trips.items()}
+    trips_new['trips_new.grid'], grids2center = grids_to_new(trips['trips.grid'], grids_AIS_EAST)
+    return trips_new, grids2center
 
-        for loc in trip_point:
-            idx, lon, lat, cog, sog, time = loc.split(',')
 
-            # print(idx)
+# 'trips_new' 组格式化为轨迹字符串，每条轨迹一个
+def format_trips_new(trips_new):
+    columns = [trips_new['trips_new.' + column].tolist() for column in POINT_COLUMNS]
+    points = [f"{grid},{lon},{lat}, {cog}, {sog}, {time}" for grid, lon, lat, cog, sog, time in zip(*columns)]
+    offsets = trips_new['trips_new.offsets'].tolist()
+    return [';'.join(points[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
 
-            # if skip == 1:
-            #     # 添加到结果DataFrame
-            #     trip_new = '0'
-            #     break
 
-            if idx not in center:
-                center[idx] = counter
-                new_idx = counter
-                grids2center[counter] = grids_AIS_EAST[int(idx)]
-                counter += 1
+# 列式轨迹的网格号重新编号，编号按网格首次出现的顺序，与原来逐点查字典的结果相同
+# 网格号范围不大时（网格编号为 行 * 列数 + 列，一般如此）用 网格号 -> 下标 的稠密查找表，否则用 np.unique，
+# 再按首次出现的位置得到 下标 -> 新编号，一次完成转换；grids2center 只对每个网格查一次
+def grids_to_new(grid, grids_AIS_EAST):
+    grid = np.asarray(grid, dtype=np.int64)
+    if len(grid) == 0:
+        return grid, {}
 
-            else:
-                new_idx = center[idx]
+    codes = grid - grid.min()
+    if codes.max() < 4 * len(grid):
+        seen = np.zeros(codes.max() + 1, dtype=bool)
+        seen[codes] = True
+        uniques = np.flatnonzero(seen)
+        dense = np.empty(len(seen), dtype=np.int64)
+        dense[uniques] = np.arange(len(uniques))
+        inverse = dense[codes]
+    else:
+        uniques, inverse = np.unique(codes, return_inverse=True)
+        inverse = inverse.reshape(-1)
 
-            str_data = f"{new_idx},{lon},{lat}, {cog}, {sog}, {time}"
+    # 每个网格首次出现的位置决定新编号
+    first = np.full(len(uniques), len(grid), dtype=np.int64)
+    np.minimum.at(first, inverse, np.arange(len(grid)))
+    order = np.argsort(first)
+    lookup = np.empty(len(uniques), dtype=np.int64)
+    lookup[order] = np.arange(len(uniques))
 
-            # 将每组数据合并，并用分号分隔
-            trip_new.append(str_data)
-
-        # 合并每组数据，并用分号分隔
-        combined_str = ';'.join(trip_new)
-
-        trips_new_list.append(combined_str)
-
-        # 添加到结果DataFrame
-        # trips_new = pd.concat([trips_new, pd.DataFrame({'trips_new': [combined_str]})], ignore_index=True)
-
-    # 将结果列表转换为 DataFrame
-    trips_new_df = pd.DataFrame({'trips_new': trips_new_list})
-
-    return trips_new_df['trips_new'], grids2center
+    grids2center = {new_idx: grids_AIS_EAST[idx] for new_idx, idx in enumerate((uniques[order] + grid.min()).tolist())}
 
+    return lookup[inverse], grids2center
 
 
 def save_file(df, output_path, new_filename):
@@ -98,6 +75,7 @@ def trips2new(data_format, data_name):
     if data_format == 'csv':
         df = pd.read_csv(os.path.join(data_path, 'trips_cleaned_'+ data_name +'.csv'))
         print('trips2new read finish')
+        profiling.rows(rows_in=df['trip_length'].sum())
 
         # 读取
         grids_AIS_EAST = pickle.load(open(os.path.join(data_path, 'grids_'+ data_name +'.pickle'), 'rb'))
@@ -116,6 +94,33 @@ def trips2new(data_format, data_name):
         print('create new dict finish')
 
         save_file(df, data_path, 'trips_new_cleaned_'+ data_name +'.csv')
+        profiling.rows(rows_out=df['trip_length'].sum())
+
+        print('trips new finish')
+
+        print('finish')
+
+    elif data_format == 'npz':
+        trips = load_trips(os.path.join(data_path, 'trips_cleaned_'+ data_name +'.npz'))
+        print('trips2new read finish')
+        profiling.rows(rows_in=trips['trips.offsets'][-1])
+
+        # 读取
+        grids_AIS_EAST = pickle.load(open(os.path.join(data_path, 'grids_'+ data_name +'.pickle'), 'rb'))
+
+        # 'trips' 组的网格号重新编号后作为 'trips_new' 组
+        trips_new, grids2cneter = table_to_new(trips, grids_AIS_EAST)
+
+        print("len(grids2cneter):{}".format(len(grids2cneter)))
+
+        # 保存到pickle文件
+        pickle.dump(grids2cneter, open(os.path.join(data_path, 'grid2center_'+ data_name +'.pickle'), 'wb'))
+        open(os.path.join(data_path, 'grid2center_'+ data_name +'.txt'), 'w').write(f"{grids2cneter}\n")
+        print("len(trips):{}".format(table_length(trips_new)))
+        print('create new dict finish')
+
+        save_trips(os.path.join(data_path, 'trips_new_cleaned_'+ data_name +'.npz'), trips_new)
+        profiling.rows(rows_out=trips_new['trips_new.offsets'][-1])
 
         print('trips new finish')
 
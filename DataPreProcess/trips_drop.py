@@ -1,7 +1,9 @@
 import pandas as pd
 import numpy as np
 import os
-import random
+from trips_store import POINT_COLUMNS, POINT_DTYPES, lengths_to_offsets, offsets_to_rows, parse_trip_strings, trips_to_records, \
+    ragged_to_lists, save_trips, load_trips
+import profiling
 
 
 # 添加一个新的列 固定删除点的比率为0.1
@@ -14,135 +16,100 @@ def drop_ratio_02(df):
 
 
 # 添加一个新的列 删除点的比率
-def drop_ratio(df):
+def drop_ratio(df, rng):
     choices = [0.2, 0.3, 0.4, 0.5, 0.6]
     probabilities = [1 / len(choices)] * len(choices)  # 每个选项被选中的概率相等
 
-    return np.random.choice(choices, size=len(df), p=probabilities)
+    return rng.choice(choices, size=len(df), p=probabilities)
 
 
 # 添加一个新的列 删除点的段数
-def tagging_num(df):
+def tagging_num(df, rng):
     choices = [1, 2, 3, 4]
     probabilities = [1 / len(choices)] * len(choices)  # 每个选项被选中的概率相等
 
-    return np.random.choice(choices, size=len(df), p=probabilities)
+    return rng.choice(choices, size=len(df), p=probabilities)
 
 
 # 确定删除点的个数
 def delete_num_exact_division(tagging_num, delete_num):
-    # 查找不大于delete_num，且能被tagging_num或tagging_num+1整除的最大的数
-    for i in range(delete_num, 0, -1):
-        if i % tagging_num == 0 or i % (tagging_num + 1) == 0:
-            return i
+    # 不大于delete_num，且能被tagging_num或tagging_num+1整除的最大的数
+    return np.maximum(delete_num // tagging_num * tagging_num, delete_num // (tagging_num + 1) * (tagging_num + 1))
+
+
+# 每条轨迹在 [0, rest_num - 1) 中不重复地随机选 tagging_num 个位置（Floyd 抽样）：
+# 第 k 步在 [0, n - tagging_num + k] 中抽一个数，已经选过时改选 n - tagging_num + k，
+# tagging_num 很小，按步数循环，每一步所有轨迹一起抽
+# 返回选中位置所属的轨迹和轨迹内的位置，按轨迹排列，每条轨迹 tagging_num 个
+def sample_positions(rest_nums, tagging_nums, rng):
+    candidates = rest_nums - 1
+    chosen = np.full((len(tagging_nums), max(tagging_nums.max(initial=0), 1)), -1, dtype=np.int64)
+    for k in range(chosen.shape[1]):
+        active = np.flatnonzero(k < tagging_nums)
+        upper = candidates[active] - tagging_nums[active] + k
+        position = rng.integers(0, upper + 1)
+        repeated = (chosen[active] == position[:, None]).any(axis=1)
+        chosen[active, k] = np.where(repeated, upper, position)
+
+    rows, steps = np.nonzero(chosen >= 0)
+    return rows, chosen[rows, steps]
+
+
+# 生成所有轨迹的 num_labels：保留下来的每个点之后删除的点数
+# 每条轨迹删除 delete_num 个点，分为 tagging_num 段（放在随机选出的 tagging_num 个保留点之后），
+# 每段 delete_num / 分母 个，分母为 tagging_num 或 tagging_num + 1，为 tagging_num + 1 时随机一段多分配一份
+# 随机数全部来自 rng，依次抽取删除位置、分母（两者都能整除时）、多分配的段，同一个种子得到相同的结果
+# 返回 tagging_nums（删除点数不多于段数时改为删除点数）、delete_nums 以及列式的 num_labels（偏移数组、值）
+def tagging_labels(trip_lengths, drop_ratios, tagging_nums, rng):
+    trip_lengths = np.asarray(trip_lengths, dtype=np.int64)
+    delete_nums = (trip_lengths * np.asarray(drop_ratios)).astype(np.int64)
+    tagging_nums = np.minimum(np.asarray(tagging_nums, dtype=np.int64), delete_nums)
+
+    delete_nums = delete_num_exact_division(tagging_nums, delete_nums)
+    rest_nums = trip_lengths - delete_nums
+    rows, positions = sample_positions(rest_nums, tagging_nums, rng)
 
+    # 确定删除点在各段的分配方式
+    divisible = delete_nums % tagging_nums == 0
+    delete_denominators = np.where(divisible, tagging_nums, tagging_nums + 1)
+    both = divisible & (delete_nums % (tagging_nums + 1) == 0)
+    delete_denominators[both] += rng.integers(0, 2, size=both.sum())
+    every_deletes = delete_nums // delete_denominators
 
-# 设置tagging_labels列中的删除位置
-def set_values_to_one(tagging_label, random_numbers):
-    # 遍历随机下标列表
-    for index in random_numbers:
-        # 将对应位置的值设置为 1
-        tagging_label[index] = 1
+    num_labels_offsets = lengths_to_offsets(rest_nums)
+    num_labels = np.zeros(num_labels_offsets[-1], dtype=np.int64)
+    num_labels[num_labels_offsets[:-1][rows] + positions] = every_deletes[rows]
 
-    return tagging_label
+    # 从每条轨迹的删除位置中随机选择一个，多分配一份
+    extra = np.flatnonzero(delete_denominators == tagging_nums + 1)
+    selected = lengths_to_offsets(tagging_nums)[extra] + rng.integers(0, tagging_nums[extra])
+    num_labels[num_labels_offsets[:-1][extra] + positions[selected]] += every_deletes[extra]
 
+    return tagging_nums, delete_nums, num_labels_offsets, num_labels
 
-# 设置num_labels列中的删除位置
-def set_values_to_delete(delete_num, tagging_num, num_label, random_numbers):
-    # 确定删除点在各段的分配方式
-    if delete_num % tagging_num == 0 and delete_num % (tagging_num + 1) == 0:
-        choices = [tagging_num, tagging_num + 1]
-        probabilities = [1 / len(choices)] * len(choices)  # 每个选项被选中的概率相等
-        delete_denominator = np.random.choice(choices, p=probabilities)
-    elif delete_num % tagging_num == 0:
-        delete_denominator = tagging_num
-    else:
-        delete_denominator = tagging_num + 1
-
-    # 每份分配删点数量
-    every_delete = int(delete_num / delete_denominator)
-
-    # print(random_numbers)
-    # print(delete_num)
-    # print(delete_denominator)
-    # print(every_delete)
-    # print(num_label)
-
-    # 遍历随机下标列表
-    for index in random_numbers:
-        # 将对应位置的值设置为 1
-        num_label[index] = every_delete
-
-    if delete_denominator == tagging_num + 1:
-        # 从 random_numbers 中随机选择一个数字
-        selected_number = random.choice(random_numbers)
-        num_label[selected_number] += every_delete
-
-    return num_label
-
-
-# 生成tagging_labels列
-def tagging_labels(df):
-    tagging_labels = []
-    delete_nums = []
-    num_labels = []
-    for index, trip in df.iterrows():
-        trip_length = trip['trip_length']
-        drop_ratio = trip['drop_ratio']
-        tagging_num = trip['tagging_num']
-        delete_num = int(trip_length * drop_ratio)
-        # print(trip_length, drop_ratio, tagging_num, delete_num)
-        # print(delete_num)
-
-        if delete_num <= tagging_num:
-            df.at[index, 'tagging_num'] = delete_num
-            tagging_num = delete_num
-
-        delete_num = delete_num_exact_division(tagging_num, delete_num)
-
-        delete_nums.append(delete_num)
-
-        # 生成单个列表
-        rest_num = trip_length - delete_num
-        tagging_label = [0] * rest_num
-
-        random_numbers = random.sample(range(0, rest_num - 1), tagging_num)
-        tagging_label = set_values_to_one(tagging_label, random_numbers)
-        tagging_labels.append(tagging_label)
-
-        num_label = set_values_to_delete(delete_num, tagging_num, tagging_label, random_numbers)
-        num_labels.append(num_label)
-    # print(tagging_labels)
-
-    return delete_nums, tagging_labels, num_labels
-
-
-def dataset_sparse(trips, num_labels):
-    # 将每个部分转换为列表
-    trips_sparse = []
-    for trip, num_label in zip(trips, num_labels):
-        trip_sparse = []
-        # 按照逗号分割每一部分，并转换为相应的数据类型
-        trip_point = trip.split(';')
-        num_label_pos = 0
-        skip_counter = 0
-        for loc in trip_point:
-            if skip_counter > 0:
-                skip_counter -= 1
-                continue
-            # print(trips)
-            # print("trips{}".format(len(trip)))
-            # print("num_label_pos:{} num_label:{}".format(num_label_pos, num_label))
-            if num_label[num_label_pos] != 0:
-                # loc跳过num_label_point个
-                skip_counter = num_label[num_label_pos]
-
-            num_label_pos += 1
-
-            idx, lon, lat, cog, sog, time = loc.split(',')
-            trip_sparse.append([int(idx), float(lon), float(lat), float(cog), float(sog), int(time)])
-        trips_sparse.append(trip_sparse)
-    return trips_sparse
+
+# csv 中的轨迹字符串一次解析为列，按 num_labels 选出保留的点，
+# 返回 [[grid, lon, lat, cog, sog, time], ...] 形式的轨迹列表
+def dataset_sparse(trips, num_labels_offsets, num_labels):
+    points, offsets = parse_trip_strings(trips)
+
+    keep = dataset_sparse_index(offsets, num_labels, num_labels_offsets)
+    table = {'trips_sparse.offsets': num_labels_offsets}
+    for i, (column, dtype) in enumerate(zip(POINT_COLUMNS, POINT_DTYPES)):
+        table['trips_sparse.' + column] = points[keep, i].astype(dtype)
+
+    return [[list(point) for point in trip] for trip in trips_to_records(table, 'trips_sparse')]
+
+
+# 列式轨迹中保留下来的轨迹点下标
+# 第 k 个保留点在轨迹内的位置为 k 加上它之前所有 num_label 之和
+def dataset_sparse_index(offsets, num_labels, num_labels_offsets):
+    rows = offsets_to_rows(num_labels_offsets)
+    skipped = np.concatenate([[0], np.cumsum(num_labels)])
+    skipped = skipped[:-1] - skipped[num_labels_offsets[:-1]][rows]
+    local = np.arange(len(num_labels)) - num_labels_offsets[:-1][rows]
+
+    return offsets[:-1][rows] + local + skipped
 
 
 def delete_grid_trip_new(df):
@@ -158,11 +125,14 @@ def save_file(df, output_path, new_filename):
     df.to_csv(output_path, index=False)
 
 
-def trips_drop(data_format, data_name):
+# seed 固定标签生成的随机数，同一个 seed 得到相同的删除点，从而得到相同的测试集
+def trips_drop(data_format, data_name, seed=42):
     data_path = os.path.join('../data', 'AIS', data_name)
+    rng = np.random.default_rng(seed)
     if data_format == 'csv':
         df = pd.read_csv(os.path.join(data_path, 'trips_new_cleaned_'+ data_name +'.csv'))
         print('trips_drop read finish')
+        profiling.rows(rows_in=df['trip_length'].sum())
 
         # 删除trip_new中网格不存在的轨迹
         df = delete_grid_trip_new(df)
@@ -171,16 +141,48 @@ def trips_drop(data_format, data_name):
         df['drop_ratio'] = drop_ratio_01(df)
         print('trips drop ratio finish')
 
-        df['tagging_num'] = tagging_num(df)
+        df['tagging_num'] = tagging_num(df, rng)
         print('trips num_labels finish')
 
-        df['delete_nums'], df['tagging_labels'], df['num_labels'] = tagging_labels(df)
+        df['tagging_num'], df['delete_nums'], num_labels_offsets, num_labels = tagging_labels(
+            df['trip_length'].values, df['drop_ratio'].values, df['tagging_num'].values, rng)
+        # tagging_labels 与 num_labels 相同
+        df['tagging_labels'] = df['num_labels'] = ragged_to_lists(
+            {'num_labels.offsets': num_labels_offsets, 'num_labels.values': num_labels}, 'num_labels')
         print('trips tagging labels finish')
 
-        df['trips_sparse'] = dataset_sparse(df['trips_new'], df['num_labels'])
+        df['trips_sparse'] = dataset_sparse(df['trips_new'], num_labels_offsets, num_labels)
         print('trips sparse labels finish')
 
         save_file(df, data_path, 'trips_drop_cleaned_'+ data_name +'.csv')
+        # 输出行数为保留下来的稀疏轨迹点数
+        profiling.rows(rows_out=num_labels_offsets[-1])
+        print('finish')
+
+    elif data_format == 'npz':
+        trips = load_trips(os.path.join(data_path, 'trips_new_cleaned_'+ data_name +'.npz'))
+        print('trips_drop read finish')
+        profiling.rows(rows_in=trips['trips_new.offsets'][-1])
+
+        trips['drop_ratio'] = drop_ratio_01(trips['trip_length'])
+        print('trips drop ratio finish')
+
+        trips['tagging_num'] = tagging_num(trips['trip_length'], rng)
+        print('trips num_labels finish')
+
+        # tagging_labels 与 num_labels 相同，只保存 num_labels
+        trips['tagging_num'], trips['delete_nums'], trips['num_labels.offsets'], trips['num_labels.values'] = tagging_labels(
+            trips['trip_length'], trips['drop_ratio'], trips['tagging_num'], rng)
+        print('trips tagging labels finish')
+
+        keep = dataset_sparse_index(trips['trips_new.offsets'], trips['num_labels.values'], trips['num_labels.offsets'])
+        trips['trips_sparse.offsets'] = trips['num_labels.offsets']
+        for column in POINT_COLUMNS:
+            trips['trips_sparse.' + column] = trips['trips_new.' + column][keep]
+        print('trips sparse labels finish')
+
+        save_trips(os.path.join(data_path, 'trips_drop_cleaned_'+ data_name +'.npz'), trips)
+        profiling.rows(rows_out=trips['trips_sparse.offsets'][-1])
         print('finish')
 
 # trips_drop('csv', 'AIS_z')
@@ -1,53 +1,55 @@
 import numpy as np
 import pandas as pd
 import os
+import scipy.sparse as sp
+from trips_store import POINT_COLUMNS, load_trips, parse_trip_grids, parse_trip_strings
+from graph_store import edges_to_matrix, adjacency_matrix_path
+import profiling
 
 
-def create_graph(trips):
-    # 创建新的DataFrame用于存储结果
-    trips_graph = pd.DataFrame(columns=['src', 'dst', 'weight'])
+# 转移图：相邻两个轨迹点构成一条边 (src, dst)，不跨越轨迹边界
+# 每条边编码为 src * n + dst（n 为网格数），np.unique 一次统计所有边的次数，结果按 (src, dst) 排序
+# groups 为每个轨迹点的分组（如时间窗口），按边起点所在的分组分别统计，编码为 (group * n + src) * n + dst，
+# 与总图共用同一组边编码
 
-    # 创建一个字典来统计每一对 (src, dst) 的出现次数
-    counts = {}
 
-    i = 0
-    print(len(trips))
+# 轨迹内相邻两点的边编码
+def edge_codes(grid, offsets, n):
+    inside = np.ones(max(len(grid) - 1, 0), dtype=bool)
+    inside[offsets[1:-1] - 1] = False
+    index = np.flatnonzero(inside)
+
+    return grid[index] * n + grid[index + 1], index
+
 
-    for trip in trips:
-        if i % 5000 == 0:
-            print("{}/{}".format(i, len(trips)))
-        i += 1
-        src = -1
-        dst = -1
-        # 按照逗号分割每一部分，并转换为相应的数据类型
-        trip_point = trip.split(';')
-        for loc in trip_point:
-            idx, lon, lat, cog, sog, time = loc.split(',')
+def create_graph_columnar(grid, offsets, groups=None):
+    grid = np.asarray(grid, dtype=np.int64)
+    n = int(grid.max()) + 1 if len(grid) else 0
+    codes, index = edge_codes(grid, offsets, n)
 
-            if src == -1:
-                src = int(idx)
-                continue
+    codes_unique, weights = np.unique(codes, return_counts=True)
+    trips_graph = pd.DataFrame({'src': codes_unique // n, 'dst': codes_unique % n, 'weight': weights})
+    if groups is None:
+        return trips_graph
 
-            dst = int(idx)
+    group_codes, group_weights = np.unique(np.asarray(groups, dtype=np.int64)[index] * n * n + codes, return_counts=True)
+    group_graph = pd.DataFrame({'group': group_codes // (n * n), 'src': group_codes % (n * n) // n,
+                                'dst': group_codes % n, 'weight': group_weights})
 
-            # 如果 (src, dst) 组合已经存在，则增加计数
-            if (src, dst) in counts:
-                counts[(src, dst)] += 1
-            else:
-                counts[(src, dst)] = 1
+    return trips_graph, group_graph
 
-            src = dst
 
-    # 将统计结果转换为 DataFrame
-    trips_graph = pd.DataFrame(
-        [(src, dst, weight) for (src, dst), weight in counts.items()],
-        columns=['src', 'dst', 'weight']
-    )
+# csv 中的轨迹字符串，只解析网格号后统计
+def create_graph(trips):
+    print(len(trips))
+    grid, offsets = parse_trip_grids(trips)
+
+    return create_graph_columnar(grid, offsets)
 
-    # for (src, dst), weight in counts.items():
-    #     trips_graph = pd.concat([trips_graph, pd.DataFrame({'src': [src], 'dst': [dst], 'weight': [weight]})],ignore_index=True)
 
-    return trips_graph
+# 按时间窗口分组：每个轨迹点所在窗口的序号，以最早的时间为起点
+def time_windows(time, time_window):
+    return (time - time.min()) // time_window
 
 
 def save_file(df, output_path, new_filename):
@@ -56,22 +58,55 @@ def save_file(df, output_path, new_filename):
     df.to_csv(output_path, index=False)
 
 
-def trips_graph(data_format, data_name):
+# 同时保存为稀疏矩阵（网格编号，不含特殊标记），与 graph_A.csv 同名，read_adjacency 优先读取
+def save_graph(trips_graph, output_path, new_filename):
+    save_file(trips_graph, output_path, new_filename)
+    n = int(max(trips_graph['src'].max(), trips_graph['dst'].max())) + 1 if len(trips_graph) else 0
+    matrix = edges_to_matrix(trips_graph['src'].values, trips_graph['dst'].values, trips_graph['weight'].values, n)
+    sp.save_npz(adjacency_matrix_path(os.path.join(output_path, new_filename)), matrix)
+
+
+# time_window 不为 None 时（秒）还按时间窗口分别统计，保存为 graph_A_window<time_window>.npz，
+# 包含每条边的 group（窗口序号）、src、dst、weight 以及窗口起点 start
+def trips_graph(data_format, data_name, time_window=None):
     data_path = os.path.join('../data', 'AIS', data_name)
     if data_format == 'csv':
         df = pd.read_csv(os.path.join(data_path, 'traj_train.csv'))
         print('trips_graph read finish')
 
-        trips_graph = create_graph(df['trips_new'])
+        grid, offsets = parse_trip_grids(df['trips_new'])
+        # 只有按时间窗口统计时才需要解析全部列
+        if time_window is not None:
+            points, _ = parse_trip_strings(df['trips_new'])
+            time = points[:, POINT_COLUMNS.index('time')].astype(np.int64)
+
+    elif data_format == 'npz':
+        trips = load_trips(os.path.join(data_path, 'traj_train.npz'))
+        print('trips_graph read finish')
+
+        offsets = trips['trips_new.offsets']
+        grid = trips['trips_new.grid']
+        time = trips['trips_new.time']
+
+    else:
+        raise ValueError(f'ERROR: {data_format} is unknown.')
 
-        print('create graph finish')
+    if time_window is None:
+        trips_graph = create_graph_columnar(grid, offsets)
+    else:
+        trips_graph, window_graph = create_graph_columnar(grid, offsets, time_windows(time, time_window))
+        window_graph['start'] = time.min() + window_graph['group'] * time_window
+        np.savez(os.path.join(data_path, 'graph_A_window{}.npz'.format(time_window)),
+                 **{column: window_graph[column].values for column in window_graph.columns})
 
-        trips_graph.sort_values(by=['src', 'dst'], inplace=True)
+    print('create graph finish')
+    # 输入为轨迹点数，输出为边数
+    profiling.rows(rows_in=offsets[-1], rows_out=len(trips_graph))
 
-        save_file(trips_graph, data_path, 'graph_A.csv')
+    save_graph(trips_graph, data_path, 'graph_A.csv')
 
-        print('save file finish')
+    print('save file finish')
 
-        print('finish')
+    print('finish')
 
-# trips_graph('csv', 'AIS_z')
\ No newline at end of file
+# trips_graph('csv', 'AIS_z')
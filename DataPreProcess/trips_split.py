@@ -2,6 +2,8 @@ import pandas as pd
 import numpy as np
 from sklearn.model_selection import train_test_split
 import os
+from trips_store import table_length, take_trips, save_trips, load_trips
+import profiling
 
 
 def save_file(df, output_path, new_filename):
@@ -15,6 +17,7 @@ def trips_split(data_format, data_name):
     if data_format == 'csv':
         df = pd.read_csv(os.path.join(data_path, 'trips_drop_cleaned_'+ data_name +'.csv'))
         print('trips_split read finish')
+        profiling.rows(rows_in=df['trip_length'].sum())
 
         # 分割比例
         train_size = 0.7  # 训练集大小为70%
@@ -31,6 +34,31 @@ def trips_split(data_format, data_name):
         save_file(df_train, data_path, 'traj_train.csv')
         save_file(df_val, data_path, 'traj_val.csv')
         save_file(df_test, data_path, 'traj_test111.csv')
+        profiling.rows(rows_out=sum(part['trip_length'].sum() for part in (df_train, df_val, df_test)))
+
+        print('finish')
+
+    elif data_format == 'npz':
+        trips = load_trips(os.path.join(data_path, 'trips_drop_cleaned_'+ data_name +'.npz'))
+        print('trips_split read finish')
+        profiling.rows(rows_in=trips['trip_length'].sum())
+
+        # 分割比例
+        train_size = 0.7  # 训练集大小为70%
+        val_size = 0.1  # 验证集大小为10%
+
+        # 对轨迹下标做与 csv 相同的分割
+        index = np.arange(table_length(trips))
+        index_train, index_remaining = train_test_split(index, test_size=(1 - train_size), random_state=42)
+        print("len(df_train):{}, len(df_remaining){}".format(len(index_train),len(index_remaining)))
+
+        index_val, index_test = train_test_split(index_remaining, test_size=(1 - val_size / (1 - train_size)), random_state=42)
+
+        # 保存到文件
+        save_trips(os.path.join(data_path, 'traj_train.npz'), take_trips(trips, index_train))
+        save_trips(os.path.join(data_path, 'traj_val.npz'), take_trips(trips, index_val))
+        save_trips(os.path.join(data_path, 'traj_test111.npz'), take_trips(trips, index_test))
+        profiling.rows(rows_out=sum(trips['trip_length'][index].sum() for index in (index_train, index_val, index_test)))
 
         print('finish')
 
@@ -0,0 +1,296 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+# 列式轨迹存储
+# 一张轨迹表是一个 {名称: numpy 数组} 的字典，保存为 .npz 文件
+#   'id'、'trip_length'、'drop_ratio' 等     每条轨迹一个值
+#   '<组>.offsets'                          该组中每条轨迹在扁平数组中的起止位置，长度为轨迹数 + 1
+#   '<组>.<列>'                              该组所有轨迹点首尾相接的扁平数组
+# 例如 'trips_new.grid'、'trips_new.lon' 对应原来 "grid,lon,lat,cog,sog,time;..." 字符串中的各列，
+# 'num_labels.values' 对应原来每条轨迹的 num_labels 列表
+
+# 轨迹点的列名及类型，与轨迹字符串中的顺序一致
+POINT_COLUMNS = ['grid', 'lon', 'lat', 'cog', 'sog', 'time']
+POINT_DTYPES = [np.int64, np.float64, np.float64, np.float64, np.float64, np.int64]
+# 轨迹点 DataFrame 中对应的列
+POINT_SOURCES = ['GRID', 'LON', 'LAT', 'COG', 'SOG', 'BaseDateTime']
+
+
+# 由每条轨迹的长度生成偏移数组
+def lengths_to_offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+# 每个扁平位置所属的轨迹下标
+def offsets_to_rows(offsets):
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+# 选出部分轨迹，返回它们在扁平数组中的下标以及新的偏移数组
+def ragged_index(offsets, index):
+    lengths = np.diff(offsets)[index]
+    new_offsets = lengths_to_offsets(lengths)
+    starts = offsets[:-1][index]
+    flat = np.arange(new_offsets[-1]) - np.repeat(new_offsets[:-1] - starts, lengths)
+    return flat, new_offsets
+
+
+def table_groups(table):
+    return [key[:-len('.offsets')] for key in table if key.endswith('.offsets')]
+
+
+def table_length(table):
+    return len(table['id'])
+
+
+# 按轨迹下标选出子表
+def take_trips(table, index):
+    index = np.asarray(index)
+    result = {}
+    for group in table_groups(table):
+        flat, offsets = ragged_index(table[group + '.offsets'], index)
+        result[group + '.offsets'] = offsets
+        for key in table:
+            if key.startswith(group + '.') and key != group + '.offsets':
+                result[key] = table[key][flat]
+
+    for key in table:
+        if '.' not in key:
+            result[key] = table[key][index]
+
+    return result
+
+
+# 从轨迹点 DataFrame 构建轨迹表，每个 key 值为一条轨迹，轨迹内保持原来的点顺序
+def trips_from_points(df, key='COUNT', group='trips'):
+    df = df.sort_values(by=key, kind='stable')
+    ids, lengths = np.unique(df[key].values, return_counts=True)
+
+    table = {'id': ids, 'trip_length': lengths, group + '.offsets': lengths_to_offsets(lengths)}
+    for column, source, dtype in zip(POINT_COLUMNS, POINT_SOURCES, POINT_DTYPES):
+        table[group + '.' + column] = df[source].values.astype(dtype)
+
+    return table
+
+
+# 转换为 [(grid, lon, lat, cog, sog, time), ...] 形式的轨迹列表
+def trips_to_records(table, group):
+    offsets = table[group + '.offsets'].tolist()
+    points = list(zip(*[table[group + '.' + column].tolist() for column in POINT_COLUMNS]))
+    return [points[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+# 转换为每条轨迹一个列表的形式，如 num_labels
+def ragged_to_lists(table, group):
+    offsets = table[group + '.offsets'].tolist()
+    values = table[group + '.values'].tolist()
+    return [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+# 轨迹表中一组轨迹的惰性序列，取出某条轨迹时才把它转换为 Python 对象，DataLoader 每个 batch 只转换取到的轨迹
+# 支持 len、下标、切片和迭代；convert 的参数为该轨迹 columns 各列的数组切片，默认得到 [(grid, lon, lat, cog, sog, time), ...]
+class LazyTrips:
+    def __init__(self, table, group, convert=None, columns=POINT_COLUMNS):
+        self.offsets = table[group + '.offsets']
+        self.columns = [table[group + '.' + column] for column in columns]
+        self.convert = convert if convert is not None else points_to_records
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.convert([column[start:end] for column in self.columns])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def points_to_records(columns):
+    return list(zip(*[column.tolist() for column in columns]))
+
+
+# 每条轨迹一个列表的惰性序列，如 num_labels
+def lazy_lists(table, group):
+    return LazyTrips(table, group, lambda columns: columns[0].tolist(), columns=['values'])
+
+
+# 流水线在同一个进程中连续运行多个阶段时，保存的 npz 同时留在内存中，下一个阶段读取同一个文件时直接使用
+memory_tables = None
+
+
+# enabled 为 False 时关闭；为 True 时开启，并只保留 retain 中的文件
+def keep_in_memory(enabled, retain=()):
+    global memory_tables
+    if not enabled:
+        memory_tables = None
+        return
+    previous = memory_tables or {}
+    retain = [os.path.abspath(path) for path in retain]
+    memory_tables = {path: previous[path] for path in retain if path in previous}
+
+
+def remember(path, table):
+    if memory_tables is not None:
+        memory_tables[os.path.abspath(path)] = table
+
+
+def recall(path):
+    if memory_tables is not None:
+        return memory_tables.get(os.path.abspath(path))
+    return None
+
+
+def save_trips(path, table):
+    np.savez(path, **table)
+    remember(path, dict(table))
+
+
+def load_trips(path):
+    table = recall(path)
+    if table is not None:
+        return dict(table)
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+# 轨迹点 DataFrame 的按列保存
+def save_points(path, df):
+    columns = {column: df[column].values for column in df.columns}
+    np.savez(path, **columns)
+    remember(path, {column: values.copy() for column, values in columns.items()})
+
+
+def load_points(path):
+    columns = recall(path)
+    if columns is not None:
+        return pd.DataFrame({key: values.copy() for key, values in columns.items()})
+    with np.load(path, allow_pickle=True) as data:
+        return pd.DataFrame({key: data[key] for key in data.files})
+
+
+# 以目录形式保存，每个数组一个 .npy 文件，读取时可以内存映射
+def save_trips_dir(path, table):
+    os.makedirs(path, exist_ok=True)
+    for key, value in table.items():
+        np.save(os.path.join(path, key + '.npy'), value)
+
+
+def load_trips_dir(path, mmap_mode='r'):
+    return {name[:-len('.npy')]: np.load(os.path.join(path, name), mmap_mode=mmap_mode)
+            for name in os.listdir(path) if name.endswith('.npy')}
+
+
+def file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+# 把 "[[grid, lon, lat, cog, sog, time], ...]" 或 "[0, 1, ...]" 形式的字符串解析为扁平数组和偏移数组，不使用 eval
+def parse_list_strings(strings, width):
+    lengths = np.array([0 if string.strip() == '[]' else string.count(',') + 1 for string in strings], dtype=np.int64)
+    text = ','.join(string for string, length in zip(strings, lengths) if length > 0)
+    values = np.fromstring(text.replace('[', '').replace(']', ''), dtype=np.float64, sep=',')
+
+    return values.reshape(-1, width), lengths_to_offsets(lengths // width)
+
+
+# 区间 [starts, starts + lengths) 内所有下标首尾相接
+def span_index(starts, lengths):
+    offsets = lengths_to_offsets(lengths)
+    return np.arange(offsets[-1]) - np.repeat(offsets[:-1] - starts, lengths)
+
+
+# 字节数组 text 中 [starts, starts + lengths) 处的非负整数，各位数字按位权求和
+def parse_integers(text, starts, lengths):
+    offsets = lengths_to_offsets(lengths)
+    exponent = np.repeat(offsets[1:] - 1, lengths) - np.arange(offsets[-1])
+    digits = (text[span_index(starts, lengths)] - ord('0')).astype(np.int64)
+    return np.add.reduceat(digits * 10 ** exponent, offsets[:-1])
+
+
+# 只解析轨迹字符串中每个点的网格号（第一个逗号之前的数字），返回网格号和偏移数组
+def parse_trip_grids(strings):
+    strings = list(strings)
+    offsets = lengths_to_offsets([string.count(';') + 1 for string in strings])
+    text = np.frombuffer(';'.join(strings).encode(), dtype=np.uint8)
+    starts = np.concatenate([[0], np.flatnonzero(text == ord(';')) + 1])
+    commas = np.flatnonzero(text == ord(','))
+    ends = commas[np.searchsorted(commas, starts)]
+
+    return parse_integers(text, starts, ends - starts), offsets
+
+
+# 把 "grid,lon,lat,cog,sog,time;..." 形式的轨迹字符串一次解析为 (点数, 6) 的数组和偏移数组
+def parse_trip_strings(strings):
+    strings = list(strings)
+    offsets = lengths_to_offsets([string.count(';') + 1 for string in strings])
+    points = np.fromstring(';'.join(strings).replace(';', ','), dtype=np.float64, sep=',')
+
+    return points.reshape(-1, len(POINT_COLUMNS)), offsets
+
+
+# 轨迹字符串解析为 group 组的列式轨迹，各列转换为 POINT_DTYPES
+def strings_to_trips(strings, group):
+    points, offsets = parse_trip_strings(strings)
+    table = {group + '.offsets': offsets}
+    for i, (column, dtype) in enumerate(zip(POINT_COLUMNS, POINT_DTYPES)):
+        table[group + '.' + column] = points[:, i].astype(dtype)
+    return table
+
+
+# csv 中解析代价高的轨迹列：trips_sparse / num_labels 为列表字符串，trips_new 为 "grid,lon,lat,cog,sog,time;..." 字符串
+CACHED_CSV_COLUMNS = ['trips_new', 'trips_sparse', 'num_labels']
+
+
+# 读取 traj_*.csv，轨迹列第一次读取时解析并缓存到 csv 旁边的 <文件名>.cache 目录，
+# 之后内存映射读取缓存，csv 内容或缓存的列变化时重新生成
+# 返回与 load_trips 相同形式的轨迹表：轨迹列为 '<列>.offsets' 和扁平数组，其余每列一个数组，
+# 需要 Python 对象时用 LazyTrips / lazy_lists 按需转换
+def read_csv_cached(path):
+    cache_path = path + '.cache'
+    hash_path = os.path.join(cache_path, 'source.sha1')
+    header = pd.read_csv(path, nrows=0).columns.tolist()
+    cached_columns = [column for column in CACHED_CSV_COLUMNS if column in header]
+    # 缓存的列不同时（如旧版本的缓存）也重新生成
+    source_hash = file_hash(path) + ':' + ','.join(cached_columns)
+
+    if os.path.exists(hash_path) and open(hash_path).read() == source_hash:
+        df = pd.read_csv(path, usecols=[column for column in header if column not in cached_columns])
+        table = load_trips_dir(cache_path)
+    else:
+        df = pd.read_csv(path)
+        table = {}
+        if 'trips_new' in cached_columns:
+            table.update(strings_to_trips(df['trips_new'].tolist(), 'trips_new'))
+        if 'trips_sparse' in cached_columns:
+            points, table['trips_sparse.offsets'] = parse_list_strings(df['trips_sparse'].tolist(), len(POINT_COLUMNS))
+            for i, (column, dtype) in enumerate(zip(POINT_COLUMNS, POINT_DTYPES)):
+                table['trips_sparse.' + column] = points[:, i].astype(dtype)
+        if 'num_labels' in cached_columns:
+            values, table['num_labels.offsets'] = parse_list_strings(df['num_labels'].tolist(), 1)
+            table['num_labels.values'] = values[:, 0].astype(np.int64)
+
+        # 先清除旧的校验值，数组全部写完后再写入，保证中断时不会留下不完整的缓存
+        if os.path.exists(hash_path):
+            os.remove(hash_path)
+        save_trips_dir(cache_path, table)
+        open(hash_path, 'w').write(source_hash)
+
+    for column in header:
+        if column not in cached_columns:
+            table[column] = df[column].values
+
+    return table
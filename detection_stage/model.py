@@ -10,7 +10,7 @@ from utils import *
 class Transformer_tagging(nn.Module):
 
     def __init__(self, model_dimension, fourier_dimension, time_dimension, vocab_size, number_of_heads, number_of_layers, number_cls,
-                 dropout_probability, device, log_attention_weights=False, position_encoding=True):
+                 dropout_probability, device, log_attention_weights=False, position_encoding=True, gcn_refresh_steps=1, gcn_subgraph=False):
         super(Transformer_tagging, self).__init__()
 
         self.src_embedding = nn.Embedding(vocab_size, model_dimension)
@@ -25,6 +25,13 @@ class Transformer_tagging(nn.Module):
         self.pos_encoding = position_encoding
 
         self.gcn = GCN(model_dimension, [model_dimension, model_dimension], model_dimension, dropout_probability)
+        self.gcn_refresh_steps = gcn_refresh_steps
+        self.gcn_subgraph = gcn_subgraph
+        self.gcn_steps = 0
+        self.cxt_cache = None
+        self.cxt_cache_key = None
+        self.cxt_cache_graph = None
+        self.cxt_cache_step = None
 
         if position_encoding is True:
             self.pos_embedding = nn.Embedding(200, model_dimension)
@@ -45,6 +52,8 @@ class Transformer_tagging(nn.Module):
                     nn.init.xavier_uniform_(p)
 
     def forward(self, src_token_ids_batch, src_time_batch, src_coor_batch, src_cog_batch, src_sog_batch, src_mask, adj_graph, type):
+        if self.training and type == 'tagging':
+            self.gcn_steps += 1
         src_representations = self.encode(src_token_ids_batch, src_time_batch, src_coor_batch, src_cog_batch, src_sog_batch, src_mask, adj_graph)
         # outputs = self.mlp(src_representations_batch) #[N, L, num_cls]
         if type == 'tagging':
@@ -58,9 +67,8 @@ class Transformer_tagging(nn.Module):
     def encode(self, src_token_ids_batch, src_time_batch, src_dist_batch, src_cog_batch, src_sog_batch, src_mask, adj_graph):
         (bs, seq_len) = src_token_ids_batch.shape
 
-        src_cxt_embeddings = self.gcn(self.src_embedding.weight, adj_graph)
         src_embeddings_batch = self.src_embedding(src_token_ids_batch)  # get embedding vectors for src token ids
-        src_embeddings_batch_cxt = src_cxt_embeddings[src_token_ids_batch.view(-1)].view(bs, seq_len, -1)
+        src_embeddings_batch_cxt = self.context_embeddings(adj_graph, src_token_ids_batch.view(-1)).view(bs, seq_len, -1)
         src_embeddings_batch = src_embeddings_batch_cxt + src_embeddings_batch
 
         if self.pos_encoding:
@@ -83,6 +91,40 @@ class Transformer_tagging(nn.Module):
         outputs = self.mlp(src_representations)
 
         return outputs
+
+    # 位置上下文嵌入（GCN 在整个词表上的输出）
+    # 推理时只计算一次并缓存，模型参数变化（训练、加载模型）或换了邻接矩阵后才重新计算
+    # 缓存保留邻接矩阵本身，用 is 比较（id 在张量释放后可能被新张量重用），并记录其 _version 以发现原地修改
+    # 训练时 gcn_refresh_steps > 1 则每 K 步才带梯度地计算一次，其余步使用缓存；gcn_subgraph 则只在 batch 中 token 的邻域子图上计算
+    def context_embeddings(self, adj_graph, token_ids):
+        if not self.training:
+            key = (adj_graph._version, tuple((p.data_ptr(), p._version) for p in self.context_parameters()))
+            if not self.context_cached(adj_graph, key):
+                with torch.no_grad():
+                    self.cxt_cache = self.gcn(self.src_embedding.weight, adj_graph)
+                self.cxt_cache_key, self.cxt_cache_graph = key, adj_graph
+            return self.cxt_cache[token_ids]
+
+        if self.gcn_subgraph:
+            return self.gcn.forward_subgraph(self.src_embedding.weight, adj_graph, token_ids)
+        if self.gcn_refresh_steps <= 1:
+            return self.gcn(self.src_embedding.weight, adj_graph)[token_ids]
+
+        # 同一步中的多次前向共用带梯度的输出，之后的步使用其 detach 后的缓存
+        key = ('train', adj_graph._version, (self.gcn_steps - 1) // self.gcn_refresh_steps)
+        if not self.context_cached(adj_graph, key):
+            self.cxt_cache = self.gcn(self.src_embedding.weight, adj_graph)
+            self.cxt_cache_key, self.cxt_cache_graph = key, adj_graph
+            self.cxt_cache_step = self.gcn_steps
+        elif self.cxt_cache_step != self.gcn_steps and self.cxt_cache.requires_grad:
+            self.cxt_cache = self.cxt_cache.detach()
+        return self.cxt_cache[token_ids]
+
+    def context_cached(self, adj_graph, key):
+        return self.cxt_cache_graph is adj_graph and self.cxt_cache_key == key
+
+    def context_parameters(self):
+        return [self.src_embedding.weight] + list(self.gcn.parameters())
 #
 # Encoder architecture
 #
@@ -263,6 +305,26 @@ class GCN(nn.Module):
 
         return x
 
+    # 只在 token_ids 的 k 跳邻域子图（k 为层数）上计算，返回 token_ids 对应的输出，与全图计算的结果一致
+    def forward_subgraph(self, x, adj, token_ids):
+        adj = adj.coalesce()
+        row, col = adj.indices()
+        n_vertex = adj.shape[0]
+
+        mask = torch.zeros(n_vertex, dtype=torch.bool, device=x.device)
+        mask[token_ids] = True
+        for _ in range(len(self.gcn)):
+            mask[col[mask[row]]] = True
+
+        nodes = mask.nonzero().squeeze(1)
+        remap = torch.full((n_vertex,), -1, dtype=torch.long, device=x.device)
+        remap[nodes] = torch.arange(len(nodes), device=x.device)
+        keep = mask[row] & mask[col]
+        sub_adj = torch.sparse_coo_tensor(torch.stack([remap[row[keep]], remap[col[keep]]]), adj.values()[keep],
+                                          (len(nodes), len(nodes)))
+
+        return self.forward(x[nodes], sub_adj)[remap[token_ids]]
+
 
 class Embedding(nn.Module):
 
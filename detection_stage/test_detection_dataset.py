@@ -0,0 +1,33 @@
+import os
+import sys
+import types
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'DataPreProcess'))
+from synthetic_ais import synthetic_pipeline_outputs
+from utils import load_dataset
+
+
+# csv 和 npz 两种格式的流水线输出经 load_dataset 读取后相同（合成数据集上分别运行两种格式的流水线）
+# csv 的中间结果经 pd.read_csv 读回时浮点数可能差最后一位，坐标按相对误差 1e-12 比较，其余完全相同
+
+
+def assert_trips_match(csv_trips, npz_trips):
+    assert len(csv_trips) == len(npz_trips) > 0
+    for csv_trip, npz_trip in zip(csv_trips, npz_trips):
+        np.testing.assert_allclose(np.array(csv_trip, dtype=np.float64), np.array(npz_trip, dtype=np.float64), rtol=1e-12)
+
+
+def test_csv_and_npz_datasets_match(tmp_path):
+    data_path = synthetic_pipeline_outputs(tmp_path)
+    args = types.SimpleNamespace(data_path=os.path.dirname(data_path), data_name=os.path.basename(data_path))
+    from_csv = load_dataset(args, 'csv')
+    from_npz = load_dataset(args, 'npz')
+
+    # train, val, val_target, test, test_target
+    for csv_part, npz_part in zip(from_csv[:5], from_npz[:5]):
+        assert_trips_match(csv_part, npz_part)
+    # loc_size, id2loc, max_len
+    assert from_csv[5:8] == from_npz[5:8]
+    assert (from_csv[8] != from_npz[8]).nnz == 0
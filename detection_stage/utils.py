@@ -3,14 +3,16 @@ import numpy as np
 import pandas as pd
 import pickle
 import os
-import networkx as nx
-from pyproj import Transformer
-from scipy.sparse.linalg import eigsh
+import sys
 from sklearn.metrics import precision_score, recall_score, f1_score
 
 from constants import *
 from dataloader import DataLoader
 
+sys.path.append('../')
+from DataPreProcess.trips_store import load_trips, read_csv_cached, LazyTrips, lazy_lists
+from DataPreProcess.graph_store import read_adjacency, calculate_laplacian_matrix
+
 
 def dataset_collate(trips):
     trips_collate = []
@@ -26,106 +28,56 @@ def dataset_collate(trips):
 
 def load_dataset(args, data_format):
     data_path = os.path.join(args.data_path, args.data_name)
-    if data_format is 'csv':
-        adj_path = os.path.join(data_path, 'graph_A.csv')
-        train_path = os.path.join(data_path, 'traj_train.csv')
-        val_path = os.path.join(data_path, "traj_val.csv")
-        test_path = os.path.join(data_path, 'traj_test.csv')
-
-        lbs_train = pd.read_csv(train_path)
-        lbs_val = pd.read_csv(val_path, converters={'trips_sparse': eval, 'num_labels': eval})
-        lbs_test = pd.read_csv(test_path, converters={'trips_sparse': eval, 'num_labels': eval})
-        id2loc = pickle.load(open(os.path.join(data_path, 'grid2center_' + args.data_name + '.pickle'), 'rb'))
-        print("train data size {}, val data size {}, test data size {}, cell tower num {}"\
-              .format(len(lbs_train), len(lbs_val), len(lbs_test), len(id2loc)))
-
-
-    coor_transformer = Transformer.from_crs("epsg:4326", "epsg:4575", always_xy=True)
+    adj_path = os.path.join(data_path, 'graph_A.csv')
+    id2loc = pickle.load(open(os.path.join(data_path, 'grid2center_' + args.data_name + '.pickle'), 'rb'))
+    # 两种格式都读取为列式轨迹表，轨迹在 DataLoader 取用时才转换
+    if data_format == 'csv':
+        lbs_train = read_csv_cached(os.path.join(data_path, 'traj_train.csv'))
+        lbs_val = read_csv_cached(os.path.join(data_path, "traj_val.csv"))
+        lbs_test = read_csv_cached(os.path.join(data_path, 'traj_test.csv'))
+    elif data_format == 'npz':
+        lbs_train = load_trips(os.path.join(data_path, 'traj_train.npz'))
+        lbs_val = load_trips(os.path.join(data_path, 'traj_val.npz'))
+        lbs_test = load_trips(os.path.join(data_path, 'traj_test.npz'))
+    else:
+        raise ValueError(f'ERROR: {data_format} is unknown.')
 
     # with open('id2loc.txt', 'w') as log_file:
     #     log_file.write(f"id2loc {id2loc}\n")
 
-    def data_to_input(trips):
-        trips_input = []
-        for trip in trips:
-            res = []
-            time_min = trip[0][-1]
-            for (loc, lon, lat, cog, sog, time) in trip:
-                coords = id2loc[loc]
-                res.append((int(loc)+TOTAL_SPE_TOKEN, time-time_min, coords[0], coords[1], cog, sog))
-                # print("loc{}\n".format(loc))
-                # print("coords[0] {}\n coords[1] {}\n".format(coords[0], coords[1]))
-            trips_input.append(res)
-        return trips_input
+    def data_to_input(columns):
+        grid, lon, lat, cog, sog, time = [column.tolist() for column in columns]
+        time_min = time[0]
+        return [(loc+TOTAL_SPE_TOKEN, t-time_min, id2loc[loc][0], id2loc[loc][1], c, s)
+                for loc, t, c, s in zip(grid, time, cog, sog)]
+
+    train_input = LazyTrips(lbs_train, 'trips_new', data_to_input)
+    val_input = LazyTrips(lbs_val, 'trips_sparse', data_to_input)
+    val_target = lazy_lists(lbs_val, 'num_labels')
+    test_input = LazyTrips(lbs_test, 'trips_sparse', data_to_input)
+    test_target = lazy_lists(lbs_test, 'num_labels')
 
+    print("train data size {}, val data size {}, test data size {}, cell tower num {}"\
+          .format(len(train_input), len(val_input), len(test_input), len(id2loc)))
 
     loc_size = len(id2loc)
     # id2loc = {id: to3414.transform(loc[0], loc[1]) for loc,id in loc2id.items()}
 
-    adj_pd = pd.read_csv(adj_path)
-    adj_pd = adj_pd.add({'src': TOTAL_SPE_TOKEN, 'dst': TOTAL_SPE_TOKEN, 'weight': 0})
-    G = nx.DiGraph()
-    G.add_nodes_from(list(range(loc_size + TOTAL_SPE_TOKEN)))
-    src, dst, weights = adj_pd['src'].values.tolist(), adj_pd['dst'].values.tolist(), adj_pd['weight'].values.tolist()
-    G.add_weighted_edges_from(zip(src, dst, weights))
-    adj_graph = nx.to_numpy_array(G)
+    adj_graph = read_adjacency(adj_path, loc_size + TOTAL_SPE_TOKEN, TOTAL_SPE_TOKEN)
 
-    train_traj = dataset_collate(lbs_train['trips_new'].values.tolist())
-    val_traj = lbs_val['trips_sparse'].values.tolist()
-    val_tgt = lbs_val['num_labels'].values.tolist()
-    test_traj = lbs_test['trips_sparse'].values.tolist()
-    test_tgt = lbs_test['num_labels'].values.tolist()
-
-
-    max_len = 0
-    for i in train_traj:
-        length = len(i)
-        if length > max_len:
-            max_len = length
+    max_len = int(np.diff(lbs_train['trips_new.offsets']).max())
 
     print("train num {}, val num {}, test num {}, target {}, " \
-          .format(len(train_traj), len(val_traj), len(test_traj), len(test_tgt)))
-
-
-    train_input = data_to_input(train_traj)
-    val_input = data_to_input(val_traj)
-    val_target = val_tgt
-    test_input = data_to_input(test_traj)
-    test_target = test_tgt
+          .format(len(train_input), len(val_input), len(test_input), len(test_target)))
 
     return train_input, val_input, val_target, test_input, test_target, loc_size, id2loc, max_len, adj_graph
 
-def calculate_laplacian_matrix(adj_mat, mat_type):
-    n_vertex = adj_mat.shape[0]
-
-    # row sum
-    deg_mat_row = np.asmatrix(np.diag(np.sum(adj_mat, axis=1)))
-    # column sum
-    # deg_mat_col = np.asmatrix(np.diag(np.sum(adj_mat, axis=0)))
-    deg_mat = deg_mat_row
-
-    adj_mat = np.asmatrix(adj_mat)
-    id_mat = np.asmatrix(np.identity(n_vertex))
-
-    if mat_type == 'com_lap_mat':
-        # Combinatorial
-        com_lap_mat = deg_mat - adj_mat
-        return com_lap_mat
-    elif mat_type == 'wid_rw_normd_lap_mat':
-        # For ChebConv
-        rw_lap_mat = np.matmul(np.linalg.matrix_power(deg_mat, -1), adj_mat)
-        rw_normd_lap_mat = id_mat - rw_lap_mat
-        lambda_max_rw = eigsh(rw_lap_mat, k=1, which='LM', return_eigenvectors=False)[0]
-        wid_rw_normd_lap_mat = 2 * rw_normd_lap_mat / lambda_max_rw - id_mat
-        return wid_rw_normd_lap_mat
-    elif mat_type == 'hat_rw_normd_lap_mat':
-        # For GCNConv
-        wid_deg_mat = deg_mat + id_mat
-        wid_adj_mat = adj_mat + id_mat
-        hat_rw_normd_lap_mat = np.matmul(np.linalg.matrix_power(wid_deg_mat, -1), wid_adj_mat)
-        return hat_rw_normd_lap_mat
-    else:
-        raise ValueError(f'ERROR: {mat_type} is unknown.')
+# scipy 稀疏矩阵转换为 torch 稀疏张量
+def laplacian_to_tensor(lap_mat):
+    lap_mat = lap_mat.tocoo()
+    indices = torch.from_numpy(np.vstack((lap_mat.row, lap_mat.col)).astype(np.int64))
+    values = torch.from_numpy(lap_mat.data)
+    return torch.sparse_coo_tensor(indices, values, lap_mat.shape).float().coalesce()
 
 def get_dataloader(data, batch_size, max_seq_len, drop_num, ratio):
     dataloader = DataLoader(data, batch_size, max_seq_len, drop_num, ratio)
@@ -0,0 +1,190 @@
+import numpy as np
+import scipy.sparse as sp
+from scipy.spatial import cKDTree
+import torch
+import torch.nn.functional as F
+
+from constants import *
+
+
+# 空缺恢复的解码：批量 beam search（beam_size=1 时即贪心解码），所有 beam 作为一个张量 batch 一起计算
+# 可选的硬约束：
+#   distance_index  上一个真实位置附近 candidate_loc_distance 内的网格
+#   graph_index     graph_A.csv 中上一个真实位置有边可达的网格
+#   forbid_special  空缺中不输出 PAD/BLK/BOS/EOS，NUL 只能出现在空缺末尾（一旦输出 NUL，该空缺剩余位置都为 NUL）
+# 约束关系以 CSR（indptr, indices，网格编号不含特殊标记偏移）保存，每步的掩码只按上一个位置做一次 gather
+
+
+def neighbour_index(matrix, device):
+    matrix = sp.csr_matrix(matrix)
+    matrix.sort_indices()
+    return (torch.tensor(matrix.indptr, dtype=torch.long, device=device),
+            torch.tensor(matrix.indices, dtype=torch.long, device=device))
+
+
+# 距离约束：用 KD 树一次找出所有中心距离在 candidate_loc_distance 以内的网格对，只构建一次，
+# 内存为 O(N·k)，不再计算 N×N 的距离矩阵；centers 为网格中心表（N×2 投影坐标）
+# query_pairs 只返回 i < j 的网格对，加上反向和自身后按 (行, 列) 排序得到 CSR
+def distance_index(centers, candidate_loc_distance, device):
+    coordinates = np.asarray(centers, dtype=np.float64)
+    n = len(coordinates)
+    pairs = cKDTree(coordinates).query_pairs(r=candidate_loc_distance, output_type='ndarray')
+
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1], np.arange(n)])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0], np.arange(n)])
+    order = np.lexsort((cols, rows))
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n))])
+    indices = cols[order].astype(np.int64)
+
+    return torch.tensor(indptr, dtype=torch.long, device=device), torch.tensor(indices, dtype=torch.long, device=device)
+
+
+# 由 read_adjacency 得到的邻接矩阵（含特殊标记）得到图约束，允许停留在原网格
+def graph_index(adj_graph, device):
+    adj = sp.csr_matrix(adj_graph)[TOTAL_SPE_TOKEN:, TOTAL_SPE_TOKEN:]
+    return neighbour_index((adj + sp.identity(adj.shape[0], format='csr')) != 0, device)
+
+
+# 每行允许的 token：last_loc 所在网格在 index 中的邻居，特殊标记不受限制
+def neighbour_mask(index, last_loc, vocab_size):
+    indptr, indices = index
+    device = last_loc.device
+    # 没有真实的上一个位置时（last_loc 为特殊标记）按第 0 个网格处理
+    cells = (last_loc - TOTAL_SPE_TOKEN).clamp(min=0)
+
+    starts = indptr[cells]
+    counts = indptr[cells + 1] - starts
+    rows = torch.repeat_interleave(torch.arange(len(cells), device=device), counts)
+    offsets = torch.cumsum(counts, dim=0) - counts
+    flat = torch.arange(int(counts.sum()), device=device) - torch.repeat_interleave(offsets - starts, counts)
+
+    mask = torch.zeros(len(cells), vocab_size, dtype=torch.bool, device=device)
+    mask[rows, indices[flat] + TOTAL_SPE_TOKEN] = True
+    mask[:, :TOTAL_SPE_TOKEN] = True
+    return mask
+
+
+def special_token_mask(prev_tokens, gap_start, vocab_size):
+    mask = torch.ones(len(prev_tokens), vocab_size, dtype=torch.bool, device=prev_tokens.device)
+    mask[:, :TOTAL_SPE_TOKEN] = False
+    mask[:, NUL_TOKEN] = True
+
+    in_nul = (prev_tokens == NUL_TOKEN) & ~gap_start
+    mask[in_nul] = False
+    mask[in_nul, NUL_TOKEN] = True
+    return mask
+
+
+# 每条轨迹中当前待预测位置之前最后一个真实位置（已预测的位置也计入），在解码过程中增量维护，每步只有 O(B) 的张量运算
+#   src_index  每个待预测位置之前最后一个真实源轨迹点的下标（没有时为 -1），解码前一次算好
+#   pred_loc / pred_pos  最近一次预测出的真实位置及其下标
+def init_last_loc(traj_locs, masked_pos_batch):
+    positions = torch.arange(traj_locs.shape[1], device=traj_locs.device).expand_as(traj_locs)
+    last_valid = torch.where(traj_locs >= TOTAL_SPE_TOKEN, positions, -1).cummax(dim=1).values
+    src_index = last_valid.gather(1, (masked_pos_batch - 1).clamp(min=0))
+
+    no_pred = torch.full((traj_locs.shape[0],), -1, dtype=torch.long, device=traj_locs.device)
+    return {'src_index': src_index, 'pred_loc': no_pred, 'pred_pos': no_pred.clone()}
+
+
+def current_last_loc(tracker, traj_locs, idx):
+    src_index = tracker['src_index'][:, idx]
+    # 都没有时与原来一样取轨迹的第一个点
+    src_loc = traj_locs.gather(1, src_index.clamp(min=0).unsqueeze(1)).squeeze(1)
+    return torch.where(tracker['pred_pos'] > src_index, tracker['pred_loc'], src_loc)
+
+
+def update_last_loc(tracker, pred_locs, pred_pos):
+    real = pred_locs >= TOTAL_SPE_TOKEN
+    tracker['pred_loc'] = torch.where(real, pred_locs, tracker['pred_loc'])
+    tracker['pred_pos'] = torch.where(real, pred_pos, tracker['pred_pos'])
+
+
+def reorder_last_loc(tracker, index):
+    for key in tracker:
+        tracker[key] = tracker[key].index_select(0, index)
+
+
+# 按 index 重排增量解码状态（beam 扩展、beam 选择）
+def reorder_decoding(state, index):
+    for kv_cache in state['kv_cache']:
+        kv_cache['key'] = kv_cache['key'].index_select(0, index)
+        kv_cache['value'] = kv_cache['value'].index_select(0, index)
+    state['key_mask'] = state['key_mask'].index_select(0, index)
+
+
+# 解码一个 batch 的所有空缺位置，返回 B x 空缺数 的预测 token
+def decode_gaps(model, traj_locs, traj_tms, traj_coors, traj_cogs, traj_sogs, masked_pos_batch, masked_pos_lengths, A,
+                beam_size=1, distance_index=None, graph_index=None, forbid_special=False, sample=False):
+    (bs, n_steps) = masked_pos_batch.shape
+    device = traj_locs.device
+    masked_pos_lengths = torch.as_tensor(masked_pos_lengths, device=device)
+
+    # 源轨迹只编码一次，再复制给每个 beam
+    state = model.start_decoding(traj_locs, traj_tms, traj_coors, traj_cogs, traj_sogs, A)
+    beam_rows = torch.arange(bs, device=device).repeat_interleave(beam_size)
+    if beam_size > 1:
+        reorder_decoding(state, beam_rows)
+        traj_locs = traj_locs[beam_rows]
+        masked_pos_batch = masked_pos_batch[beam_rows]
+        masked_pos_lengths = masked_pos_lengths[beam_rows]
+
+    # 初始时各 beam 相同，只保留第一个，避免重复
+    scores = torch.full((bs, beam_size), -float('inf'), device=device)
+    scores[:, 0] = 0
+    scores = scores.view(-1)
+    tokens = torch.full((bs * beam_size, 1), BLK_TOKEN, dtype=torch.long, device=device)
+    use_last_loc = distance_index is not None or graph_index is not None
+    if use_last_loc:
+        tracker = init_last_loc(traj_locs, masked_pos_batch)
+
+    for idx in range(n_steps):
+        # 第 idx 个预测位置的序号为 masked_pos[idx - 1]（第 0 个为 masked_pos[0]），与 encode 中的 pos_ids 一致
+        logits = model.decode_step(state, tokens[:, idx], masked_pos_batch[:, max(idx - 1, 0)], A)  # (B*K) x vocab_size
+        vocab_size = logits.size(-1)
+
+        allowed = torch.ones_like(logits, dtype=torch.bool)
+        if use_last_loc:
+            last_loc = current_last_loc(tracker, traj_locs, idx)
+            if distance_index is not None:
+                allowed &= neighbour_mask(distance_index, last_loc, vocab_size)
+            if graph_index is not None:
+                allowed &= neighbour_mask(graph_index, last_loc, vocab_size)
+        if forbid_special:
+            if idx == 0:
+                gap_start = torch.ones(len(logits), dtype=torch.bool, device=device)
+            else:
+                gap_start = masked_pos_batch[:, idx] != masked_pos_batch[:, idx - 1] + 1
+            allowed &= special_token_mask(tokens[:, idx], gap_start, vocab_size)
+
+        if beam_size == 1:
+            logits = torch.where(allowed, logits, -float('inf'))
+            if sample:
+                pred_locs = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1).squeeze(1)
+            else:
+                pred_locs = torch.argmax(logits, dim=-1)
+            tokens = torch.cat([tokens, pred_locs.unsqueeze(1)], dim=1)
+            if use_last_loc:
+                update_last_loc(tracker, pred_locs, masked_pos_batch[:, idx])
+            continue
+
+        log_probs = torch.where(allowed, F.log_softmax(logits, dim=-1), -float('inf'))
+        # 已经解码完的轨迹（空缺数少于当前步）不再改变分数
+        finished = idx >= masked_pos_lengths
+        log_probs[finished] = -float('inf')
+        log_probs[finished, PAD_TOKEN] = 0
+
+        candidate_scores = (scores.unsqueeze(1) + log_probs).view(bs, -1)  # B x (K*vocab_size)
+        top_scores, top_index = torch.topk(candidate_scores, beam_size, dim=-1)
+        parents = (torch.arange(bs, device=device).unsqueeze(1) * beam_size + top_index // vocab_size).view(-1)
+
+        scores = top_scores.view(-1)
+        pred_locs = (top_index % vocab_size).view(-1)
+        tokens = torch.cat([tokens[parents], pred_locs.unsqueeze(1)], dim=1)
+        reorder_decoding(state, parents)
+        if use_last_loc:
+            reorder_last_loc(tracker, parents)
+            update_last_loc(tracker, pred_locs, masked_pos_batch[:, idx])
+
+    # topk 按分数从大到小排列，每条轨迹取第一个 beam
+    return tokens[torch.arange(bs, device=device) * beam_size, 1:]
@@ -10,7 +10,8 @@ from utils import *
 class Transformer_insertion(nn.Module):
 
     def __init__(self, model_dimension, fourier_dimension, time_dimension, src_vocab_size, trg_vocab_size, number_of_heads, number_of_layers,
-                 dropout_probability, max_len, device, max_input_length=200, log_attention_weights=False, learnable_pos=True):
+                 dropout_probability, max_len, device, max_input_length=200, log_attention_weights=False, learnable_pos=True,
+                 gcn_refresh_steps=1, gcn_subgraph=False):
         super().__init__()
 
         self.learnable_pos = learnable_pos
@@ -18,6 +19,13 @@ class Transformer_insertion(nn.Module):
         self.src_embedding_cxt = nn.Embedding(src_vocab_size, model_dimension)
         self.src_embedding_loc = nn.Embedding(src_vocab_size, model_dimension)
         self.gcn = GCN(model_dimension, [model_dimension], model_dimension, dropout_probability)
+        self.gcn_refresh_steps = gcn_refresh_steps
+        self.gcn_subgraph = gcn_subgraph
+        self.gcn_steps = 0
+        self.cxt_cache = None
+        self.cxt_cache_key = None
+        self.cxt_cache_graph = None
+        self.cxt_cache_step = None
 
         if learnable_pos:
             self.src_pos_embedding = Embedding(max_input_length, model_dimension)
@@ -51,6 +59,8 @@ class Transformer_insertion(nn.Module):
 
     def forward(self, src_token_ids_batch, src_time_batch, src_dist_batch, src_cog_batch, src_sog_batch, attn_mask, adj_graph, type,
                 masked_pos=None, src_pred_inputs_batch=None):
+        if self.training and type == 'recovery':
+            self.gcn_steps += 1
         src_representations_batch = self.encode(src_token_ids_batch, src_time_batch, src_dist_batch, src_cog_batch, src_sog_batch ,attn_mask, adj_graph, type,
                                                 src_pred_inputs_batch, masked_pos)
         if type == 'recovery':
@@ -84,11 +94,7 @@ class Transformer_insertion(nn.Module):
             cogs_batch = src_cog_batch
             sogs_batch = src_sog_batch
 
-        loc_cxt_embeddings = self.gcn(self.src_embedding_cxt.weight, adj_graph)
-        token_embeddings_batch_cxt = loc_cxt_embeddings[src_token_inputs_batch.view(-1)].view(bs, src_token_inputs_batch.shape[1], -1)
-        token_embeddings_batch_loc = self.src_embedding_loc(src_token_inputs_batch)  # get embedding vectors for src token ids
-        token_embeddings_batch = token_embeddings_batch_cxt + token_embeddings_batch_loc
-
+        pos_ids_batch = None
         if self.learnable_pos:
             src_pos_batch = torch.arange(src_token_ids_batch.size(1), device=self.device).unsqueeze(0).repeat(bs, 1)
             if masked_pos is None:
@@ -96,7 +102,27 @@ class Transformer_insertion(nn.Module):
             else:
                 pos_ids_batch = torch.cat([src_pos_batch, masked_pos[:, :1], masked_pos[:, :-1]], dim=1)
 
+        embeddings_batch = self.embed(src_token_inputs_batch, times_batch, dists_batch, cogs_batch, sogs_batch, pos_ids_batch, adj_graph)
+
+        # embeddings_batch = self.norm(embeddings_batch)
+        src_representations_batch = self.encoder(embeddings_batch, attn_mask)  # forward pass through the encoder
 
+        # with open('../data/AIS/embeddings_batch.txt', 'a') as log_file:
+        #     log_file.write(
+        #         "len(embeddings_batch):{} len(token_embeddings_batch):{} len(pos_embeddings_batch):{} len(time_embeddings_batch):{} len(dist_embeddings_batch):{} \nembeddings_batch:\n{}\ntoken_embeddings_batch:\n{}\npos_embeddings_batch:\n{}\ntime_embeddings_batch:\n{}\ndist_embeddings_batch:\n{}\n" \
+        #         .format(len(embeddings_batch), len(token_embeddings_batch), len(pos_embeddings_batch), len(time_embeddings_batch), len(dist_embeddings_batch), embeddings_batch, token_embeddings_batch, pos_embeddings_batch, time_embeddings_batch, dist_embeddings_batch))
+
+        return src_representations_batch
+
+
+    # 输入嵌入：位置上下文 + 位置 token + 序号 + 时间 + 坐标 + 方向 + 速度，start 为第一个位置在整条序列中的下标
+    def embed(self, token_ids_batch, times_batch, dists_batch, cogs_batch, sogs_batch, pos_ids_batch, adj_graph, start=0):
+        (bs, length) = token_ids_batch.shape
+        token_embeddings_batch_cxt = self.context_embeddings(adj_graph, token_ids_batch.reshape(-1)).view(bs, length, -1)
+        token_embeddings_batch_loc = self.src_embedding_loc(token_ids_batch)  # get embedding vectors for src token ids
+        token_embeddings_batch = token_embeddings_batch_cxt + token_embeddings_batch_loc
+
+        if self.learnable_pos:
             pos_embeddings_batch = self.src_pos_embedding(pos_ids_batch)
             time_embeddings_batch = self.time_embedding(times_batch)
             dist_embeddings_batch = self.dist_embedding(dists_batch)
@@ -108,23 +134,80 @@ class Transformer_insertion(nn.Module):
             # src_embeddings_batch = src_embeddings_batch + src_pos_embeddings_batch + src_time_embeddings_batch + src_dist_embeddings_batch
             embeddings_batch = token_embeddings_batch + pos_embeddings_batch + time_embeddings_batch + dist_embeddings_batch + cog_embeddings_batch + sog_embeddings_batch
         else:
-            embeddings_batch = self.src_pos_embedding(token_embeddings_batch)  # add positional embedding
+            embeddings_batch = self.src_pos_embedding(token_embeddings_batch, start)  # add positional embedding
 
-        # embeddings_batch = self.norm(embeddings_batch)
-        src_representations_batch = self.encoder(embeddings_batch, attn_mask)  # forward pass through the encoder
+        return embeddings_batch
 
-        # with open('../data/AIS/embeddings_batch.txt', 'a') as log_file:
-        #     log_file.write(
-        #         "len(embeddings_batch):{} len(token_embeddings_batch):{} len(pos_embeddings_batch):{} len(time_embeddings_batch):{} len(dist_embeddings_batch):{} \nembeddings_batch:\n{}\ntoken_embeddings_batch:\n{}\npos_embeddings_batch:\n{}\ntime_embeddings_batch:\n{}\ndist_embeddings_batch:\n{}\n" \
-        #         .format(len(embeddings_batch), len(token_embeddings_batch), len(pos_embeddings_batch), len(time_embeddings_batch), len(dist_embeddings_batch), embeddings_batch, token_embeddings_batch, pos_embeddings_batch, time_embeddings_batch, dist_embeddings_batch))
+    # 增量解码（eval 模式）：源轨迹只编码一次，编码器每层缓存 key/value，之后每步只计算新追加的预测位置，
+    # 结果与每步把 [源轨迹, 已预测位置] 整体送入 forward(..., 'recovery', ...) 一致
+    def start_decoding(self, src_token_ids_batch, src_time_batch, src_dist_batch, src_cog_batch, src_sog_batch, adj_graph):
+        (bs, seq_len) = src_token_ids_batch.shape
+        src_pos_batch = torch.arange(seq_len, device=self.device).unsqueeze(0).repeat(bs, 1)
+        embeddings_batch = self.embed(src_token_ids_batch, src_time_batch, src_dist_batch, src_cog_batch, src_sog_batch,
+                                      src_pos_batch, adj_graph)
 
-        return src_representations_batch
+        attn_mask, _ = get_masks_and_count_tokens_trg(src_token_ids_batch, PAD_TOKEN)
+        kv_cache = [{} for _ in self.encoder.encoder_layers]
+        self.encoder(embeddings_batch, attn_mask, kv_cache)
+
+        return {'kv_cache': kv_cache, 'key_mask': (src_token_ids_batch != PAD_TOKEN).view(bs, 1, 1, -1), 'length': seq_len}
+
+    # 追加一个预测位置（token 为 BLK 或上一步的预测，pos 为其在原轨迹中的下标），返回该位置在词表上的输出
+    def decode_step(self, state, pred_token_batch, pos_batch, adj_graph):
+        bs = pred_token_batch.shape[0]
+        token_ids_batch = pred_token_batch.view(bs, 1)
+        times_batch = torch.ones(bs, 1, 1, dtype=torch.float, device=self.device) * PAD_TIME
+        dists_batch = torch.tensor([[PAD_LON, PAD_LAT]], device=self.device, dtype=torch.float).unsqueeze(1).repeat(bs, 1, 1)
+        cogs_batch = torch.ones(bs, 1, 1, dtype=torch.float, device=self.device) * PAD_COG
+        sogs_batch = torch.ones(bs, 1, 1, dtype=torch.float, device=self.device) * PAD_SOG
 
+        embeddings_batch = self.embed(token_ids_batch, times_batch, dists_batch, cogs_batch, sogs_batch, pos_batch.view(bs, 1),
+                                      adj_graph, start=state['length'])
+
+        state['key_mask'] = torch.cat([state['key_mask'], (token_ids_batch != PAD_TOKEN).view(bs, 1, 1, 1)], dim=-1)
+        state['length'] += 1
+        representations_batch = self.encoder(embeddings_batch, state['key_mask'], state['kv_cache'])
+
+        return self.decoder(representations_batch[:, -1])
 
     def decode(self, src_representations_batch, src_length):
         masked_output_probs= self.decoder(src_representations_batch[:, src_length:]) # B x Masked_S x H
         return masked_output_probs
 
+    # 位置上下文嵌入（GCN 在整个词表上的输出）
+    # 推理时只计算一次并缓存，模型参数变化（训练、加载模型）或换了邻接矩阵后才重新计算
+    # 缓存保留邻接矩阵本身，用 is 比较（id 在张量释放后可能被新张量重用），并记录其 _version 以发现原地修改
+    # 训练时 gcn_refresh_steps > 1 则每 K 步才带梯度地计算一次，其余步使用缓存；gcn_subgraph 则只在 batch 中 token 的邻域子图上计算
+    def context_embeddings(self, adj_graph, token_ids):
+        if not self.training:
+            key = (adj_graph._version, tuple((p.data_ptr(), p._version) for p in self.context_parameters()))
+            if not self.context_cached(adj_graph, key):
+                with torch.no_grad():
+                    self.cxt_cache = self.gcn(self.src_embedding_cxt.weight, adj_graph)
+                self.cxt_cache_key, self.cxt_cache_graph = key, adj_graph
+            return self.cxt_cache[token_ids]
+
+        if self.gcn_subgraph:
+            return self.gcn.forward_subgraph(self.src_embedding_cxt.weight, adj_graph, token_ids)
+        if self.gcn_refresh_steps <= 1:
+            return self.gcn(self.src_embedding_cxt.weight, adj_graph)[token_ids]
+
+        # 同一步中的多次前向共用带梯度的输出，之后的步使用其 detach 后的缓存
+        key = ('train', adj_graph._version, (self.gcn_steps - 1) // self.gcn_refresh_steps)
+        if not self.context_cached(adj_graph, key):
+            self.cxt_cache = self.gcn(self.src_embedding_cxt.weight, adj_graph)
+            self.cxt_cache_key, self.cxt_cache_graph = key, adj_graph
+            self.cxt_cache_step = self.gcn_steps
+        elif self.cxt_cache_step != self.gcn_steps and self.cxt_cache.requires_grad:
+            self.cxt_cache = self.cxt_cache.detach()
+        return self.cxt_cache[token_ids]
+
+    def context_cached(self, adj_graph, key):
+        return self.cxt_cache_graph is adj_graph and self.cxt_cache_key == key
+
+    def context_parameters(self):
+        return [self.src_embedding_cxt.weight] + list(self.gcn.parameters())
+
 
 
 class DecoderGenerator(nn.Module):
@@ -149,11 +232,11 @@ class Encoder(nn.Module):
         self.encoder_layers = nn.ModuleList([EncoderLayer(d_model, num_heads, dropout_probability).to(device) for _ in range(num_layers)])
         self.norm = nn.LayerNorm(d_model)
 
-    def forward(self, src_embeddings_batch, src_mask):
+    def forward(self, src_embeddings_batch, src_mask, kv_cache=None):
         src_representations_batch = src_embeddings_batch
 
-        for encoder_layer in self.encoder_layers:
-            src_representations_batch = encoder_layer(src_representations_batch, src_mask)
+        for i, encoder_layer in enumerate(self.encoder_layers):
+            src_representations_batch = encoder_layer(src_representations_batch, src_mask, None if kv_cache is None else kv_cache[i])
 
         return self.norm(src_representations_batch)
 
@@ -176,10 +259,10 @@ class EncoderLayer(nn.Module):
 
 
 
-    def forward(self, src_representations_batch, src_mask):
+    def forward(self, src_representations_batch, src_mask, kv_cache=None):
 
         attn_output, attn = self.mha(src_representations_batch, src_representations_batch,
-                                     src_representations_batch, src_mask)
+                                     src_representations_batch, src_mask, kv_cache)
         attn_output = self.dropout1(attn_output)
         out1  = self.layernorm1(src_representations_batch + attn_output)
 
@@ -236,13 +319,20 @@ class MultiHeadedAttention(nn.Module):
 
         return intermediate_token_representations, attention_weights  # attention weights for visualization purposes
 
-    def forward(self, query, key, value, mask):
+    def forward(self, query, key, value, mask, kv_cache=None):
         batch_size = query.shape[0]
 
         query = self.wq(query).view(batch_size, -1, self.number_of_heads, self.head_dimension).transpose(1, 2) #(B, NH, S, HD)
         key = self.wk(key).view(batch_size, -1, self.number_of_heads, self.head_dimension).transpose(1, 2)
         value = self.wv(value).view(batch_size, -1, self.number_of_heads, self.head_dimension).transpose(1, 2)
 
+        # 增量解码时把之前位置的 key/value 接在前面，并保存供下一步使用
+        if kv_cache is not None:
+            if 'key' in kv_cache:
+                key = torch.cat([kv_cache['key'], key], dim=2)
+                value = torch.cat([kv_cache['value'], value], dim=2)
+            kv_cache['key'], kv_cache['value'] = key, value
+
         intermediate_token_representations, attention_weights = self.attention(query, key, value, mask)
 
         reshaped = intermediate_token_representations.transpose(1, 2).reshape(batch_size, -1, self.number_of_heads * self.head_dimension)
@@ -313,6 +403,26 @@ class GCN(nn.Module):
 
         return x
 
+    # 只在 token_ids 的 k 跳邻域子图（k 为层数）上计算，返回 token_ids 对应的输出，与全图计算的结果一致
+    def forward_subgraph(self, x, adj, token_ids):
+        adj = adj.coalesce()
+        row, col = adj.indices()
+        n_vertex = adj.shape[0]
+
+        mask = torch.zeros(n_vertex, dtype=torch.bool, device=x.device)
+        mask[token_ids] = True
+        for _ in range(len(self.gcn)):
+            mask[col[mask[row]]] = True
+
+        nodes = mask.nonzero().squeeze(1)
+        remap = torch.full((n_vertex,), -1, dtype=torch.long, device=x.device)
+        remap[nodes] = torch.arange(len(nodes), device=x.device)
+        keep = mask[row] & mask[col]
+        sub_adj = torch.sparse_coo_tensor(torch.stack([remap[row[keep]], remap[col[keep]]]), adj.values()[keep],
+                                          (len(nodes), len(nodes)))
+
+        return self.forward(x[nodes], sub_adj)[remap[token_ids]]
+
 
 class Embedding(nn.Module):
 
@@ -433,11 +543,11 @@ class PositionalEncoding(nn.Module):
 
         self.register_buffer('positional_encodings_table', positional_encodings_table)
 
-    def forward(self, embeddings_batch):
+    def forward(self, embeddings_batch, start=0):
         assert embeddings_batch.ndim == 3 and embeddings_batch.shape[-1] == self.positional_encodings_table.shape[1], \
             f'Expected (batch size, max token sequence length, model dimension) got {embeddings_batch.shape}'
 
-        positional_encodings = self.positional_encodings_table[:embeddings_batch.shape[1]]
+        positional_encodings = self.positional_encodings_table[start:start + embeddings_batch.shape[1]]
 
         return self.dropout(embeddings_batch + positional_encodings)
 
@@ -4,58 +4,35 @@ import numpy as np
 import pandas as pd
 import pickle
 import argparse
-import networkx as nx
 import torch
 import os
 import sys
-from pyproj import Transformer
 sys.path.append('../')
 
 from model import Transformer_insertion
 from detection_stage.model import Transformer_tagging
-from utils import get_masks_and_count_tokens_src, get_masks_and_count_tokens_trg, calculate_laplacian_matrix
+from utils import get_masks_and_count_tokens_src, get_masks_and_count_tokens_trg, calculate_laplacian_matrix, laplacian_to_tensor, find_best_subsequence
 from dataloader import pad_arrays
 from constants import *
 from collections import defaultdict
-from geopy.distance import great_circle
-from fastdtw import fastdtw
 from joblib import Parallel, delayed
+from DataPreProcess.trips_store import read_csv_cached, LazyTrips, lazy_lists
+from DataPreProcess.graph_store import read_adjacency
 
 def load_test_dataset(args, data_path, adj_path):
     test_path = os.path.join(data_path, 'traj_test.csv')
-    lbs_test = pd.read_csv(test_path, converters={'trips_sparse': eval,
-                                                  'num_labels': eval})
+    lbs_test = read_csv_cached(test_path)
     # id2loc = pickle.load(open(os.path.join(data_path,"grid2center_Beijing.pickle"), 'rb'))
     id2loc = pickle.load(open(os.path.join(data_path, "grid2center_" + args.data_name + ".pickle"), 'rb'))
-    print("test data size {}, location num {}".format(len(lbs_test), len(id2loc)))
-
-    to3414 = Transformer.from_crs("epsg:4326", "epsg:4575", always_xy=True)
-
-    def dataset_collate(trips):
-        trips_collate = []
-        for trip in trips:
-            trip_collate = []
-            trip = trip.split(';')
-            for loc in trip:
-                idx, lon, lat, time = loc.split(',')
-                trip_collate.append([int(idx), float(lon), float(lat), int(time)])
-            trips_collate.append(trip_collate)
-        return trips_collate
-
-
-    def data_to_input(trips):
-        trips_input = []
-        for trip in trips:
-            res = []
-            time_min = trip[0][-1]
-            for (loc, lon, lat, time) in trip:
-                if loc == 'BLK':
-                    res.append((BLK_TOKEN, 5000, 20447840.4, 4419792.3))
-                else:
-                    coords = id2loc[loc]
-                    res.append((int(loc)+TOTAL_SPE_TOKEN, time-time_min, coords[0], coords[1]))
-            trips_input.append(np.array(res))
-        return trips_input
+    print("test data size {}, location num {}".format(len(lbs_test['drop_ratio']), len(id2loc)))
+
+    # 本脚本的轨迹点为 (grid, lon, lat, time)
+    point_columns = ['grid', 'lon', 'lat', 'time']
+
+    def data_to_input(columns):
+        grid, lon, lat, time = [column.tolist() for column in columns]
+        time_min = time[0]
+        return np.array([(loc+TOTAL_SPE_TOKEN, t-time_min, id2loc[loc][0], id2loc[loc][1]) for loc, t in zip(grid, time)])
 
 
     def get_insertion_input_seq2seq(trips_drop, labels):
@@ -78,28 +55,19 @@ def load_test_dataset(args, data_path, adj_path):
     loc_size = len(id2loc)
     loc2id = {loc: id for id, loc in id2loc.items()}
 
-    adj_pd = pd.read_csv(adj_path)
-    adj_pd = adj_pd.add({'src': TOTAL_SPE_TOKEN, 'dst': TOTAL_SPE_TOKEN, 'weight': 0})
-    G = nx.DiGraph()
-    G.add_nodes_from(list(range(loc_size + TOTAL_SPE_TOKEN)))
-    src, dst, weights = adj_pd['src'].values.tolist(), adj_pd['dst'].values.tolist(), adj_pd['weight'].values.tolist()
-    G.add_weighted_edges_from(zip(src, dst, weights))
-    adj_graph = nx.to_numpy_array(G)
+    adj_graph = read_adjacency(adj_path, loc_size + TOTAL_SPE_TOKEN, TOTAL_SPE_TOKEN)
 
-    test_traj = lbs_test['trips_sparse'].values.tolist()
-    test_tgt = dataset_collate(lbs_test['trips_new'].values.tolist())
-    drop_ratios = lbs_test['drop_ratio'].values.tolist()
-    num_labels = lbs_test['num_labels'].values.tolist()
+    test_target = LazyTrips(lbs_test, 'trips_new', columns=point_columns)
+    drop_ratios = lbs_test['drop_ratio'].tolist()
+    num_labels = lazy_lists(lbs_test, 'num_labels')
 
     max_len = 60
 
-    print("test num {}, target {}, " \
-          .format(len(test_traj), len(test_tgt)))
-
     # + special tokens: PAD, BOS, EOS, NUL, BLK
-    test_input = data_to_input(test_traj)
-    # test_target = data_to_input(test_tgt)
-    test_target = test_tgt
+    test_input = LazyTrips(lbs_test, 'trips_sparse', data_to_input, columns=point_columns)
+
+    print("test num {}, target {}, " \
+          .format(len(test_input), len(test_target)))
 
     return test_input, test_target, loc_size, id2loc, max_len, adj_graph, drop_ratios, num_labels
 
@@ -184,8 +152,8 @@ def test_twostage(args):
 
     insertion_model.load_state_dict(torch.load(recovery_model_path, map_location=args.device))
 
-    A = calculate_laplacian_matrix(adj_graph, mat_type='hat_rw_normd_lap_mat')
-    A = torch.from_numpy(A).float().to_sparse().to(device=args.device)
+    A = calculate_laplacian_matrix(adj_graph, mat_type='hat_rw_normd_lap_mat', cache_path=os.path.join(data_path, 'graph_A.csv.cache'))
+    A = laplacian_to_tensor(A).to(device=args.device)
 
     ### Stage 1: tagging for BLK token
     test_size, eval_batch = len(test_input), args.batch_size
@@ -291,29 +259,6 @@ def test_twostage(args):
 
 def evaluate(test_input, preds, test_target, num_labels, id2loc, maxlen, data_path):
 
-    def euclidean_square_distance(p1, p2):
-        to4326 = Transformer.from_crs("epsg:4575", "epsg:4326", always_xy=True)
-        # to3086 = Transformer.from_crs("epsg:4326", "epsg:3086")
-        point1 = to4326.transform(p1[1], p1[0])
-        point2 = to4326.transform(p2[1], p2[0])
-
-        return (great_circle(point1, point2).meters) ** 2
-
-    def find_best_subsequence(long, short):
-        len_long = len(long)
-        len_short = len(short)
-        min_distance = float('inf')
-        best_subseq = None
-
-        for start in range(len_long - len_short + 1):
-            subseq = long[start:start + len_short]
-            distance, _ = fastdtw(np.array(short), np.array(subseq), dist=euclidean_square_distance)
-            if distance < min_distance:
-                min_distance = distance
-                best_subseq = subseq
-
-        return min_distance
-
     def process_trip(idx, drop, pred, label, tag, id2loc):
         label = [l[0] for l in label]
         pred = [p - TOTAL_SPE_TOKEN for p in pred if p >= TOTAL_SPE_TOKEN]
@@ -4,63 +4,44 @@ import numpy as np
 import pandas as pd
 import pickle
 import argparse
-import networkx as nx
 import torch
 import os
 import sys
-import pyproj
-from pyproj import Transformer
 import torch.nn as nn
-from itertools import combinations
 from RMSE_point import RMSE_point
 
 sys.path.append('../')
 
 from model import Transformer_insertion
 from detection_stage.model import Transformer_tagging
-from utils import get_masks_and_count_tokens_src, get_masks_and_count_tokens_trg, calculate_laplacian_matrix
+from utils import get_masks_and_count_tokens_src, get_masks_and_count_tokens_trg, calculate_laplacian_matrix, laplacian_to_tensor
 from dataloader import pad_arrays
+from decoding import decode_gaps, distance_index, graph_index
 from constants import *
 from collections import defaultdict
-from geopy.distance import great_circle
-from fastdtw import fastdtw
+from DataPreProcess.trips_store import load_trips, read_csv_cached, LazyTrips, lazy_lists
+from DataPreProcess.graph_store import read_adjacency
+from DataPreProcess.geo import to_wgs84, square_distance_matrix, grid_center_table
+from DataPreProcess.alignment import best_subsequence
 
 
 def load_test_dataset(args, data_path, adj_path):
-    test_path = os.path.join(data_path, 'traj_test.csv')
-    lbs_test = pd.read_csv(test_path, converters={'trips_sparse': eval,
-                                                  'num_labels': eval})
+    if args.data_format == 'csv':
+        test_path = os.path.join(data_path, 'traj_test.csv')
+        lbs_test = read_csv_cached(test_path)
+    elif args.data_format == 'npz':
+        lbs_test = load_trips(os.path.join(data_path, 'traj_test.npz'))
+    else:
+        raise ValueError(f'ERROR: {args.data_format} is unknown.')
     # id2loc = pickle.load(open(os.path.join(data_path,"grid2center_Beijing.pickle"), 'rb'))
     id2loc = pickle.load(open(os.path.join(data_path, "grid2center_" + args.data_name + ".pickle"), 'rb'))
-    print("test data size {}, location num {}".format(len(lbs_test), len(id2loc)))
-
-    to3414 = Transformer.from_crs("epsg:4326", "epsg:4575", always_xy=True)
-
-    def dataset_collate(trips):
-        trips_collate = []
-        for trip in trips:
-            trip_collate = []
-            trip = trip.split(';')
-            for loc in trip:
-                idx, lon, lat, cog, sog, time = loc.split(',')
-                trip_collate.append([int(idx), float(lon), float(lat), float(cog), float(sog), int(time)])
-            trips_collate.append(trip_collate)
-        return trips_collate
-
-
-    def data_to_input(trips):
-        trips_input = []
-        for trip in trips:
-            res = []
-            time_min = trip[0][-1]
-            for (loc, lon, lat, cog, sog, time) in trip:
-                if loc == 'BLK':
-                    res.append((BLK_TOKEN, 5000, 20447840.4, 4419792.3 ,0 ,0))
-                else:
-                    coords = id2loc[loc]
-                    res.append((int(loc)+TOTAL_SPE_TOKEN, time-time_min, coords[0], coords[1], cog, sog))
-            trips_input.append(np.array(res))
-        return trips_input
+    print("test data size {}, location num {}".format(len(lbs_test['drop_ratio']), len(id2loc)))
+
+    def data_to_input(columns):
+        grid, lon, lat, cog, sog, time = [column.tolist() for column in columns]
+        time_min = time[0]
+        return np.array([(loc+TOTAL_SPE_TOKEN, t-time_min, id2loc[loc][0], id2loc[loc][1], c, s)
+                         for loc, t, c, s in zip(grid, time, cog, sog)])
 
 
     def get_insertion_input_seq2seq(trips_drop, labels):
@@ -83,87 +64,22 @@ def load_test_dataset(args, data_path, adj_path):
     loc_size = len(id2loc)
     loc2id = {loc: id for id, loc in id2loc.items()}
 
-    adj_pd = pd.read_csv(adj_path)
-    adj_pd = adj_pd.add({'src': TOTAL_SPE_TOKEN, 'dst': TOTAL_SPE_TOKEN, 'weight': 0})
-    G = nx.DiGraph()
-    G.add_nodes_from(list(range(loc_size + TOTAL_SPE_TOKEN)))
-    src, dst, weights = adj_pd['src'].values.tolist(), adj_pd['dst'].values.tolist(), adj_pd['weight'].values.tolist()
-    G.add_weighted_edges_from(zip(src, dst, weights))
-    adj_graph = nx.to_numpy_array(G)
+    adj_graph = read_adjacency(adj_path, loc_size + TOTAL_SPE_TOKEN, TOTAL_SPE_TOKEN)
 
-    test_traj = lbs_test['trips_sparse'].values.tolist()
-    test_tgt = dataset_collate(lbs_test['trips_new'].values.tolist())
-    drop_ratios = lbs_test['drop_ratio'].values.tolist()
-    num_labels = lbs_test['num_labels'].values.tolist()
+    # 两种格式都是列式轨迹表，轨迹在取用时才转换
+    test_target = LazyTrips(lbs_test, 'trips_new')
+    num_labels = lazy_lists(lbs_test, 'num_labels')
+    drop_ratios = lbs_test['drop_ratio'].tolist()
 
     max_len = 60
 
+    # + special tokens: PAD, BOS, EOS, NUL, BLK
+    test_input = LazyTrips(lbs_test, 'trips_sparse', data_to_input)
+
     print("test num {}, target {}, " \
-          .format(len(test_traj), len(test_tgt)))
+          .format(len(test_input), len(test_target)))
 
-    # + special tokens: PAD, BOS, EOS, NUL, BLK
-    test_input = data_to_input(test_traj)
-    # test_target = data_to_input(test_tgt)
-    test_target = test_tgt
-
-    distance = trips_distance(id2loc)
-
-    # new_filename = 'distance_matrix.csv'
-    # output_path = os.path.join(data_path, new_filename)
-    # distance.to_csv(output_path, index=False)
-
-    return test_input, test_target, loc_size, id2loc, max_len, adj_graph, drop_ratios, num_labels, distance
-
-
-def trips_distance(grid2center):
-    # 将字典中的坐标转换为 NumPy 数组
-    keys = list(grid2center.keys())
-    coordinates = np.array([grid2center[key] for key in keys])
-
-    # 计算所有点之间的距离
-    def calculate_distances(coordinates):
-        # to4326 = Transformer.from_crs("epsg:4087", "epsg:4326", always_xy=True)
-        # coordinates_trans = to4326.transform(coordinates[:, 1], coordinates[:, 0])
-
-        # coordinates_trans = utm_to_wgs84(coordinates[:, 1], coordinates[:, 0])
-
-        # Convert coordinates to radians
-        # coords_rad = np.radians(coordinates_trans)
-        #
-        # # Extract latitudes and longitudes
-        # lat1 = coords_rad[:, 0][:, np.newaxis]
-        # lon1 = coords_rad[:, 1][:, np.newaxis]
-        # lat2 = coords_rad[:, 0]
-        # lon2 = coords_rad[:, 1]
-        #
-        # # Compute differences
-        # dlat = lat2 - lat1
-        # dlon = lon2 - lon1
-        #
-        # # Apply Haversine formula
-        # a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
-        # c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
-        #
-        # R = 6371.0
-        #
-        # # Distance matrix in kilometers
-        # distance_matrix_km = R * c
-        #
-        # # Convert distance matrix to meters
-        # distance_matrix_m = distance_matrix_km * 1000
-
-        
-        # num_points = len(coordinates)
-        distance_matrix_m = np.linalg.norm(coordinates[:, np.newaxis] - coordinates, axis=2)
-        return distance_matrix_m
-
-    # 调用函数计算距离
-    distance_matrix = calculate_distances(coordinates)
-
-    # 将距离矩阵转换为 DataFrame
-    distance = pd.DataFrame(distance_matrix, index=keys, columns=keys)
-
-    return distance
+    return test_input, test_target, loc_size, id2loc, max_len, adj_graph, drop_ratios, num_labels
 
 
 def collate_multi_class_label(label):
@@ -196,58 +112,6 @@ def get_insertion_input_data(traj, num_label):
 
 
 # 找到上一个点位的网格号
-def find_last_loc(traj_locs, masked_pos_batch, batch_pred_inputs):
-
-    max_len = batch_pred_inputs.size(1)
-
-    index = masked_pos_batch[:, max_len] - 1
-
-    if max_len == 0:
-
-        # 使用 np.arange 和高级索引提取指定元素
-        selected_data = traj_locs[np.arange(index.shape[0]), index]
-
-        # 将结果转换为二维数组
-        last_loc = selected_data[:, None]
-
-        # last_loc = traj_locs[:, index]
-        return last_loc
-
-    masked_pos_pres_batch = masked_pos_batch[:, :max_len]
-
-    new_traj_locs = traj_locs.clone()
-
-    # 更新数组 traj_locs
-    new_traj_locs[np.arange(masked_pos_batch.shape[0])[:, None], masked_pos_pres_batch] = batch_pred_inputs
-
-    # 将 index 和 traj_locs 转换为 NumPy 数组
-    index_np = index.cpu().numpy()
-    new_traj_locs_np = new_traj_locs.cpu().numpy()
-
-    # 生成所有可能的索引
-    all_indices = np.arange(traj_locs.shape[1])
-
-    # 生成每个子数组的有效索引
-    valid_indices = all_indices[None, :] <= index_np[:, None]
-
-    # 生成每个子数组中大于等于5的值的掩码
-    valid_values_mask = (new_traj_locs_np >= 5) & valid_indices
-
-    max_indices = valid_values_mask.shape[1] - 1 - np.argmax(valid_values_mask[:, ::-1], axis=1)
-    # 处理没有满足条件的索引
-    no_valid_mask = ~valid_values_mask.any(axis=1)
-    max_indices[no_valid_mask] = 0  # 设置为0，因为np.argmax返回0
-
-    # 提取结果值
-    last_loc = new_traj_locs[np.arange(len(index)), max_indices]
-
-    # last_loc = last_loc.flatten()
-
-    last_loc = last_loc.reshape(-1)
-
-    return last_loc
-
-
 def test_twostage(args):
     data_path = os.path.join(args.data_path, args.data_name)
     adj_path = os.path.join(data_path, 'graph_A.csv')
@@ -255,7 +119,7 @@ def test_twostage(args):
     recovery_model_path = os.path.join(args.model_path, 'model_recovery')
 
 
-    test_input, test_target, loc_size, id2loc, max_len, adj_graph, drop_ratios, num_labels, distance = load_test_dataset(args, data_path, adj_path)
+    test_input, test_target, loc_size, id2loc, max_len, adj_graph, drop_ratios, num_labels = load_test_dataset(args, data_path, adj_path)
 
     # 调整 NumPy 显示选项
     # np.set_printoptions(threshold=np.inf)  # 显示所有元素
@@ -299,8 +163,8 @@ def test_twostage(args):
     insertion_model.load_state_dict(torch.load(recovery_model_path, map_location=args.device))
 
 
-    A = calculate_laplacian_matrix(adj_graph, mat_type='hat_rw_normd_lap_mat')
-    A = torch.from_numpy(A).float().to_sparse().to(device=args.device)
+    A = calculate_laplacian_matrix(adj_graph, mat_type='hat_rw_normd_lap_mat', cache_path=os.path.join(data_path, 'graph_A.csv.cache'))
+    A = laplacian_to_tensor(A).to(device=args.device)
 
     ### Stage 1: tagging for BLK token
     test_size, eval_batch = len(test_input), args.batch_size
@@ -369,6 +233,11 @@ def test_twostage(args):
 
     ### Stage 2: insertion for BLK tokens
 
+    # 解码约束只构建一次
+    centers = grid_center_table(os.path.join(data_path, "grid2center_" + args.data_name + ".pickle"), epsg)
+    candidate_index = distance_index(centers['xy'], args.candidate_loc_distance, args.device)
+    edge_index = graph_index(adj_graph, args.device) if args.graph_constraint else None
+
     insertion_model.eval()
     inputs = []
     final_preds = []
@@ -392,61 +261,11 @@ def test_twostage(args):
             masked_pos_batch = pad_arrays(masked_pos_np)
 
             masked_pos_batch = torch.tensor(masked_pos_batch, dtype=torch.long, device=args.device)
-            batch_pred_inputs = torch.tensor([BLK_TOKEN] * traj_locs.size(0), dtype=torch.long,
-                                             device=args.device).unsqueeze(1)
+            batch_preds = decode_gaps(insertion_model, traj_locs, traj_tms, traj_coors, traj_cogs, traj_sogs, masked_pos_batch,
+                                      masked_pos_lengths, A, beam_size=args.beam_size, distance_index=candidate_index,
+                                      graph_index=edge_index, forbid_special=bool(args.forbid_special))
 
-            for idx in range(masked_pos_batch.shape[1]):
-                attn_mask, _ = get_masks_and_count_tokens_trg(torch.cat([traj_locs, batch_pred_inputs], dim=1),
-                                                              PAD_TOKEN)
-                batch_masked_pos_cur = masked_pos_batch[:, :idx + 1]
-
-                trg_probs = insertion_model(traj_locs, traj_tms, traj_coors, traj_cogs, traj_sogs, attn_mask, A, 'recovery', batch_masked_pos_cur,
-                                            batch_pred_inputs)
-
-                last_words_batch = trg_probs[:, idx]  # B x vocab_size
-
-                # 找到距离上一个轨迹点较近的候选点
-                last_loc = find_last_loc(traj_locs, masked_pos_batch, batch_pred_inputs[:, 1:])
-
-                # 将张量从 CUDA 设备转移到 CPU
-                last_loc_cpu = last_loc.cpu()
-
-                # 将张量转换为 NumPy 数组
-                last_loc_np = last_loc_cpu.numpy()
-
-                # 确保 last_loc - 5 的结果保持为正数
-                last_loc_np = np.maximum(last_loc_np - 5, 0)
-
-                # 将 last_loc_np 转换为 PyTorch 张量，并移动到与 distance 相同的设备
-                last_loc_tensor = torch.tensor(last_loc_np, dtype=torch.int64, device=args.device).flatten()
-
-
-                distance_tensor = torch.tensor(distance.values, device=args.device)
-
-                # 从 distance 矩阵中选择特定的列
-                distances_to_last_loc = torch.index_select(distance_tensor, dim=0, index=last_loc_tensor)
-
-                # 生成布尔掩码，表示距离是否小于candidate_loc_distance
-                mask = distances_to_last_loc <= args.candidate_loc_distance
-
-                # 生成 5 行全为 True 的张量
-                true_rows = torch.ones(last_words_batch.size(0), TOTAL_SPE_TOKEN, dtype=torch.bool, device=args.device)
-
-                # 使用 torch.cat 拼接张量
-                new_mask = torch.cat([true_rows, mask], dim=1)
-
-                # 使用 torch.where 函数
-                last_words_batch = torch.where(new_mask, last_words_batch, -float('inf'))
-
-                # with open(data_path + '/last_words_batch.txt', 'a') as log_file:
-                #     for i in range(last_words_batch.shape[1]):
-                #         log_file.write("i:{} last_words_batch:{}\n".format(i, last_words_batch[:, i]))
-
-                pred_locs = torch.argmax(last_words_batch, dim=-1)
-
-                batch_pred_inputs = torch.cat([batch_pred_inputs, pred_locs.unsqueeze(1)], dim=1)
-
-            output_pred_locs = batch_pred_inputs[:, 1:].cpu().numpy()  # remove the first blk token
+            output_pred_locs = batch_preds.cpu().numpy()
             output_locs = traj_locs.cpu().numpy()
             batch_preds_post = []
 
@@ -484,10 +303,10 @@ def evaluate(args, test_input, preds, test_target, num_labels, id2loc, maxlen, d
     pred_trips = []
     pred_trips_id = 0
 
-    to4326 = Transformer.from_crs(f"epsg:{epsg}", "epsg:4326", always_xy=True)
-
     for idx, (drop, pred, label_origin, tag) in enumerate(zip(test_input, preds, test_target, num_labels)):
         label = [l[0] for l in label_origin]
+        # 整条轨迹的经纬度一次转换
+        label_lonlat = [tuple(lonlat) for lonlat in to_wgs84([(row[1], row[2]) for row in label_origin], epsg).tolist()]
         pred = [p - TOTAL_SPE_TOKEN for p in pred if p >= TOTAL_SPE_TOKEN]
 
         pred_seq = []
@@ -501,8 +320,8 @@ def evaluate(args, test_input, preds, test_target, num_labels, id2loc, maxlen, d
 
         if len(pred) == len(tag):
             pred_seq = [
-                [item[0], to4326.transform(item[1], item[2]), to4326.transform(item[1], item[2])] + [0]
-                for item in label_origin
+                [item[0], lonlat, lonlat] + [0]
+                for item, lonlat in zip(label_origin, label_lonlat)
             ]
 
             pred_trips.append({'id': pred_trips_id, 'trips': pred_seq, 'single_RMSE': -1})
@@ -523,15 +342,15 @@ def evaluate(args, test_input, preds, test_target, num_labels, id2loc, maxlen, d
                 # 找出被预测的地方
                 if tag[i] == 0:
                     pred_seq.append([label_origin[label_index][0],
-                                     to4326.transform(label_origin[label_index][1],label_origin[label_index][2]),
-                                     to4326.transform(label_origin[label_index][1],label_origin[label_index][2])]
+                                     label_lonlat[label_index],
+                                     label_lonlat[label_index]]
                                     + [0])  # 使用原来的
                     label_index += 1
                     continue
 
                 pred_seq.append([label_origin[label_index][0],
-                                 to4326.transform(label_origin[label_index][1],label_origin[label_index][2]),
-                                 to4326.transform(label_origin[label_index][1],label_origin[label_index][2])]
+                                 label_lonlat[label_index],
+                                 label_lonlat[label_index]]
                                 + [0])  # 使用原来的
                 label_index += 1
                 # print("label_index:{} last_label_index:{} ".format(label_index, last_label_index))
@@ -578,12 +397,8 @@ def evaluate(args, test_input, preds, test_target, num_labels, id2loc, maxlen, d
                         label_index = label_index + tag[i]
                         last_label_index = label_index
 
-                        for coord_label, coord_pred in zip(converted_label, best_subseq):
-                            x1, y1 = coord_label
-                            lat_lon_label = to4326.transform(x1, y1)
-                            x2, y2 = coord_pred
-                            lat_lon_pred = to4326.transform(x2, y2)
-                            pred_seq.append([-1, lat_lon_label, lat_lon_pred, 1])
+                        for lat_lon_label, lat_lon_pred in zip(to_wgs84(converted_label, epsg).tolist(), to_wgs84(best_subseq, epsg).tolist()):
+                            pred_seq.append([-1, tuple(lat_lon_label), tuple(lat_lon_pred), 1])
 
                     else:
                         converted_label_subset = label_origin[label_index: label_index + tag[i]]
@@ -605,12 +420,8 @@ def evaluate(args, test_input, preds, test_target, num_labels, id2loc, maxlen, d
                         label_index = label_index + tag[i]
                         last_label_index = label_index
 
-                        for coord_label, coord_pred in zip(best_subseq, converted_pred):
-                            x1, y1 = coord_label
-                            lat_lon_label = to4326.transform(x1, y1)
-                            x2, y2 = coord_pred
-                            lat_lon_pred = to4326.transform(x2, y2)
-                            pred_seq.append([-1, lat_lon_label, lat_lon_pred, 1])
+                        for lat_lon_label, lat_lon_pred in zip(to_wgs84(best_subseq, epsg).tolist(), to_wgs84(converted_pred, epsg).tolist()):
+                            pred_seq.append([-1, tuple(lat_lon_label), tuple(lat_lon_pred), 1])
 
             # print("single_RMSE_count:{}".format(single_RMSE_count))
 
@@ -680,43 +491,15 @@ def evaluate(args, test_input, preds, test_target, num_labels, id2loc, maxlen, d
     return prec, recall, recovery, m_prec
 
 
-def euclidean_square_distance(p1, p2):
-    to4326 = Transformer.from_crs(f"epsg:{epsg}", "epsg:4326")
-    # to4326 = Transformer.from_crs("epsg:4575", "epsg:4326")
-    # to4326 = Transformer.from_crs("epsg:4087", "epsg:4326")
-
-    point1 = to4326.transform(p1[1], p1[0])
-    point2 = to4326.transform(p2[1], p2[0])
-
-    # print(point1)
-
-    return (great_circle(point1, point2).meters) ** 2
-    # 计算两点之间的欧氏距离的平方
-    # return ((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2)
-
-
+# 在 long 中选出长度为 len(short) 的保序子序列，使其与 short 的 DTW 距离最小，返回最小距离和该子序列
+# 原来枚举所有组合再逐个做 fastdtw，这里用 alignment.best_subsequence 的动态规划精确求解
 def find_best_subsequence(long, short):
-    len_long = len(long)
-    len_short = len(short)
-    min_distance = float('inf')
-    best_subseq = None
-
-    # for start in range(len_long - len_short + 1):
-    #     subseq = long[start:start + len_short]
-    #     distance, _ = fastdtw(np.array(short), np.array(subseq), dist=euclidean_square_distance)
-    #     if distance < min_distance:
-    #         min_distance = distance
-    #         best_subseq = subseq
+    if len(short) == 0:
+        return 0, []
 
-    # 生成所有长度为 len_short 的组合
-    for indices in combinations(range(len_long), len_short):
-        subseq = [long[i] for i in indices]
-        distance, _ = fastdtw(np.array(short), np.array(subseq), dist=euclidean_square_distance)
-        if distance < min_distance:
-            min_distance = distance
-            best_subseq = subseq
+    min_distance, selected = best_subsequence(square_distance_matrix(short, long, epsg))
 
-    return min_distance, best_subseq
+    return min_distance, [long[j] for j in selected]
 
 
 def save_file(df, output_path, new_filename):
@@ -759,8 +542,16 @@ if __name__ == '__main__':
                         help='Dataset path')
     parser.add_argument("--data_name", type=str, default="AIS_2023_101112",
                         help="data name")
+    parser.add_argument("--data_format", type=str, default="npz",
+                        help="dataset format, csv or npz")
     parser.add_argument("--candidate_loc_distance", type=int, default=10000,
                         help="candidate loc distance")
+    parser.add_argument("--beam_size", type=int, default=1,
+                        help="beam size for gap recovery, 1 for greedy decoding")
+    parser.add_argument("--graph_constraint", type=int, default=0,
+                        help="only decode locations reachable from the previous location in graph_A.csv")
+    parser.add_argument("--forbid_special", type=int, default=0,
+                        help="forbid special tokens inside a gap except trailing NUL tokens")
 
 
     args = parser.parse_args()
@@ -0,0 +1,53 @@
+import os
+import sys
+import itertools
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from DataPreProcess.alignment import dtw_distance, best_window, best_subsequence
+
+
+# find_best_subsequence 的动态规划与暴力枚举的对照：long 不超过 7 个点时枚举所有保序子序列，逐个做精确 DTW
+
+
+def exact_dtw(dist):
+    n, m = dist.shape
+    D = np.full((n + 1, m + 1), np.inf)
+    D[0, 0] = 0
+    for i in range(1, n + 1):
+        for j in range(1, m + 1):
+            D[i, j] = dist[i - 1, j - 1] + min(D[i - 1, j], D[i, j - 1], D[i - 1, j - 1])
+    return D[n, m]
+
+
+def random_cases(count, seed=0):
+    rng = np.random.default_rng(seed)
+    for _ in range(count):
+        m = int(rng.integers(1, 8))
+        n = int(rng.integers(1, m + 1))
+        # 取整后容易出现相等的距离，检查并列时的选择
+        yield np.round(rng.random((n, m)) * 10) if rng.random() < 0.3 else rng.random((n, m))
+
+
+def test_dtw_distance_matches_exact():
+    for dist in random_cases(200, seed=1):
+        assert np.isclose(dtw_distance(dist), exact_dtw(dist))
+
+
+def test_best_subsequence_matches_combinations():
+    for dist in random_cases(300):
+        n, m = dist.shape
+        brute_force = min(exact_dtw(dist[:, list(indices)]) for indices in itertools.combinations(range(m), n))
+
+        min_distance, selected = best_subsequence(dist)
+        assert np.isclose(min_distance, brute_force)
+        # 回溯得到的子序列保序且距离与最小值一致
+        assert len(selected) == n and all(a < b for a, b in zip(selected, selected[1:]))
+        assert np.isclose(exact_dtw(dist[:, selected]), min_distance)
+
+
+def test_best_window_matches_windows():
+    for dist in random_cases(200, seed=2):
+        n, m = dist.shape
+        assert np.isclose(best_window(dist), min(exact_dtw(dist[:, start:start + n]) for start in range(m - n + 1)))
+    assert best_window(np.ones((3, 2))) == float('inf')
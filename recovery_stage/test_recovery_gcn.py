@@ -0,0 +1,68 @@
+import os
+import sys
+import torch
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from model import GCN, Transformer_insertion
+
+
+# GCN 的子图计算与全图计算一致，位置上下文表的缓存在换了邻接矩阵或修改了参数后重新计算
+
+
+def random_graph(n_vertex, n_edges, seed):
+    generator = torch.Generator().manual_seed(seed)
+    indices = torch.randint(0, n_vertex, (2, n_edges), generator=generator)
+    indices = torch.cat([indices, torch.arange(n_vertex).repeat(2, 1)], dim=1)
+    values = torch.rand(indices.shape[1], generator=generator)
+    return torch.sparse_coo_tensor(indices, values, (n_vertex, n_vertex)).coalesce()
+
+
+def test_forward_subgraph_matches_full_graph():
+    torch.manual_seed(0)
+    for n_layers, seed in [(1, 0), (2, 1), (3, 2)]:
+        gcn = GCN(8, [8] * (n_layers - 1), 8, 0.5).eval()
+        x = torch.randn(200, 8)
+        adj = random_graph(200, 300, seed)
+        token_ids = torch.randint(0, 200, (40,), generator=torch.Generator().manual_seed(seed))
+        with torch.no_grad():
+            torch.testing.assert_close(gcn.forward_subgraph(x, adj, token_ids), gcn(x, adj)[token_ids])
+
+
+def count_gcn_calls(model):
+    calls = []
+    model.gcn.register_forward_hook(lambda module, inputs, output: calls.append(1))
+    return calls
+
+
+def test_context_cache_follows_graph_and_parameters():
+    torch.manual_seed(0)
+    model = Transformer_insertion(16, 16, 16, 30, 30, 2, 1, 0.1, 20, 'cpu', learnable_pos=False).eval()
+    calls = count_gcn_calls(model)
+    token_ids = torch.arange(30)
+    adj = random_graph(30, 60, 0)
+
+    first = model.context_embeddings(adj, token_ids)
+    model.context_embeddings(adj, token_ids)
+    assert len(calls) == 1
+
+    # 内容不同的另一个邻接矩阵（即使 id 相同也不能用旧表）
+    other = random_graph(30, 60, 1)
+    with torch.no_grad():
+        torch.testing.assert_close(model.context_embeddings(other, token_ids), model.gcn(model.src_embedding_cxt.weight, other))
+    assert len(calls) == 3
+
+    # 不再被引用的邻接矩阵释放后，新的邻接矩阵可能重用它的 id
+    for seed in range(2, 20):
+        with torch.no_grad():
+            torch.testing.assert_close(model.context_embeddings(random_graph(30, 60, seed), token_ids),
+                                       model.gcn(model.src_embedding_cxt.weight, random_graph(30, 60, seed)))
+    calls.clear()
+
+    # 原地修改邻接矩阵、修改参数
+    other.values().mul_(2)
+    model.context_embeddings(other, token_ids)
+    assert len(calls) == 1
+    with torch.no_grad():
+        model.src_embedding_cxt.weight.add_(1)
+    assert not torch.equal(model.context_embeddings(adj, token_ids), first)
+    assert len(calls) == 2
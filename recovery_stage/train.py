@@ -6,7 +6,6 @@ import argparse
 import torch
 import torch.nn as nn
 from model import Transformer_insertion, CL_Loss
-from pyproj import Transformer
 
 from dataloader import TrajectoryInfillingDataset, TestingInfillingDataset, dataloader_collate, dataloader_collate_test
 from torch.utils.data import DataLoader
@@ -17,7 +16,7 @@ from constants import *
 
 def train_recovery(args):
 
-    train_data, val_input, val_num_labels, val_trg, test_input, test_num_labels, test_trg, loc_size, id2loc, max_len, adj_graph = load_dataset(args, 'csv')
+    train_data, val_input, val_num_labels, val_trg, test_input, test_num_labels, test_trg, loc_size, id2loc, max_len, adj_graph = load_dataset(args, args.data_format)
 
     pad_token_id = PAD_TOKEN  # pad token id is the same for target as well
 
@@ -31,10 +30,12 @@ def train_recovery(args):
         number_of_layers=args.num_layers,
         dropout_probability=args.dropout,
         max_len=max_len,
-        device = args.device
+        device = args.device,
+        gcn_refresh_steps=args.gcn_refresh_steps,
+        gcn_subgraph=bool(args.gcn_subgraph)
     ).to(args.device)
 
-    A = calculate_laplacian_matrix(adj_graph, mat_type='hat_rw_normd_lap_mat')
+    A = calculate_laplacian_matrix(adj_graph, mat_type='hat_rw_normd_lap_mat', cache_path=os.path.join(args.data_path, args.data_name, 'graph_A.csv.cache'))
 
     train_dataset = TrajectoryInfillingDataset(train_data, args, max_len, drop_num=[1, 2, 3, 4],
                                              drop_ratio=[0.2, 0.3, 0.4, 0.5, 0.6], id2loc=id2loc)
@@ -51,7 +52,7 @@ def train_recovery(args):
     cl_loss = CL_Loss(args.temperature, args.device)
 
     optimizer = torch.optim.Adam(recovery_model.parameters(), lr=args.lr)
-    A = torch.from_numpy(A).float().to_sparse().to(device=args.device)
+    A = laplacian_to_tensor(A).to(device=args.device)
 
 
     best_rec = 0
@@ -189,6 +190,12 @@ if __name__ == '__main__':
                         help='Dataset path')
     parser.add_argument("--data_name", type=str, default="AIS_2023_101112",
                         help="data name")
+    parser.add_argument("--data_format", type=str, default="npz",
+                        help="dataset format, csv or npz")
+    parser.add_argument("--gcn_refresh_steps", type=int, default=1,
+                        help="recompute the GCN context embeddings every K training steps")
+    parser.add_argument("--gcn_subgraph", type=int, default=0,
+                        help="run the GCN only on the neighbourhood of the tokens in each batch")
 
 
     args = parser.parse_args()
@@ -2,14 +2,18 @@ import torch
 import torch.nn as nn
 import numpy as np
 import pandas as pd
-import networkx as nx
 import os
+import sys
 import pickle
-from pyproj import Transformer
 import math
 from constants import *
-from geopy.distance import great_circle
-from fastdtw import fastdtw
+
+sys.path.append('../')
+from DataPreProcess.trips_store import load_trips, read_csv_cached, LazyTrips, lazy_lists
+from DataPreProcess.graph_store import read_adjacency, calculate_laplacian_matrix
+from DataPreProcess.geo import square_distance_matrix, from_wgs84
+from DataPreProcess.alignment import best_window
+from decoding import decode_gaps
 
 def dataset_collate(trips):
     trips_collate = []
@@ -26,102 +30,53 @@ def dataset_collate(trips):
 def load_dataset(args, data_format):
     # data_path = os.path.join('../data/AIS', 'AIS_SOUTH_diff_3')
     data_path = os.path.join(args.data_path, args.data_name)
-    if data_format is 'csv':
-        adj_path = os.path.join(data_path, 'graph_A.csv')
-        train_path = os.path.join(data_path, 'traj_train.csv')
-        val_path = os.path.join(data_path, "traj_val.csv")
-        test_path = os.path.join(data_path, 'traj_test.csv')
-
-        lbs_train = pd.read_csv(train_path)
-        lbs_val = pd.read_csv(val_path, converters={'trips_sparse': eval, 'num_labels': eval})
-        lbs_test = pd.read_csv(test_path, converters={'trips_sparse': eval, 'num_labels': eval})
-        id2loc = pickle.load(open(os.path.join(data_path, 'grid2center_' + args.data_name + '.pickle'), 'rb'))
-        print("train data size {}, test data size {}, cell tower num {}".format(len(lbs_train), len(lbs_test),
-                                                                                len(id2loc)))
-
-    coor_transformer = Transformer.from_crs("epsg:4326", "epsg:4575", always_xy=True)
-
-    def data_to_input(trips):
-        trips_input = []
-        for trip in trips:
-            res = []
-            time_min = trip[0][-1]
-            for (loc, lon, lat, cog, sog, time) in trip:
-                if loc == 'BLK':
-                    res.append((BLK_TOKEN, PAD_TIME, PAD_LON, PAD_LAT, PAD_COG, PAD_SOG))
-                else:
-                    coords = id2loc[loc]
-                    res.append((int(loc)+TOTAL_SPE_TOKEN, time-time_min, coords[0], coords[1], cog, sog))
-            trips_input.append(res)
-        return trips_input
+    adj_path = os.path.join(data_path, 'graph_A.csv')
+    id2loc = pickle.load(open(os.path.join(data_path, 'grid2center_' + args.data_name + '.pickle'), 'rb'))
+    # 两种格式都读取为列式轨迹表，轨迹在 DataLoader 取用时才转换
+    if data_format == 'csv':
+        lbs_train = read_csv_cached(os.path.join(data_path, 'traj_train.csv'))
+        lbs_val = read_csv_cached(os.path.join(data_path, "traj_val.csv"))
+        lbs_test = read_csv_cached(os.path.join(data_path, 'traj_test.csv'))
+    elif data_format == 'npz':
+        lbs_train = load_trips(os.path.join(data_path, 'traj_train.npz'))
+        lbs_val = load_trips(os.path.join(data_path, 'traj_val.npz'))
+        lbs_test = load_trips(os.path.join(data_path, 'traj_test.npz'))
+    else:
+        raise ValueError(f'ERROR: {data_format} is unknown.')
 
-    loc_size = len(id2loc)
-    adj_pd = pd.read_csv(adj_path)
-    adj_pd = adj_pd.add({'src': TOTAL_SPE_TOKEN, 'dst': TOTAL_SPE_TOKEN, 'weight': 0})
-    G = nx.DiGraph()
-    G.add_nodes_from(list(range(loc_size+TOTAL_SPE_TOKEN)))
-    src, dst, weights = adj_pd['src'].values.tolist(), adj_pd['dst'].values.tolist(), adj_pd['weight'].values.tolist()
-    G.add_weighted_edges_from(zip(src, dst, weights))
-    adj_graph = nx.to_numpy_array(G)
-
-
-    train_traj = dataset_collate(lbs_train['trips_new'].values.tolist())
-    val_traj, val_num_labels = lbs_val['trips_sparse'].values.tolist(), lbs_val['num_labels'].values.tolist()
-    test_traj, test_num_labels = lbs_test['trips_sparse'].values.tolist(), lbs_test['num_labels'].values.tolist()
-    test_tgt = dataset_collate(lbs_test['trips_new'].values.tolist())
-    val_tgt = dataset_collate(lbs_val['trips_new'].values.tolist())
-
-
-    max_len = 0
-    for i in train_traj:
-        length = len(i)
-        if length > max_len:
-            max_len = length
-    print("train num {}, val num {}, test num {}, target {}" \
-          .format(len(train_traj), len(val_traj), len(test_traj), len(test_tgt)))
+    def data_to_input(columns):
+        grid, lon, lat, cog, sog, time = [column.tolist() for column in columns]
+        time_min = time[0]
+        return [(loc+TOTAL_SPE_TOKEN, t-time_min, id2loc[loc][0], id2loc[loc][1], c, s)
+                for loc, t, c, s in zip(grid, time, cog, sog)]
 
     # + special tokens: PAD, BOS, EOS, NUL, BLK
-    train_input = data_to_input(train_traj)
-    val_input = data_to_input(val_traj)
-    val_target = val_tgt
-    test_input = data_to_input(test_traj)
-    test_target = test_tgt
+    train_input = LazyTrips(lbs_train, 'trips_new', data_to_input)
+    val_input, val_num_labels = LazyTrips(lbs_val, 'trips_sparse', data_to_input), lazy_lists(lbs_val, 'num_labels')
+    test_input, test_num_labels = LazyTrips(lbs_test, 'trips_sparse', data_to_input), lazy_lists(lbs_test, 'num_labels')
+    val_target = LazyTrips(lbs_val, 'trips_new')
+    test_target = LazyTrips(lbs_test, 'trips_new')
+
+    print("train data size {}, test data size {}, cell tower num {}".format(len(train_input), len(test_input),
+                                                                            len(id2loc)))
+
+    loc_size = len(id2loc)
+    adj_graph = read_adjacency(adj_path, loc_size + TOTAL_SPE_TOKEN, TOTAL_SPE_TOKEN)
+
+    max_len = int(np.diff(lbs_train['trips_new.offsets']).max())
+    print("train num {}, val num {}, test num {}, target {}" \
+          .format(len(train_input), len(val_input), len(test_input), len(test_target)))
 
     return train_input, val_input, val_num_labels, val_target, test_input, test_num_labels, test_target, loc_size, id2loc, max_len, adj_graph
 
 
 
-def calculate_laplacian_matrix(adj_mat, mat_type):
-    n_vertex = adj_mat.shape[0]
-
-    # row sum
-    deg_mat_row = np.asmatrix(np.diag(np.sum(adj_mat, axis=1)))
-    # column sum
-    # deg_mat_col = np.asmatrix(np.diag(np.sum(adj_mat, axis=0)))
-    deg_mat = deg_mat_row
-
-    adj_mat = np.asmatrix(adj_mat)
-    id_mat = np.asmatrix(np.identity(n_vertex))
-
-    if mat_type == 'com_lap_mat':
-        # Combinatorial
-        com_lap_mat = deg_mat - adj_mat
-        return com_lap_mat
-    elif mat_type == 'wid_rw_normd_lap_mat':
-        # For ChebConv
-        rw_lap_mat = np.matmul(np.linalg.matrix_power(deg_mat, -1), adj_mat)
-        rw_normd_lap_mat = id_mat - rw_lap_mat
-        lambda_max_rw = eigsh(rw_lap_mat, k=1, which='LM', return_eigenvectors=False)[0]
-        wid_rw_normd_lap_mat = 2 * rw_normd_lap_mat / lambda_max_rw - id_mat
-        return wid_rw_normd_lap_mat
-    elif mat_type == 'hat_rw_normd_lap_mat':
-        # For GCNConv
-        wid_deg_mat = deg_mat + id_mat
-        wid_adj_mat = adj_mat + id_mat
-        hat_rw_normd_lap_mat = np.matmul(np.linalg.matrix_power(wid_deg_mat, -1), wid_adj_mat)
-        return hat_rw_normd_lap_mat
-    else:
-        raise ValueError(f'ERROR: {mat_type} is unknown.')
+# scipy 稀疏矩阵转换为 torch 稀疏张量
+def laplacian_to_tensor(lap_mat):
+    lap_mat = lap_mat.tocoo()
+    indices = torch.from_numpy(np.vstack((lap_mat.row, lap_mat.col)).astype(np.int64))
+    values = torch.from_numpy(lap_mat.data)
+    return torch.sparse_coo_tensor(indices, values, lap_mat.shape).float().coalesce()
 
 
 def loss_func(pred, true, func):
@@ -199,17 +154,12 @@ def get_masks_and_count_tokens(src_token_ids_batch, trg_token_ids_batch, pad_tok
 
 
 
-def project2D_enriched(updates, func):
-    updates2D = []
-    for update in updates:
-        lon = update[0]
-        lat = update[1]
-        (x, y) = func.transform(np.float(lon), np.float(lat))
-        updates2D.append([x, y])
-    return (updates2D)
+def project2D_enriched(updates, epsg):
+    # 所有点一次转换
+    return from_wgs84([(update[0], update[1]) for update in updates], epsg).tolist()
 
 
-def validation(dataset, model, A, device, sample=False):
+def validation(dataset, model, A, device, sample=False, beam_size=1):
     preds = []
     for i, batch_data in enumerate(dataset):
         with torch.no_grad():
@@ -220,29 +170,10 @@ def validation(dataset, model, A, device, sample=False):
             masked_pos = batch_masked_pos.cpu().numpy()
             masked_pos_lengths = batch_masked_pos_lengths.cpu().numpy()
 
-            batch_pred_inputs = torch.tensor([BLK_TOKEN] * batch_loc.size(0), dtype=torch.long,
-                                             device=device).unsqueeze(1)
-
-            for idx in range(batch_masked_pos.shape[1]):
-                attn_mask, _ = get_masks_and_count_tokens_trg(torch.cat([batch_loc, batch_pred_inputs], dim=1),
-                                                              PAD_TOKEN)
-                batch_masked_pos_cur = batch_masked_pos[:, :idx + 1]
+            batch_preds = decode_gaps(model, batch_loc, batch_time, batch_coor, batch_cog, batch_sog, batch_masked_pos,
+                                      batch_masked_pos_lengths, A, beam_size=beam_size, sample=sample)
 
-                assert batch_pred_inputs.shape[1] == batch_masked_pos_cur.shape[1], "decoding step not correct"
-
-                trg_probs = model(batch_loc, batch_time, batch_coor, batch_cog, batch_sog, attn_mask, A, 'recovery',
-                                           batch_masked_pos_cur, batch_pred_inputs)
-
-                last_words_batch = trg_probs[:, idx]  # B x vocab_size
-
-                if sample:
-                    pred_locs = torch.multinomial(last_words_batch, num_samples=1)
-                else:
-                    pred_locs = torch.argmax(last_words_batch, dim=-1)
-
-                batch_pred_inputs = torch.cat([batch_pred_inputs, pred_locs.unsqueeze(1)], dim=1)
-
-            output_pred_locs = batch_pred_inputs[:, 1:].cpu().numpy()  # remove the first blk token
+            output_pred_locs = batch_preds.cpu().numpy()
             output_locs = batch_loc.cpu().numpy()
             batch_preds_post = []
             for idx, (pred, masked_p, length, masked_pos_length) in enumerate(
@@ -452,35 +383,6 @@ def evaluate1(test_input, preds, test_target, num_labels, id2loc, maxlen):
     return prec, recall, recovery, m_prec, RMSE, RMSE_count
 
 
-def euclidean_square_distance(p1, p2):
-    to4326 = Transformer.from_crs(f"epsg:{epsg}", "epsg:4326", always_xy=True)
-    # to4326 = Transformer.from_crs("epsg:4575", "epsg:4326")
-    # to4326 = Transformer.from_crs("epsg:3086", "epsg:4326")
-
-    # point1 = to4326.transform(p1[1], p1[0])
-    # point2 = to4326.transform(p2[1], p2[0])
-
-    point1 = to4326.transform(p1[0], p1[1])
-    point2 = to4326.transform(p2[0], p2[1])
-
-    # print(point1)
-
-    return (great_circle(point1, point2).meters) ** 2
-    # 计算两点之间的欧氏距离的平方
-    # return ((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2)
-
-
+# 距离矩阵只计算一次，所有连续子序列一起做精确 DTW
 def find_best_subsequence(long, short):
-    len_long = len(long)
-    len_short = len(short)
-    min_distance = float('inf')
-    best_subseq = None
-
-    for start in range(len_long - len_short + 1):
-        subseq = long[start:start + len_short]
-        distance, _ = fastdtw(np.array(short), np.array(subseq), dist=euclidean_square_distance)
-        if distance < min_distance:
-            min_distance = distance
-            best_subseq = subseq
-
-    return min_distance
+    return best_window(square_distance_matrix(short, long, epsg))